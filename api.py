@@ -1,9 +1,12 @@
 import json
-import platform
-import pyodbc
-import requests
 from datetime import datetime, timedelta, date
 
+from balancedata_schema import KEY_COLUMNS, drop_staging, ensure_balancedata_keys, stage_rows
+from db import get_connection, print_timings, timed
+from fetch_retry import FailureJournal, RetryStats, post_json, resume_requested
+from http_transport import make_session, print_transfer_stats
+from run_report import span
+
 # ====== UTIL ======
 def today_samarkand() -> date:
     """Asia/Samarkand ~ UTC+5 (без pytz)"""
@@ -39,41 +42,8 @@ def to_float(val):
         return None
 
 
-def _pick_driver():
-    drivers = [d.strip() for d in pyodbc.drivers()]
-    for name in [
-        "ODBC Driver 18 for SQL Server",
-        "ODBC Driver 17 for SQL Server",
-        "SQL Server Native Client 11.0",
-        "SQL Server",
-    ]:
-        if name in drivers:
-            return name, drivers
-    return None, drivers
-
-
 def connect_sql():
-    driver = "{ODBC Driver 18 for SQL Server}"
-    server = "TAKEDA"
-    database = "SmartUpDB"
-
-    print(f"➡️  Используется ODBC driver: {{{driver}}}")
-
-    conn_str = (
-        f"DRIVER={driver};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        "Trusted_Connection=Yes;"
-        "Encrypt=No;"
-        "TrustServerCertificate=Yes;"
-    )
-    conn = pyodbc.connect(conn_str, autocommit=False)
-
-    # Unicode
-    conn.setdecoding(pyodbc.SQL_CHAR, encoding="utf-8")
-    conn.setdecoding(pyodbc.SQL_WCHAR, encoding="utf-16le")
-    conn.setencoding(encoding="utf-16le")
-    return conn
+    return get_connection("TAKEDA", "SmartUpDB")
 
 
 # ====== CONFIG ======
@@ -103,13 +73,18 @@ COLLATION = "Cyrillic_General_CI_AS"
 
 
 # ====== FETCH API ======
-def fetch_balance_chunks(filial_warehouse_list, begin_date: date, end_date: date):
+def fetch_balance_chunks(filial_warehouse_list, begin_date: date, end_date: date, resume: bool = False,
+                         journal: FailureJournal = None, done: list = None):
     """
     Для API mdeal/return$export:
     - корень: data["return"] -> список возвратов (ret)
     - товары: ret["return_products"] -> список позиций (product)
+    resume=True: только окна из журнала неудачных загрузок (.fetch_journal/api.json)
+    done: если задан, загруженные окна копятся в нём — из журнала их убирает вызывающий после commit
     """
-    session = requests.Session()
+    session = make_session()
+    journal = journal or FailureJournal("api")
+    stats = RetryStats()
     final_rows = []
     seen = set()
     all_data = []
@@ -120,7 +95,13 @@ def fetch_balance_chunks(filial_warehouse_list, begin_date: date, end_date: date
         warehouse_id_cfg = entry.get("warehouse_id")
         warehouse_code_cfg = entry.get("warehouse_code")
 
-        for start, finish in daterange(begin_date, end_date, step_days=30):
+        scope = f"filial={filial_id}|warehouse={warehouse_id_cfg}"
+        if resume:
+            windows = [(b.date(), e.date()) for b, e in journal.windows(scope)]
+        else:
+            windows = daterange(begin_date, end_date, step_days=30)
+
+        for start, finish in windows:
             # ВАЖНО: проверь по доке, какие именно поля нужны return API.
             # Ниже оставил твой payload, но многие return-эндпойнты не принимают warehouse_codes.
             payload = {
@@ -131,100 +112,110 @@ def fetch_balance_chunks(filial_warehouse_list, begin_date: date, end_date: date
             }
 
             try:
-                resp = session.post(
+                data = post_json(
+                    session,
                     URL,
+                    stats=stats,
                     params={},
                     auth=(USERNAME, PASSWORD),
                     headers={"Content-Type": "application/json; charset=utf-8"},
                     data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
                     timeout=60,
                 )
-                resp.encoding = "utf-8"
-                resp.raise_for_status()
-                data = resp.json()
 
                 returns = data.get("return", []) or []
                 added_count = 0
                 products_count = 0
 
-                for ret in returns:
-                    # даты на уровне возврата
-                    date_val = to_date(ret.get("delivery_date") or ret.get("booked_date") or ret.get("deal_time"))
-                    filial_code_ret = ret.get("filial_code") or filial_code_cfg
-                    batch_number_ret = ret.get("batch_number")
-
-                    # перебираем товары внутри возврата
-                    for product in ret.get("return_products", []):
-                        products_count += 1
-
-                        # В API возвратов warehouse_code лежит у товара
-                        warehouse_code = product.get("warehouse_code") or warehouse_code_cfg
-                        # warehouse_id в ответе не видно — оставляем из конфига или None
-                        warehouse_id = warehouse_id_cfg
-
-                        # Готовим объект для дедупа (только значимые поля)
-                        dedup_obj = {
-                            "date": str(date_val),
-                            "product_code": product.get("product_code"),
-                            "warehouse_code": warehouse_code,
-                            "filial_code": filial_code_ret,
-                            "batch_number": batch_number_ret,
-                            "serial_number": product.get("serial_number"),
-                            "return_quant": product.get("return_quant"),
-                            "product_price": product.get("product_price"),
-                        }
-                        # dedup
-                        for chunk in data.get("data", []):
-                             # делаем уникальный ключ с учётом филиала и склада
-                             key = json.dumps({
-                                  **chunk,
-                                  "filial_id": filial_id,
-                                  "warehouse_id": warehouse_id
-                                  }, sort_keys=True, ensure_ascii=False)
-                             if key in seen:
-                                  continue
-                             seen.add(key)
-                             chunk["filial_id"] = filial_id
-                             chunk["warehouse_id"] = warehouse_id
-                             all_data.append(chunk)
-
-
-
-                        # Группы/категории/брендов в return нет — ставим None
-                        group_name = category_name = brand_name = None
-
-                        # Маппинг в твои SQL-поля
-                        final_rows.append((
-                            product.get("inventory_kind"),            # inventory_kind
-                            date_val,                                 # date
-                            int(warehouse_id) if warehouse_id else None,  # warehouse_id
-                            warehouse_code,                            # warehouse_code
-                            product.get("product_code"),              # product_code
-                            None,                                     # product_barcode (в return нет)
-                            product.get("product_unit_id"),           # product_id (лучшее приближение)
-                            product.get("card_code"),                 # card_code
-                            to_date(product.get("expiry_date")),      # expiry_date
-                            product.get("serial_number"),             # serial_number
-                            batch_number_ret,                         # batch_number (из ret)
-                            to_float(product.get("return_quant")),    # quantity
-                            None,                                     # measure_code (в return нет)
-                            to_float(product.get("product_price")),   # input_price
-                            int(filial_id) if filial_id else None,    # filial_id (из конфига)
-                            filial_code_ret,                          # filial_code (из ответа/конфига)
-                            group_name,                               # group_name
-                            category_name,                            # category_name
-                            brand_name                                # brand_name
-                        ))
-                        added_count += 1
+                with span("transform") as tr:
+                    for ret in returns:
+                        # даты на уровне возврата
+                        date_val = to_date(ret.get("delivery_date") or ret.get("booked_date") or ret.get("deal_time"))
+                        filial_code_ret = ret.get("filial_code") or filial_code_cfg
+                        batch_number_ret = ret.get("batch_number")
+
+                        # перебираем товары внутри возврата
+                        for product in ret.get("return_products", []):
+                            products_count += 1
+
+                            # В API возвратов warehouse_code лежит у товара
+                            warehouse_code = product.get("warehouse_code") or warehouse_code_cfg
+                            # warehouse_id в ответе не видно — оставляем из конфига или None
+                            warehouse_id = warehouse_id_cfg
+
+                            # Готовим объект для дедупа (только значимые поля)
+                            dedup_obj = {
+                                "date": str(date_val),
+                                "product_code": product.get("product_code"),
+                                "warehouse_code": warehouse_code,
+                                "filial_code": filial_code_ret,
+                                "batch_number": batch_number_ret,
+                                "serial_number": product.get("serial_number"),
+                                "return_quant": product.get("return_quant"),
+                                "product_price": product.get("product_price"),
+                            }
+                            # dedup
+                            for chunk in data.get("data", []):
+                                 # делаем уникальный ключ с учётом филиала и склада
+                                 key = json.dumps({
+                                      **chunk,
+                                      "filial_id": filial_id,
+                                      "warehouse_id": warehouse_id
+                                      }, sort_keys=True, ensure_ascii=False)
+                                 if key in seen:
+                                      continue
+                                 seen.add(key)
+                                 chunk["filial_id"] = filial_id
+                                 chunk["warehouse_id"] = warehouse_id
+                                 all_data.append(chunk)
+
+
+
+                            # Группы/категории/брендов в return нет — ставим None
+                            group_name = category_name = brand_name = None
+
+                            # Маппинг в твои SQL-поля
+                            final_rows.append((
+                                product.get("inventory_kind"),            # inventory_kind
+                                date_val,                                 # date
+                                int(warehouse_id) if warehouse_id else None,  # warehouse_id
+                                warehouse_code,                            # warehouse_code
+                                product.get("product_code"),              # product_code
+                                None,                                     # product_barcode (в return нет)
+                                product.get("product_unit_id"),           # product_id (лучшее приближение)
+                                product.get("card_code"),                 # card_code
+                                to_date(product.get("expiry_date")),      # expiry_date
+                                product.get("serial_number"),             # serial_number
+                                batch_number_ret,                         # batch_number (из ret)
+                                to_float(product.get("return_quant")),    # quantity
+                                None,                                     # measure_code (в return нет)
+                                to_float(product.get("product_price")),   # input_price
+                                int(filial_id) if filial_id else None,    # filial_id (из конфига)
+                                filial_code_ret,                          # filial_code (из ответа/конфига)
+                                group_name,                               # group_name
+                                category_name,                            # category_name
+                                brand_name                                # brand_name
+                            ))
+                            added_count += 1
+                    tr.rows = added_count
 
                 print(f"✅ {start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | "
                       f"filial={filial_code_cfg} | warehouse={warehouse_code_cfg} | "
                       f"{products_count} items ({added_count} new)")
+                if done is not None:
+                    done.append((scope, start, finish))
+                else:
+                    journal.mark_done(scope, start, finish)
 
             except Exception as e:
                 print(f"⚠️ Ошибка API | filial={filial_code_cfg} | warehouse={warehouse_code_cfg} | "
                       f"{start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | {e}")
+                journal.record_failure(scope, start, finish, e)
+                stats.add(failed_units=1)
 
+    stats.print_summary()
+    if done is None:
+        journal.print_pending()
     return final_rows
 
 
@@ -238,43 +229,43 @@ def load_to_sql(rows):
     conn = connect_sql()
     cur = conn.cursor()
 
+    # тип колонки #TempBalanceData; TEXT — NVARCHAR(n), размер из balancedata_schema или по данным
     desired_cols = {
-        "inventory_kind": f"NVARCHAR(MAX) COLLATE {COLLATION}",
+        "inventory_kind": "TEXT",
         "date": "DATE",
         "warehouse_id": "INT",
-        "warehouse_code": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "product_code": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "product_barcode": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "product_id": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "card_code": f"NVARCHAR(MAX) COLLATE {COLLATION}",
+        "warehouse_code": "TEXT",
+        "product_code": "TEXT",
+        "product_barcode": "TEXT",
+        "product_id": "TEXT",
+        "card_code": "TEXT",
         "expiry_date": "DATE",
-        "serial_number": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "batch_number": f"NVARCHAR(MAX) COLLATE {COLLATION}",
+        "serial_number": "TEXT",
+        "batch_number": "TEXT",
         "quantity": "FLOAT",
-        "measure_code": f"NVARCHAR(MAX) COLLATE {COLLATION}",
+        "measure_code": "TEXT",
         "input_price": "FLOAT",
         "filial_id": "INT",
-        "filial_code": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "group_name": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "category_name": f"NVARCHAR(MAX) COLLATE {COLLATION}",
-        "brand_name": f"NVARCHAR(MAX) COLLATE {COLLATION}",
+        "filial_code": "TEXT",
+        "group_name": "TEXT",
+        "category_name": "TEXT",
+        "brand_name": "TEXT",
     }
 
-    # создать временную таблицу
-    cur.execute("IF OBJECT_ID('tempdb..#TempBalanceData') IS NOT NULL DROP TABLE #TempBalanceData;")
-    columns_sql = ", ".join([f"{c} {t}" for c, t in desired_cols.items()])
-    cur.execute(f"CREATE TABLE #TempBalanceData ({columns_sql});")
+    # ключевые колонки BalanceData ограниченной длины + индекс под MERGE
+    still_max = ensure_balancedata_keys(cur)
+    conn.commit()
 
-    # bulk insert
-    placeholders = ",".join("?" * len(desired_cols))
-    insert_sql = f"INSERT INTO #TempBalanceData VALUES ({placeholders})"
-    cur.executemany(insert_sql, rows)
+    # temp с NVARCHAR(n) + setinputsizes: fast_executemany остаётся на пакетной привязке
+    with span("stage", rows=len(rows)), timed("stage #TempBalanceData"):
+        source = stage_rows(cur, "#TempBalanceData", desired_cols, rows, COLLATION,
+                            bounded_keys=set(KEY_COLUMNS) - still_max)
     print(f"📥 Загружено {len(rows)} строк во временную таблицу")
 
     # MERGE
     merge_sql = f"""
     MERGE {TABLE_NAME} AS target
-    USING #TempBalanceData AS src
+    USING {source} AS src
     ON target.date = src.date
        AND target.product_code = src.product_code
        AND target.warehouse_code = src.warehouse_code
@@ -299,17 +290,21 @@ def load_to_sql(rows):
         INSERT ({", ".join(desired_cols.keys())})
         VALUES ({", ".join([f"src.{c}" for c in desired_cols.keys()])});
     """
-    cur.execute(merge_sql)
+    with span("merge", rows=len(rows)), timed("merge BalanceData"):
+        cur.execute(merge_sql)
     print("🔄 MERGE завершен")
+    drop_staging(cur, "#TempBalanceData")
 
-    conn.commit()
+    with span("commit"):
+        conn.commit()
     cur.close()
-    conn.close()
     print("✅ Данные успешно загружены")
+    print_timings()
+    print_transfer_stats()
 
 
 # ====== MAIN ======
-def main():
+def main(resume: bool = False):
     # загрузка конфигурации filial_warehouse.json
     with open(FILIAL_WAREHOUSE_JSON, "r", encoding="utf-8") as f:
         filial_warehouse_list = json.load(f)
@@ -317,9 +312,14 @@ def main():
     begin_date = BEGIN_DATE_FIXED
     end_date = today_samarkand()
 
-    rows = fetch_balance_chunks(filial_warehouse_list, begin_date, end_date)
+    # окна убираются из журнала только после commit в load_to_sql
+    journal = FailureJournal("api")
+    done = []
+    rows = fetch_balance_chunks(filial_warehouse_list, begin_date, end_date, resume=resume, journal=journal, done=done)
     load_to_sql(rows)
+    journal.mark_many(done)
+    journal.print_pending()
 
 
 if __name__ == "__main__":
-    main()
+    main(resume=resume_requested())
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import json
-import platform
 import sys
 from datetime import datetime, timedelta
 import pyodbc
-import requests
+
+from db import get_connection, print_timings, timed
+from fetch_retry import FailureJournal, RetryStats, post_json, resume_requested
+from http_transport import make_session, print_transfer_stats
+from product_groups import PRODUCT_GROUPS, ensure_product_group_tables
+import quarantine
+from quarantine import BALANCE_GROUP_SCHEMA, balance_fact_schema
+from run_report import span
 
 print(sys.getdefaultencoding())  # utf-8 bo'lishi kerak
 
@@ -26,6 +32,12 @@ FILIAL_WAREHOUSE_JSON = "filial_warehouse.json"
 # --- Yangi sxema: 2 jadval ---
 FACT_TABLE = "dbo.FactBalance"
 GROUP_TABLE = "dbo.BalanceGroup"
+# "product" — guruhlar dbo.ProductGroup ko‘prigida (product_id bo‘yicha, faqat o‘zgarganda yangilanadi),
+# eski shakl — dbo.vBalanceGroup; "balance" — avvalgidek har balance_id uchun BalanceGroup qatori
+GROUP_STORAGE = "product"
+# staging’dan oldin qatorlar #TmpFact/#TmpGroup sxemasiga tekshiriladi, yaroqsizlari — dbo.LoadQuarantine
+# (quarantine.py); shunda fast_executemany xatosi va sekin fallback bo‘lmaydi
+VALIDATE_ROWS = True
 
 # Collation (kiril/lotin uchun)
 COLLATION = "Cyrillic_General_CI_AS"
@@ -46,43 +58,8 @@ def daterange(start_date: datetime, end_date: datetime):
 
 
 
-def _pick_driver():
-    drivers = [d.strip() for d in pyodbc.drivers()]
-    for name in [
-        "ODBC Driver 18 for SQL Server",
-        "ODBC Driver 17 for SQL Server",
-        "SQL Server Native Client 11.0",
-        "SQL Server",
-    ]:
-        if name in drivers:
-            return name, drivers
-    return None, drivers
-
-
 def connect_sql():
-    driver, all_drivers = _pick_driver()
-    if not driver:
-        arch = platform.architecture()[0]
-        raise RuntimeError(
-            f"ODBC drayver topilmadi. Python: {arch}. O'rnatilganlar: {all_drivers}\n"
-            "Iltimos, 'ODBC Driver 17/18 for SQL Server' ni o'rnating."
-        )
-    print(f"➡️  Using ODBC driver: {{{driver}}}")
-
-    conn_str = (
-        f"DRIVER={{{driver}}};"
-        f"SERVER={SQL_SERVER};"
-        f"DATABASE={SQL_DATABASE};"
-        f"Trusted_Connection={SQL_TRUSTED};"
-        "Encrypt=No;"
-        "TrustServerCertificate=Yes;"
-    )
-    conn = pyodbc.connect(conn_str, autocommit=False)
-    # Unicode
-    conn.setdecoding(pyodbc.SQL_CHAR, encoding="utf-8")
-    conn.setdecoding(pyodbc.SQL_WCHAR, encoding="utf-16le")
-    conn.setencoding(encoding="utf-16le")
-    return conn
+    return get_connection(SQL_SERVER, SQL_DATABASE, SQL_TRUSTED)
 
 
 def to_date(val):
@@ -145,28 +122,6 @@ def ensure_tables(cursor):
 IF OBJECT_ID('{FACT_TABLE}', 'U') IS NULL
 BEGIN
     CREATE TABLE {FACT_TABLE} (
-<<<<<<< HEAD
-    balance_id       CHAR(64)      NOT NULL PRIMARY KEY,
-    inventory_kind   VARCHAR(5)    NULL,
-    balance_date     DATE          NULL,
-    warehouse_id     INT           NULL,
-    warehouse_code   NVARCHAR(200) COLLATE {COLLATION} NULL,
-    product_code     NVARCHAR(100) COLLATE {COLLATION} NULL,
-    product_barcode  NVARCHAR(100) COLLATE {COLLATION} NULL,
-    product_id       NVARCHAR(50)  COLLATE {COLLATION} NULL,
-    card_code        NVARCHAR(100) COLLATE {COLLATION} NULL,
-    expiry_date      DATE          NULL,
-    serial_number    NVARCHAR(100) COLLATE {COLLATION} NULL,
-    batch_number     NVARCHAR(100) COLLATE {COLLATION} NULL,
-    quantity         DECIMAL(18,4) NULL,
-    measure_code     NVARCHAR(50)  COLLATE {COLLATION} NULL,
-    input_price      DECIMAL(18,4) NULL,
-    filial_id        INT           NULL,
-    filial_code      NVARCHAR(100) COLLATE {COLLATION} NULL,
-    product_conditions NVARCHAR(10) COLLATE {COLLATION} NULL
-);
-
-=======
         balance_id      CHAR(64)     NOT NULL PRIMARY KEY,
         inventory_kind  VARCHAR(5)   NULL,
         balance_date    DATE         NULL,
@@ -185,7 +140,6 @@ BEGIN
         filial_id       INT           NULL,
         filial_code     NVARCHAR(100) COLLATE {COLLATION} NULL
     );
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
 END
 """)
 
@@ -219,17 +173,25 @@ IF NOT EXISTS (
 )
     CREATE INDEX IX_BalanceGroup_Code ON {GROUP_TABLE}(group_code);
 """)
+
+    if GROUP_STORAGE == "product":
+        ensure_product_group_tables(cursor, FACT_TABLE, GROUP_TABLE, COLLATION)
+    if VALIDATE_ROWS:
+        quarantine.ensure_table(cursor)
 CONDITIONS_JSON = "conditions.json"
 
-def fetch_balance_chunks(filial_warehouse_list, begin_date: datetime, end_date: datetime, allowed_conditions: set):
-    session = requests.Session()
+def fetch_balance_chunks(filial_warehouse_list, begin_date: datetime, end_date: datetime, allowed_conditions: set,
+                         resume: bool = False, journal: FailureJournal = None, done: list = None):
+    """
+    resume=True: faqat .fetch_journal/api_group.json dagi yuklanmagan oynalar.
+    done: berilsa, yuklangan oynalar shu ro‘yxatga — journal’dan commit’dan keyin o‘chiriladi.
+    """
+    session = make_session()
+    journal = journal or FailureJournal("api_group")
+    stats = RetryStats()
     fact_rows, group_rows = [], []
     seen_balance_ids, seen_group_pairs = set(), set()
-<<<<<<< HEAD
-    
-=======
 
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
     seen_balance_ids = set()  # Fact darajasida dublikat bo‘lmasin
     seen_group_pairs = set()  # (balance_id, group_code) darajasi
 
@@ -238,14 +200,13 @@ def fetch_balance_chunks(filial_warehouse_list, begin_date: datetime, end_date:
         filial_code = entry["filial_code"]
         warehouse_id = entry["warehouse_id"]
         warehouse_code = entry["warehouse_code"]
-<<<<<<< HEAD
-        
-
-        for start, finish in daterange(begin_date, end_date):
-=======
+        scope = f"filial={filial_id}|warehouse={warehouse_id}"
+        if resume:
+            windows = [(b.date(), e.date()) for b, e in journal.windows(scope)]
+        else:
+            windows = daterange(begin_date, end_date)
 
-        for start, finish in daterange(begin_date, end_date, step_days=30):
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
+        for start, finish in windows:
             params = {"filial_id": filial_id, } 
             payload = {
                 "warehouse_codes": [{"warehouse_code": warehouse_code}],
@@ -255,86 +216,85 @@ def fetch_balance_chunks(filial_warehouse_list, begin_date: datetime, end_date:
             }
 
             try:
-                resp = session.post(
+                data = post_json(
+                    session,
                     URL,
+                    stats=stats,
                     params=params,
                     auth=(USERNAME, PASSWORD),
                     headers={"Content-Type": "application/json; charset=utf-8"},
                     data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
                     timeout=90,
                 )
-                resp.encoding = "utf-8"
-                resp.raise_for_status()
-                data = resp.json()
                 balance = data.get("balance", [])
 
                 added_f, added_g = 0, 0
-                for item in balance:
-                    # Enrichment
-                    inv_kind = item.get("inventory_kind")
-                    bal_date = to_date(item.get("date"))
-                    prod_code = item.get("product_code")
-                    prod_barcode = item.get("product_barcode")
-                    prod_id = item.get("product_id")
-                    card_code = item.get("card_code")
-                    expiry_date = to_date(item.get("expiry_date"))
-                    serial_num = item.get("serial_number")
-                    batch_num = item.get("batch_number")
-                    qty = to_float(item.get("quantity"))
-                    measure_code = item.get("measure_code")
-                    input_price = to_float(item.get("input_price"))
-<<<<<<< HEAD
-                    product_conditions = inv_kind 
-                    inv_kind = (item.get("inventory_kind") or "").strip().upper()  
-=======
-                    if inv_kind not in allowed_conditions:
-                        continue
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
+                with span("transform") as tr:
+                    for item in balance:
+                        # Enrichment
+                        inv_kind = item.get("inventory_kind")
+                        bal_date = to_date(item.get("date"))
+                        prod_code = item.get("product_code")
+                        prod_barcode = item.get("product_barcode")
+                        prod_id = item.get("product_id")
+                        card_code = item.get("card_code")
+                        expiry_date = to_date(item.get("expiry_date"))
+                        serial_num = item.get("serial_number")
+                        batch_num = item.get("batch_number")
+                        qty = to_float(item.get("quantity"))
+                        measure_code = item.get("measure_code")
+                        input_price = to_float(item.get("input_price"))
+                        if inv_kind not in allowed_conditions:
+                            continue
                 
-                    # Deterministik ID
-                    balance_id = make_balance_id(warehouse_id, prod_id, batch_num, bal_date)
-
-                    # Fact — dublikatni tekshirish
-                    if balance_id not in seen_balance_ids:
-                        fact_rows.append((
-                            balance_id, inv_kind, bal_date, int(warehouse_id) if warehouse_id else None,
-                            warehouse_code, prod_code, prod_barcode, prod_id, card_code, expiry_date,
-                            serial_num, batch_num, qty, measure_code, input_price,
-<<<<<<< HEAD
-                            int(filial_id) if filial_id else None, filial_code,
-                            product_conditions
-=======
-                            int(filial_id) if filial_id else None, filial_code
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
-                        ))
-                        seen_balance_ids.add(balance_id)
-                        added_f += 1
-
-                    # Groups — bo‘sh bo‘lsa ham 1 qator None bilan kiritamiz (ixtiyoriy)
-                    groups = item.get("groups") or [{"group_code": None, "type_code": None}]
-                    for g in groups:
-                        gc = g.get("group_code")
-                        tc = g.get("type_code")
-                        key = (balance_id, gc)
-                        if key not in seen_group_pairs:
-                            group_rows.append((balance_id, gc, tc))
-                            seen_group_pairs.add(key)
-                            added_g += 1
+                        # Deterministik ID
+                        balance_id = make_balance_id(warehouse_id, prod_id, batch_num, bal_date)
+
+                        # Fact — dublikatni tekshirish
+                        if balance_id not in seen_balance_ids:
+                            fact_rows.append((
+                                balance_id, inv_kind, bal_date, int(warehouse_id) if warehouse_id else None,
+                                warehouse_code, prod_code, prod_barcode, prod_id, card_code, expiry_date,
+                                serial_num, batch_num, qty, measure_code, input_price,
+                                int(filial_id) if filial_id else None, filial_code
+                            ))
+                            seen_balance_ids.add(balance_id)
+                            added_f += 1
+
+                        # Groups — bo‘sh bo‘lsa ham 1 qator None bilan kiritamiz (ixtiyoriy)
+                        groups = item.get("groups") or [{"group_code": None, "type_code": None}]
+                        for g in groups:
+                            gc = g.get("group_code")
+                            tc = g.get("type_code")
+                            key = (balance_id, gc)
+                            if key not in seen_group_pairs:
+                                group_rows.append((balance_id, gc, tc))
+                                seen_group_pairs.add(key)
+                                added_g += 1
+                    tr.rows = added_f + added_g
 
                 print(f"📅 Oyma-oy: {start.strftime(DATE_FORMAT)} → {finish.strftime(DATE_FORMAT)} | "
       f"filial={filial_code}, warehouse={warehouse_code} | "
       f"{len(balance)} items → +Fact:{added_f}, +Group:{added_g}")
-
+                if done is not None:
+                    done.append((scope, start, finish))
+                else:
+                    journal.mark_done(scope, start, finish)
 
             except Exception as e:
                 print(f"⚠️ API xatosi | filial={filial_code} | warehouse={warehouse_code} | "
                       f"{start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | {e}")
+                journal.record_failure(scope, start, finish, e)
+                stats.add(failed_units=1)
 
+    stats.print_summary()
+    if done is None:
+        journal.print_pending()
     return fact_rows, group_rows
 
 
 # ====== MAIN ======
-def main():
+def main(resume: bool = False):
     # 1) JSON ni UTF-8 da o‘qiymiz
     with open(FILIAL_WAREHOUSE_JSON, "r", encoding="utf-8") as f:
         filial_warehouse_list = json.load(f)
@@ -357,16 +317,27 @@ def main():
     conn.commit()
 
     # 3) API dan ma’lumotlarni yig‘amiz (fact/group alohida)
-    fact_rows, group_rows = fetch_balance_chunks(filial_warehouse_list, begin_date, end_date, allowed_conditions)
+    # oynalar journal’dan faqat commit’dan keyin o‘chiriladi (MERGE yiqilsa --resume ularni qayta oladi)
+    journal = FailureJournal("api_group")
+    done = []
+    fact_rows, group_rows = fetch_balance_chunks(filial_warehouse_list, begin_date, end_date, allowed_conditions,
+                                                 resume=resume, journal=journal, done=done)
     if not fact_rows:
         print("ℹ️ Fact bo‘yicha yangi yozuvlar topilmadi.")
     if not group_rows:
         print("ℹ️ Group bo‘yicha yangi yozuvlar topilmadi.")
     if not fact_rows and not group_rows:
-        cursor.close();
-        conn.close()
+        journal.mark_many(done)
+        journal.print_pending()
+        cursor.close()
         return
 
+    # 3a) Qator tekshiruvi: #TmpFact (inventory_kind VARCHAR(5)) / #TmpGroup sxemasiga mos kelmaganlar — karantinga
+    if VALIDATE_ROWS:
+        fact_rows, (group_rows,) = quarantine.screen(cursor, "api_group",
+                                                     ("#TmpFact", fact_rows, balance_fact_schema(5)),
+                                                     [("#TmpGroup", group_rows, BALANCE_GROUP_SCHEMA)])
+
     # 4) Temp jadvallar (Unicode/collation bilan)
     cursor.execute(f"""
 IF OBJECT_ID('tempdb..#TmpFact') IS NOT NULL DROP TABLE #TmpFact;
@@ -387,12 +358,7 @@ CREATE TABLE #TmpFact (
     measure_code    NVARCHAR(50)  COLLATE {COLLATION} NULL,
     input_price     DECIMAL(18,4) NULL,
     filial_id       INT           NULL,
-<<<<<<< HEAD
-    filial_code     NVARCHAR(100) COLLATE {COLLATION} NULL,
-    product_conditions NVARCHAR(10) COLLATE {COLLATION} NULL
-=======
     filial_code     NVARCHAR(100) COLLATE {COLLATION} NULL
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
 );
 IF OBJECT_ID('tempdb..#TmpGroup') IS NOT NULL DROP TABLE #TmpGroup;
 CREATE TABLE #TmpGroup (
@@ -402,39 +368,36 @@ CREATE TABLE #TmpGroup (
 );
 """)
 
-    # 5) Bulk insert (Unicode safe) — muammo bo'lsa fallback
-    try:
-        cursor.fast_executemany = True
-        if fact_rows:
-            cursor.executemany("""
-<<<<<<< HEAD
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-=======
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
-            """, fact_rows)
-        if group_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpGroup VALUES (?,?,?)
-            """, group_rows)
-    except pyodbc.Error as e:
-        print(f"⚠️ fast_executemany muammo: {e}. Fallback bilan davom etamiz.")
-        cursor.fast_executemany = False
-        if fact_rows:
-            cursor.executemany("""
-<<<<<<< HEAD
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-=======
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
-            """, fact_rows)
-        if group_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpGroup VALUES (?,?,?)
-            """, group_rows)
+    # "product" rejimida guruhlar #TmpGroup ga tushmaydi — 8-qadamdan oldin ko‘prikka
+    staged_groups = group_rows if GROUP_STORAGE == "balance" else []
+
+    # 5) Bulk insert (Unicode safe) — muammo bo'lsa fallback (VALIDATE_ROWS da faqat kutilmagan holatda)
+    with span("stage", rows=len(fact_rows) + len(staged_groups)), timed("stage temp tables"):
+        try:
+            cursor.fast_executemany = True
+            if fact_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """, fact_rows)
+            if staged_groups:
+                cursor.executemany("""
+                    INSERT INTO #TmpGroup VALUES (?,?,?)
+                """, staged_groups)
+        except pyodbc.Error as e:
+            print(f"⚠️ fast_executemany muammo: {e}. Fallback bilan davom etamiz.")
+            cursor.fast_executemany = False
+            if fact_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """, fact_rows)
+            if staged_groups:
+                cursor.executemany("""
+                    INSERT INTO #TmpGroup VALUES (?,?,?)
+                """, staged_groups)
 
     # 6) MERGE: Fact upsert (PRIMARY KEY = balance_id)
-    cursor.execute(f"""
+    with span("merge", rows=len(fact_rows)), timed(f"merge {FACT_TABLE}"):
+        cursor.execute(f"""
 MERGE {FACT_TABLE} AS T
 USING (
     SELECT DISTINCT *
@@ -442,34 +405,6 @@ USING (
 ) AS S
 ON (T.balance_id = S.balance_id)
 WHEN MATCHED THEN UPDATE SET
-<<<<<<< HEAD
-    inventory_kind    = S.inventory_kind,
-    balance_date      = S.balance_date,
-    warehouse_id      = S.warehouse_id,
-    warehouse_code    = S.warehouse_code,
-    product_code      = S.product_code,
-    product_barcode   = S.product_barcode,
-    product_id        = S.product_id,
-    card_code         = S.card_code,
-    expiry_date       = S.expiry_date,
-    serial_number     = S.serial_number,
-    batch_number      = S.batch_number,
-    quantity          = S.quantity,
-    measure_code      = S.measure_code,
-    input_price       = S.input_price,
-    filial_id         = S.filial_id,
-    filial_code       = S.filial_code,
-    product_conditions = S.product_conditions
-WHEN NOT MATCHED THEN
-    INSERT (balance_id, inventory_kind, balance_date, warehouse_id, warehouse_code,
-        product_code, product_barcode, product_id, card_code, expiry_date,
-        serial_number, batch_number, quantity, measure_code, input_price,
-        filial_id, filial_code, product_conditions)
-    VALUES (S.balance_id, S.inventory_kind, S.balance_date, S.warehouse_id, S.warehouse_code,
-        S.product_code, S.product_barcode, S.product_id, S.card_code, S.expiry_date,
-        S.serial_number, S.batch_number, S.quantity, S.measure_code, S.input_price,
-        S.filial_id, S.filial_code, S.product_conditions);
-=======
     inventory_kind  = S.inventory_kind,
     balance_date    = S.balance_date,
     warehouse_id    = S.warehouse_id,
@@ -495,11 +430,12 @@ WHEN NOT MATCHED THEN
             S.product_code, S.product_barcode, S.product_id, S.card_code, S.expiry_date,
             S.serial_number, S.batch_number, S.quantity, S.measure_code, S.input_price,
             S.filial_id, S.filial_code);
->>>>>>> ecf2bb909876df5c5d1018c65d0b3098ceb3a4cb
 """)
 
     # 7) MERGE: Group upsert (PRIMARY KEY = balance_id + group_code)
-    cursor.execute(f"""
+    if staged_groups:
+        with span("merge", rows=len(group_rows)), timed(f"merge {GROUP_TABLE}"):
+            cursor.execute(f"""
 MERGE {GROUP_TABLE} AS T
 USING (
     -- null group_code lar bo‘lishi mumkin; PK uchun NULL yo‘q, shu sabab null bo‘lsa ham bitta 'NULL' sifatida saqlamoqchi bo‘lsak ISNULL ishlatamiz.
@@ -516,14 +452,21 @@ WHEN NOT MATCHED THEN
     VALUES (S.balance_id, S.group_code, S.type_code);
 """)
 
+    if GROUP_STORAGE == "product":
+        PRODUCT_GROUPS.refresh(cursor, fact_rows, group_rows)
+
     # 8) Tozalash va commit
     cursor.execute("DROP TABLE #TmpFact; DROP TABLE #TmpGroup;")
-    conn.commit()
+    with span("commit"):
+        conn.commit()
+    journal.mark_many(done)
+    journal.print_pending()
     cursor.close()
-    conn.close()
 
+    print_timings()
+    print_transfer_stats()
     print(f"💾 Yuklash yakunlandi | Fact yozuvlar: {len(fact_rows)} | Group yozuvlar: {len(group_rows)}")
 
 
 if __name__ == "__main__":
-    main()
+    main(resume=resume_requested())
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Остатки для Power BI: columnstore на факте и агрегаты, которые пересчитываются
+только по тому, что затронула загрузка.
+
+    dbo.AggStockDaily     (balance_date, warehouse_id, group_code, product_condition)
+                          -> quantity, amount (quantity * input_price), products, rows_count
+    dbo.AggLatestBalance  (warehouse_id, product_id) -> последняя balance_date и остаток на неё
+
+После каждой загрузки balance_data: затронутые (balance_date, warehouse_id) и
+(warehouse_id, product_id) удаляются из агрегатов и собираются заново из
+факта — дашборды читают готовые строки вместо скана всего FactBalance.
+
+Товар в нескольких группах входит в AggStockDaily по каждой из них (как при
+JOIN с BalanceGroup); товар без групп — группа '__NULL__'.
+
+ensure_columnstore(): "clustered" — PK факта становится некластерным (FK на
+него пересоздаются), таблица — clustered columnstore; "nonclustered" —
+NCCI поверх rowstore (MERGE по balance_id не меняется).
+"""
+from db import timed
+from run_report import span
+
+COLLATION = "Cyrillic_General_CI_AS"  # как в dbo.FactBalance
+
+AGG_DAILY_TABLE = "dbo.AggStockDaily"
+AGG_LATEST_TABLE = "dbo.AggLatestBalance"
+COLUMNSTORE_MODES = ("clustered", "nonclustered")
+
+# колонки факта для NCCI (всё, что агрегируют отчёты)
+NCCI_COLUMNS = ["balance_date", "warehouse_id", "product_id", "batch_number", "inventory_kind",
+                "quantity", "input_price", "measure_code", "filial_id"]
+
+
+# ====== COLUMNSTORE ======
+def _foreign_keys(cursor, table):
+    """FK других таблиц на table: (имя, таблица, колонка, колонка в table). Все FK здесь одноколоночные."""
+    cursor.execute("""
+SELECT fk.name,
+       QUOTENAME(OBJECT_SCHEMA_NAME(fk.parent_object_id)) + '.' + QUOTENAME(OBJECT_NAME(fk.parent_object_id)),
+       COL_NAME(fkc.parent_object_id, fkc.parent_column_id),
+       COL_NAME(fkc.referenced_object_id, fkc.referenced_column_id)
+FROM sys.foreign_keys AS fk
+JOIN sys.foreign_key_columns AS fkc ON fkc.constraint_object_id = fk.object_id
+WHERE fk.referenced_object_id = OBJECT_ID(?)
+""", table)
+    return cursor.fetchall()
+
+
+def ensure_columnstore(cursor, table: str, mode: str):
+    """mode: "clustered" | "nonclustered". Повторный запуск ничего не меняет."""
+    if mode not in COLUMNSTORE_MODES:
+        print(f"⚠️ COLUMNSTORE={mode!r}: ожидается одно из {COLUMNSTORE_MODES}")
+        return
+    short = table.split(".")[-1]
+    cursor.execute("SELECT type_desc, name FROM sys.indexes WHERE object_id = OBJECT_ID(?) AND type IN (1, 5, 6)",
+                   table)
+    have = {row[0]: row[1] for row in cursor.fetchall()}
+
+    if mode == "nonclustered":
+        if "NONCLUSTERED COLUMNSTORE" in have or "CLUSTERED COLUMNSTORE" in have:
+            return
+        with timed(f"columnstore {table}"):
+            cursor.execute(f"CREATE NONCLUSTERED COLUMNSTORE INDEX NCCI_{short} ON {table} "
+                           f"({', '.join(NCCI_COLUMNS)});")
+        print(f"🔧 {table}: nonclustered columnstore")
+        return
+
+    if "CLUSTERED COLUMNSTORE" in have:
+        return
+    with timed(f"columnstore {table}"):
+        if "NONCLUSTERED COLUMNSTORE" in have:
+            cursor.execute(f"DROP INDEX {have['NONCLUSTERED COLUMNSTORE']} ON {table};")
+        if "CLUSTERED" in have:
+            # кластерный PK (balance_id) -> некластерный; FK дочерних таблиц мешают DROP CONSTRAINT
+            fks = _foreign_keys(cursor, table)
+            for name, child, _, _ in fks:
+                cursor.execute(f"ALTER TABLE {child} DROP CONSTRAINT {name};")
+            cursor.execute("SELECT name FROM sys.key_constraints WHERE parent_object_id = OBJECT_ID(?) AND type = 'PK'",
+                           table)
+            pk = cursor.fetchone()
+            if pk is not None:
+                cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {pk[0]};")
+            else:
+                cursor.execute(f"DROP INDEX {have['CLUSTERED']} ON {table};")
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT PK_{short} PRIMARY KEY NONCLUSTERED (balance_id);")
+            cursor.execute(f"CREATE CLUSTERED COLUMNSTORE INDEX CCI_{short} ON {table};")
+            for name, child, col, ref_col in fks:
+                cursor.execute(f"ALTER TABLE {child} ADD CONSTRAINT {name} FOREIGN KEY ({col}) "
+                               f"REFERENCES {table}({ref_col});")
+        else:
+            cursor.execute(f"CREATE CLUSTERED COLUMNSTORE INDEX CCI_{short} ON {table};")
+    print(f"🔧 {table}: clustered columnstore (PK balance_id — nonclustered)")
+
+
+# ====== AGGREGATES ======
+def ensure_aggregate_tables(cursor, collation: str = COLLATION):
+    cursor.execute(f"""
+IF OBJECT_ID('{AGG_DAILY_TABLE}', 'U') IS NULL
+    CREATE TABLE {AGG_DAILY_TABLE} (
+        balance_date      DATE          NOT NULL,
+        warehouse_id      INT           NOT NULL,
+        group_code        NVARCHAR(100) COLLATE {collation} NOT NULL,
+        product_condition NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        quantity          DECIMAL(38,4) NULL,
+        amount            DECIMAL(38,4) NULL,
+        products          INT           NOT NULL,
+        rows_count        INT           NOT NULL,
+        updated_utc       DATETIME2(0)  NOT NULL DEFAULT SYSUTCDATETIME(),
+        CONSTRAINT PK_AggStockDaily PRIMARY KEY (balance_date, warehouse_id, group_code, product_condition)
+    );
+IF OBJECT_ID('{AGG_LATEST_TABLE}', 'U') IS NULL
+    CREATE TABLE {AGG_LATEST_TABLE} (
+        warehouse_id INT           NOT NULL,
+        product_id   NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        balance_date DATE          NOT NULL,
+        quantity     DECIMAL(38,4) NULL,
+        amount       DECIMAL(38,4) NULL,
+        batches      INT           NOT NULL,
+        updated_utc  DATETIME2(0)  NOT NULL DEFAULT SYSUTCDATETIME(),
+        CONSTRAINT PK_AggLatestBalance PRIMARY KEY (warehouse_id, product_id)
+    );
+""")
+
+
+def ensure_fact_date_index(cursor, fact_table: str):
+    """Для пересборки AggStockDaily по (дата, склад) на rowstore-факте (columnstore в нём не нуждается)."""
+    short = fact_table.split(".")[-1]
+    cursor.execute(f"""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID('{fact_table}') AND type IN (5, 6))
+   AND NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_{short}_DateWarehouse'
+                   AND object_id = OBJECT_ID('{fact_table}'))
+    CREATE INDEX IX_{short}_DateWarehouse ON {fact_table}(balance_date, warehouse_id)
+        INCLUDE (product_id, quantity, input_price);
+""")
+
+
+class AggSource:
+    """Откуда собирать агрегаты: факт, состояния и как к строке факта присоединяются группы."""
+
+    def __init__(self, fact_table: str, condition_table: str, group_join: str, dated_conditions: bool = False):
+        self.fact_table = fact_table
+        self.condition_table = condition_table
+        self.group_join = group_join  # LEFT JOIN ... AS g ON ... f.
+        self.dated_conditions = dated_conditions  # у таблицы состояний есть balance_date (секционирование)
+
+
+def touched_keys(fact_rows):
+    """(balance_date, warehouse_id) и (warehouse_id, product_id) из строк collect_rows."""
+    days, products = set(), set()
+    for r in fact_rows:
+        d, wh, pid = r[2], r[3], r[7]
+        if wh is None:
+            continue
+        if d is not None:
+            days.add((d, wh))
+        if pid is not None:
+            products.add((wh, pid))
+    return sorted(days), sorted(products)
+
+
+def refresh_aggregates(cursor, fact_rows, source: AggSource):
+    """Пересобирает агрегаты по затронутым ключам. Commit — за вызывающим."""
+    days, products = touched_keys(fact_rows)
+    if not days and not products:
+        return
+    cursor.execute(f"""
+IF OBJECT_ID('tempdb..#AggDays') IS NOT NULL DROP TABLE #AggDays;
+CREATE TABLE #AggDays (balance_date DATE NOT NULL, warehouse_id INT NOT NULL, PRIMARY KEY (balance_date, warehouse_id));
+IF OBJECT_ID('tempdb..#AggProducts') IS NOT NULL DROP TABLE #AggProducts;
+SELECT TOP 0 warehouse_id, product_id INTO #AggProducts FROM {AGG_LATEST_TABLE};
+""")
+    with span("stage", rows=len(days) + len(products)), timed("stage aggregate keys"):
+        cursor.fast_executemany = True
+        if days:
+            cursor.executemany("INSERT INTO #AggDays VALUES (?,?)", days)
+        if products:
+            cursor.executemany("INSERT INTO #AggProducts VALUES (?,?)", products)
+
+    cond_on = "c.balance_id = f.balance_id" + (" AND c.balance_date = f.balance_date"
+                                                if source.dated_conditions else "")
+    with span("merge", rows=len(days)), timed(f"refresh {AGG_DAILY_TABLE}"):
+        cursor.execute(f"""
+DELETE a
+FROM {AGG_DAILY_TABLE} AS a
+JOIN #AggDays AS d ON d.balance_date = a.balance_date AND d.warehouse_id = a.warehouse_id;
+
+INSERT INTO {AGG_DAILY_TABLE} (balance_date, warehouse_id, group_code, product_condition,
+                               quantity, amount, products, rows_count)
+SELECT f.balance_date, f.warehouse_id,
+       ISNULL(g.group_code, N'__NULL__'), ISNULL(c.product_condition, N''),
+       SUM(CAST(f.quantity AS DECIMAL(38,4))), SUM(f.quantity * f.input_price),
+       COUNT(DISTINCT f.product_id), COUNT(*)
+FROM #AggDays AS d
+JOIN {source.fact_table} AS f ON f.balance_date = d.balance_date AND f.warehouse_id = d.warehouse_id
+{source.group_join}
+LEFT JOIN {source.condition_table} AS c ON {cond_on}
+GROUP BY f.balance_date, f.warehouse_id, ISNULL(g.group_code, N'__NULL__'), ISNULL(c.product_condition, N'');
+""")
+    with span("merge", rows=len(products)), timed(f"refresh {AGG_LATEST_TABLE}"):
+        cursor.execute(f"""
+DELETE a
+FROM {AGG_LATEST_TABLE} AS a
+JOIN #AggProducts AS p ON p.warehouse_id = a.warehouse_id AND p.product_id = a.product_id;
+
+INSERT INTO {AGG_LATEST_TABLE} (warehouse_id, product_id, balance_date, quantity, amount, batches)
+SELECT x.warehouse_id, x.product_id, x.balance_date,
+       SUM(CAST(x.quantity AS DECIMAL(38,4))), SUM(x.quantity * x.input_price), COUNT(*)
+FROM (
+    SELECT f.warehouse_id, f.product_id, f.balance_date, f.quantity, f.input_price,
+           DENSE_RANK() OVER (PARTITION BY f.warehouse_id, f.product_id ORDER BY f.balance_date DESC) AS rn
+    FROM #AggProducts AS p
+    JOIN {source.fact_table} AS f ON f.product_id = p.product_id AND f.warehouse_id = p.warehouse_id
+    WHERE f.balance_date IS NOT NULL
+) AS x
+WHERE x.rn = 1
+GROUP BY x.warehouse_id, x.product_id, x.balance_date;
+
+DROP TABLE #AggDays; DROP TABLE #AggProducts;
+""")
+    print(f"📊 Агрегаты пересобраны: {len(days)} дней×складов, {len(products)} складов×товаров")
@@ -1,14 +1,26 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import json
-import platform
 import re
 import sys
 from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
 
 import pyodbc
-import requests
+
+from balance_aggregates import (AggSource, ensure_aggregate_tables, ensure_columnstore, ensure_fact_date_index,
+                                refresh_aggregates)
+from balance_dims import DIM_CACHE, ensure_keyed_tables, load_keyed
+from balance_intervals import collapse, ensure_interval_tables, load_intervals
+from balance_partitions import MONTHLY_CONDITION_TABLE, MONTHLY_FACT_TABLE, ensure_monthly_tables, load_monthly
+from db import get_connection, print_timings, timed
+from fetch_retry import FailureJournal, RetryStats, post_json, resume_requested
+from http_transport import make_session, print_transfer_stats
+from product_groups import PRODUCT_GROUP_TABLE, PRODUCT_GROUPS, ensure_product_group_tables
+import quarantine
+from quarantine import BALANCE_CONDITION_SCHEMA, BALANCE_GROUP_SCHEMA, balance_fact_schema
+from run_report import span
+from work_queue import LeaseLost, WorkQueue
 
 print(sys.getdefaultencoding())
 
@@ -32,10 +44,33 @@ FACT_TABLE = "dbo.FactBalance"
 GROUP_TABLE = "dbo.BalanceGroup"
 CONDITION_TABLE = "dbo.BalanceCondition"
 COLLATION = "Cyrillic_General_CI_AS"
+# "daily" — FactBalance (har kun alohida qator); "interval" — FactBalanceInterval (SCD2,
+# o‘zgarmagan kunlar bitta [valid_from, valid_to] qatorga yig‘iladi; balance_intervals.py);
+# "keyed" — FactBalanceKeyed (kodlar o‘rniga DimWarehouse/DimProduct/DimMeasure/DimGroup INT kalitlari; balance_dims.py);
+# "monthly" — FactBalanceMonthly (balance_date bo‘yicha oylik bo‘limlar, oy staging’da yig‘ilib SWITCH qilinadi;
+# guruhlar — faqat ProductGroup ko‘prigi; balance_partitions.py)
+FACT_STORAGE = "daily"
+# "monthly" rejimida har oy alohida commit (backfill bitta ulkan tranzaksiyada emas)
+PARTITION_COMMITS = True
+# Power BI uchun: None | "clustered" | "nonclustered" columnstore FactBalance da (faqat "daily")
+COLUMNSTORE = None
+# AggStockDaily / AggLatestBalance — har yuklamada faqat tegilgan kun×ombor va ombor×mahsulot qayta yig‘iladi
+# ("daily" va "monthly"; balance_aggregates.py)
+AGGREGATES = True
+# "product" — guruhlar mahsulot atributi: dbo.ProductGroup (product_id -> group_code), faqat guruh to‘plami
+# o‘zgarganda yangilanadi; eski shakl — dbo.vBalanceGroup (product_groups.py). "balance" — avvalgidek
+# har balance_id uchun BalanceGroup qatori. Faqat FACT_STORAGE = "daily" uchun.
+GROUP_STORAGE = "product"
+# staging’dan oldin har qator #TmpFact/#TmpGroup/#TmpCond sxemasiga tekshiriladi (uzunlik, DECIMAL(18,4),
+# sana); yaroqsizlari dbo.LoadQuarantine ga — paket doim fast_executemany yo‘lidan boradi (quarantine.py)
+VALIDATE_ROWS = True
 
 # ====== INCREMENTAL SETTINGS ======
 INCREMENTAL_BUFFER_DAYS = 3
 
+# ====== NAVBAT (--queue) ======
+QUEUE_NAME = "balance"
+
 # ====== UTIL ======
 _WS_CHARS = "\u00A0\u202F\u2007"  # NBSP, thin space, figure space
 _WS_TABLE = str.maketrans({c: " " for c in _WS_CHARS})
@@ -54,43 +89,8 @@ def daterange(start_date: datetime, end_date: datetime, step_days: int = 30):
         current = next_date + timedelta(days=1)
 
 
-def _pick_driver():
-    drivers = [d.strip() for d in pyodbc.drivers()]
-    for name in [
-        "ODBC Driver 18 for SQL Server",
-        "ODBC Driver 17 for SQL Server",
-        "SQL Server Native Client 11.0",
-        "SQL Server",
-    ]:
-        if name in drivers:
-            return name, drivers
-    return None, drivers
-
-
 def connect_sql():
-    driver, all_drivers = _pick_driver()
-    if not driver:
-        arch = platform.architecture()[0]
-        raise RuntimeError(
-            f"ODBC drayver topilmadi. Python: {arch}. O'rnatilganlar: {all_drivers}\n"
-            "Iltimos, 'ODBC Driver 17/18 for SQL Server' ni o'rnating."
-        )
-    print(f"➡️  Using ODBC driver: {{{driver}}}")
-
-    conn_str = (
-        f"DRIVER={{{driver}}};"
-        f"SERVER={SQL_SERVER};"
-        f"DATABASE={SQL_DATABASE};"
-        f"Trusted_Connection={SQL_TRUSTED};"
-        "Encrypt=No;"
-        "TrustServerCertificate=Yes;"
-    )
-    conn = pyodbc.connect(conn_str, autocommit=False)
-    # Unicode
-    conn.setdecoding(pyodbc.SQL_CHAR, encoding="utf-8")
-    conn.setdecoding(pyodbc.SQL_WCHAR, encoding="utf-16le")
-    conn.setencoding(encoding="utf-16le")
-    return conn
+    return get_connection(SQL_SERVER, SQL_DATABASE, SQL_TRUSTED)
 
 
 def _clean_str(s: str) -> str:
@@ -373,6 +373,28 @@ IF NOT EXISTS (
     CREATE INDEX IX_BalanceCondition_Cond ON {CONDITION_TABLE}(product_condition);
 """)
 
+    if VALIDATE_ROWS:
+        quarantine.ensure_table(cursor)
+    if FACT_STORAGE == "daily" and GROUP_STORAGE == "product":
+        ensure_product_group_tables(cursor, FACT_TABLE, GROUP_TABLE, COLLATION)
+    if FACT_STORAGE == "monthly":
+        ensure_monthly_tables(cursor, datetime.strptime(BEGIN_DATE_STR, DATE_FORMAT), COLLATION)
+        ensure_product_group_tables(cursor, MONTHLY_FACT_TABLE, GROUP_TABLE, COLLATION)
+    if COLUMNSTORE:
+        if FACT_STORAGE == "daily":
+            ensure_columnstore(cursor, FACT_TABLE, COLUMNSTORE)
+        else:
+            print(f"⚠️ COLUMNSTORE faqat FACT_STORAGE = 'daily' uchun, hozir: {FACT_STORAGE}")
+    if AGGREGATES and FACT_STORAGE in ("daily", "monthly"):
+        ensure_aggregate_tables(cursor, COLLATION)
+        if FACT_STORAGE == "daily":
+            # oylik jadvalda PK balance_date bilan boshlanadi; qo‘shimcha indeks SWITCH ni buzadi
+            ensure_fact_date_index(cursor, FACT_TABLE)
+    if FACT_STORAGE == "interval":
+        ensure_interval_tables(cursor, COLLATION)
+    elif FACT_STORAGE == "keyed":
+        ensure_keyed_tables(cursor, COLLATION)
+
 
 def ensure_loadstate_table(cursor):
     cursor.execute("""
@@ -418,34 +440,138 @@ def upsert_scope_state(cursor, scope_key: str, last_balance_date, rowcount: int)
 
 
 # ====== API → ROWS (INCREMENTAL, with product_condition) ======
+def fetch_window(session, stats: RetryStats, entry: dict, cond: str, start, finish) -> list:
+    """Bitta (filial, ombor, cond, oyna) uchun balance$export; xatoda exception."""
+    params = {"filial_id": entry.get("filial_id")}
+    payload = {
+        "warehouse_codes": [{"warehouse_code": entry.get("warehouse_code")}],
+        "filial_code": entry.get("filial_code"),
+        "begin_date": start.strftime(DATE_FORMAT),
+        "end_date": finish.strftime(DATE_FORMAT),
+        # API specific: include product_conditions filter if supported by API
+        "product_conditions": [cond]
+    }
+    data = post_json(
+        session,
+        URL,
+        stats=stats,
+        params=params,
+        auth=(USERNAME, PASSWORD),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        timeout=120,
+    )
+    return data.get("balance", [])
+
+
+def collect_rows(balance: list, entry: dict, cond: str, out, seen):
+    """
+    balance elementlarini out = (fact_rows, group_rows, condition_rows) ga qo‘shadi.
+    seen = (balance_id, (balance_id, group), (balance_id, cond)) to‘plamlari — takrorlar o‘tkaziladi.
+    Qaytadi: added_f, added_g, added_c, eng katta balance_date
+    """
+    fact_rows, group_rows, condition_rows = out
+    seen_balance_ids, seen_group_pairs, seen_cond_pairs = seen
+    filial_id = entry.get("filial_id")
+    filial_code = entry.get("filial_code")
+    warehouse_id = entry.get("warehouse_id")
+    warehouse_code = entry.get("warehouse_code")
+
+    added_f, added_g, added_c = 0, 0, 0
+    max_balance_date = None
+    with span("transform") as tr:
+        for item in balance:
+            inv_kind = item.get("inventory_kind")
+            bal_date = to_date(item.get("date"))
+            prod_code = item.get("product_code")
+            prod_barcode = item.get("product_barcode")
+            prod_id = item.get("product_id")
+            card_code = item.get("card_code")
+            expiry_date = to_date(item.get("expiry_date"))
+            serial_num = item.get("serial_number")
+            batch_num = item.get("batch_number")
+            qty = to_float(item.get("quantity"))
+            measure_code = item.get("measure_code")
+            input_price = to_float(item.get("input_price"))
+
+            balance_id = make_balance_id(warehouse_id, prod_id, batch_num, bal_date)
+
+            # Fact rows (only once per balance_id)
+            if balance_id not in seen_balance_ids:
+                fact_rows.append((
+                    balance_id, inv_kind, bal_date,
+                    safe_int(warehouse_id),
+                    warehouse_code, prod_code, prod_barcode, prod_id, card_code, expiry_date,
+                    serial_num, batch_num,
+                    qty, measure_code, input_price,
+                    safe_int(filial_id), filial_code
+                ))
+                seen_balance_ids.add(balance_id)
+                added_f += 1
+                if bal_date and (max_balance_date is None or bal_date > max_balance_date):
+                    max_balance_date = bal_date
+
+            # Groups (may be multiple)
+            groups = item.get("groups") or [{"group_code": None, "type_code": None}]
+            for g in groups:
+                gc = g.get("group_code")
+                tc = g.get("type_code")
+                key = (balance_id, gc)
+                if key not in seen_group_pairs:
+                    group_rows.append((balance_id, gc, tc))
+                    seen_group_pairs.add(key)
+                    added_g += 1
+
+            # Condition mapping (balance_id, cond)
+            cond_key = (balance_id, cond)
+            if cond_key not in seen_cond_pairs:
+                condition_rows.append((balance_id, cond))
+                seen_cond_pairs.add(cond_key)
+                added_c += 1
+        tr.rows = added_f + added_g + added_c
+    return added_f, added_g, added_c, max_balance_date
+
+
 def fetch_balance_chunks(cursor, filial_warehouse_list, product_conditions, user_begin_date: datetime,
-                         user_end_date: datetime):
+                         user_end_date: datetime, session=None, journal: FailureJournal = None,
+                         stats: RetryStats = None, resume: bool = False, done: list = None,
+                         states: list = None):
     """
     Har bir (filial_id, warehouse_id, condition) scope bo‘yicha LoadState’ni o‘qiydi:
       effective_begin = max(user_begin_date, (state_date - buffer))
       effective_end   = user_end_date
+    resume=True: faqat journal’dagi muvaffaqiyatsiz (scope, oyna) lar qayta yuklanadi.
+    done: berilsa, yuklab olingan oynalar (scope, start, finish) shu ro‘yxatga yoziladi —
+    journal.mark_many ni chaqiruvchi commit’dan keyin qiladi.
+    states: berilsa, LoadState darhol yozilmaydi — (scope, sana, qatorlar) shu ro‘yxatga tushadi va
+    chaqiruvchi ularni store_rows dan keyin yozadi (oylik rejimda oy commit’lari LoadState’ni oldinroq
+    commit qilib yubormasin).
     Qaytadi: fact_rows, group_rows, condition_rows
     """
-    session = requests.Session()
+    session = session or make_session()
+    journal = journal or FailureJournal("balance_data")
+    stats = stats or RetryStats()
     fact_rows = []  # tuples like in original code
     group_rows = []
     condition_rows = []  # (balance_id, product_condition)
-
-    seen_balance_ids = set()
-    seen_group_pairs = set()
-    seen_cond_pairs = set()
+    out = (fact_rows, group_rows, condition_rows)
+    seen = (set(), set(), set())
 
     total_items = 0
 
     for entry in filial_warehouse_list:
         filial_id = entry.get("filial_id")
-        filial_code = entry.get("filial_code")
         warehouse_id = entry.get("warehouse_id")
-        warehouse_code = entry.get("warehouse_code")
 
         for cond in product_conditions:
             # cond can be "T" or "B" or "F"
             scope_key = make_scope_key(filial_id, warehouse_id, cond)
+            if resume:
+                windows = journal.windows(scope_key)
+                if not windows:
+                    continue
+            else:
+                windows = None
             state_last = get_scope_state(cursor, scope_key)  # DATE or None
 
             effective_begin = user_begin_date
@@ -455,88 +581,24 @@ def fetch_balance_chunks(cursor, filial_warehouse_list, product_conditions, user
                     effective_begin = eff
 
             effective_end = user_end_date
-            if effective_begin > effective_end:
+            if windows is None and effective_begin > effective_end:
                 print(f"↪️  Skip scope {scope_key}: effective_begin>{effective_end}")
                 continue
 
             scope_max_balance_date = None
             scope_added_f, scope_added_g, scope_added_c = 0, 0, 0
 
-            for start, finish in daterange(effective_begin, effective_end, step_days=30):
-                params = {"filial_id": filial_id}
-                payload = {
-                    "warehouse_codes": [{"warehouse_code": warehouse_code}],
-                    "filial_code": filial_code,
-                    "begin_date": start.strftime(DATE_FORMAT),
-                    "end_date": finish.strftime(DATE_FORMAT),
-                    # API specific: include product_conditions filter if supported by API
-                    "product_conditions": [cond]
-                }
+            if windows is None:
+                windows = daterange(effective_begin, effective_end, step_days=30)
 
+            for start, finish in windows:
                 try:
-                    resp = session.post(
-                        URL,
-                        params=params,
-                        auth=(USERNAME, PASSWORD),
-                        headers={"Content-Type": "application/json; charset=utf-8"},
-                        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
-                        timeout=120,
-                    )
-                    resp.encoding = "utf-8"
-                    resp.raise_for_status()
-                    data = resp.json()
-                    balance = data.get("balance", [])
+                    balance = fetch_window(session, stats, entry, cond, start, finish)
                     total_items += len(balance)
 
-                    added_f, added_g, added_c = 0, 0, 0
-                    for item in balance:
-                        inv_kind = item.get("inventory_kind")
-                        bal_date = to_date(item.get("date"))
-                        prod_code = item.get("product_code")
-                        prod_barcode = item.get("product_barcode")
-                        prod_id = item.get("product_id")
-                        card_code = item.get("card_code")
-                        expiry_date = to_date(item.get("expiry_date"))
-                        serial_num = item.get("serial_number")
-                        batch_num = item.get("batch_number")
-                        qty = to_float(item.get("quantity"))
-                        measure_code = item.get("measure_code")
-                        input_price = to_float(item.get("input_price"))
-
-                        balance_id = make_balance_id(warehouse_id, prod_id, batch_num, bal_date)
-
-                        # Fact rows (only once per balance_id)
-                        if balance_id not in seen_balance_ids:
-                            fact_rows.append((
-                                balance_id, inv_kind, bal_date,
-                                safe_int(warehouse_id),
-                                warehouse_code, prod_code, prod_barcode, prod_id, card_code, expiry_date,
-                                serial_num, batch_num,
-                                qty, measure_code, input_price,
-                                safe_int(filial_id), filial_code
-                            ))
-                            seen_balance_ids.add(balance_id)
-                            added_f += 1
-                            if bal_date and (scope_max_balance_date is None or bal_date > scope_max_balance_date):
-                                scope_max_balance_date = bal_date
-
-                        # Groups (may be multiple)
-                        groups = item.get("groups") or [{"group_code": None, "type_code": None}]
-                        for g in groups:
-                            gc = g.get("group_code")
-                            tc = g.get("type_code")
-                            key = (balance_id, gc)
-                            if key not in seen_group_pairs:
-                                group_rows.append((balance_id, gc, tc))
-                                seen_group_pairs.add(key)
-                                added_g += 1
-
-                        # Condition mapping (balance_id, cond)
-                        cond_key = (balance_id, cond)
-                        if cond_key not in seen_cond_pairs:
-                            condition_rows.append((balance_id, cond))
-                            seen_cond_pairs.add(cond_key)
-                            added_c += 1
+                    added_f, added_g, added_c, max_date = collect_rows(balance, entry, cond, out, seen)
+                    if max_date and (scope_max_balance_date is None or max_date > scope_max_balance_date):
+                        scope_max_balance_date = max_date
 
                     print(f"✅ {start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | "
                           f"{scope_key} | cond:{cond} | items:{len(balance)} → +F:{added_f}, +G:{added_g}, +C:{added_c}")
@@ -544,59 +606,35 @@ def fetch_balance_chunks(cursor, filial_warehouse_list, product_conditions, user
                     scope_added_f += added_f
                     scope_added_g += added_g
                     scope_added_c += added_c
+                    if done is not None:
+                        done.append((scope_key, start, finish))
+                    else:
+                        journal.mark_done(scope_key, start, finish)
 
                 except Exception as e:
                     print(
                         f"⚠️ API xatosi | {scope_key} | cond:{cond} | {start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | {e}")
+                    journal.record_failure(scope_key, start, finish, e)
+                    stats.add(failed_units=1)
 
             # Update load state per (filial|warehouse|cond)
             if scope_max_balance_date:
-                upsert_scope_state(cursor, scope_key, scope_max_balance_date, scope_added_f)
+                if states is not None:
+                    states.append((scope_key, scope_max_balance_date, scope_added_f))
+                else:
+                    upsert_scope_state(cursor, scope_key, scope_max_balance_date, scope_added_f)
 
     print(
         f"Σ API items: {total_items} | fact_rows:{len(fact_rows)} | group_rows:{len(group_rows)} | condition_rows:{len(condition_rows)}")
+    stats.print_summary()
+    if done is None:
+        journal.print_pending()
     return fact_rows, group_rows, condition_rows
 
 
-# ====== MAIN ======
-def main():
-    # 1) JSON ni UTF-8 da o‘qiymiz
-    with open(FILIAL_WAREHOUSE_JSON, "r", encoding="utf-8") as f:
-        filial_warehouse_list = json.load(f)
-
-    # read product conditions as simple list of strings: ["T","B","F"]
-    with open(PRODUCT_CONDITION_JSON, "r", encoding="utf-8") as f:
-        cond_json = json.load(f)
-    # cond_json expected like: [ {"product_conditions":["T"]}, {"product_conditions":["B"]} ... ]
-    product_conditions = []
-    for entry in cond_json:
-        pcs = entry.get("product_conditions") or []
-        for p in pcs:
-            if p and p not in product_conditions:
-                product_conditions.append(p)
-
-    # 2) Sana oynasi: 01.01.2025 → bugun (Asia/Samarkand)
-    begin_date = datetime.strptime(BEGIN_DATE_STR, DATE_FORMAT)
-    end_date = datetime.strptime(today_samarkand_date().strftime(DATE_FORMAT), DATE_FORMAT)
-
-    # 3) SQL ga ulanib, jadvallarni tekshiramiz
-    conn = connect_sql()
-    cursor = conn.cursor()
-    print("✅ SQL Serverga ulandik")
-
-    ensure_tables(cursor)
-    ensure_loadstate_table(cursor)
-    conn.commit()
-
-    # 4) API dan ma’lumotlarni yig‘amiz (INCREMENTAL, per-scope per-condition)
-    fact_rows, group_rows, condition_rows = fetch_balance_chunks(cursor, filial_warehouse_list, product_conditions,
-                                                                 begin_date, end_date)
-    if not fact_rows and not group_rows and not condition_rows:
-        print("ℹ️ Yangi yozuvlar topilmadi.")
-        cursor.close()
-        conn.close()
-        return
-
+# ====== SQL LOAD ======
+def load_rows(cursor, fact_rows, group_rows, condition_rows):
+    """Temp jadvallar → MERGE (Fact, Group, Condition). Commit qilmaydi."""
     # 5) Temp jadvallarni yaratish (shu joyni original koddagi temp strukturasiga mos qildim)
     def create_temp_tables():
         cursor.execute(f"""
@@ -636,39 +674,42 @@ CREATE TABLE #TmpCond (
     create_temp_tables()
 
     # 6) Bulk insert (Unicode safe) — xatoda fallback + temp jadvallarni qayta yaratish
-    try:
-        cursor.fast_executemany = True
-        if fact_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, fact_rows)
-        if group_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpGroup VALUES (?,?,?)
-            """, group_rows)
-        if condition_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpCond VALUES (?,?)
-            """, condition_rows)
-    except pyodbc.Error as e:
-        print(f"⚠️ fast_executemany muammo: {e}. Fallback bilan davom etamiz.")
-        create_temp_tables()
-        cursor.fast_executemany = False
-        if fact_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, fact_rows)
-        if group_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpGroup VALUES (?,?,?)
-            """, group_rows)
-        if condition_rows:
-            cursor.executemany("""
-                INSERT INTO #TmpCond VALUES (?,?)
-            """, condition_rows)
+    # (VALIDATE_ROWS bilan qatorlar oldindan tekshirilgan — fallback faqat kutilmagan holat uchun)
+    with span("stage", rows=len(fact_rows) + len(group_rows) + len(condition_rows)), timed("stage temp tables"):
+        try:
+            cursor.fast_executemany = True
+            if fact_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """, fact_rows)
+            if group_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpGroup VALUES (?,?,?)
+                """, group_rows)
+            if condition_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpCond VALUES (?,?)
+                """, condition_rows)
+        except pyodbc.Error as e:
+            print(f"⚠️ fast_executemany muammo: {e}. Fallback bilan davom etamiz.")
+            create_temp_tables()
+            cursor.fast_executemany = False
+            if fact_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpFact VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """, fact_rows)
+            if group_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpGroup VALUES (?,?,?)
+                """, group_rows)
+            if condition_rows:
+                cursor.executemany("""
+                    INSERT INTO #TmpCond VALUES (?,?)
+                """, condition_rows)
 
     # 7) MERGE: Fact upsert (PRIMARY KEY = balance_id)
-    cursor.execute(f"""
+    with span("merge", rows=len(fact_rows)), timed(f"merge {FACT_TABLE}"):
+        cursor.execute(f"""
 MERGE {FACT_TABLE} AS T
 USING (
     SELECT DISTINCT *
@@ -704,7 +745,9 @@ WHEN NOT MATCHED THEN
 """)
 
     # 8) MERGE: Group upsert (PRIMARY KEY = balance_id + group_code)
-    cursor.execute(f"""
+    if group_rows:  # GROUP_STORAGE = "product" da bo‘sh
+        with span("merge", rows=len(group_rows)), timed(f"merge {GROUP_TABLE}"):
+            cursor.execute(f"""
 MERGE {GROUP_TABLE} AS T
 USING (
     SELECT DISTINCT balance_id,
@@ -721,7 +764,8 @@ WHEN NOT MATCHED THEN
 """)
 
     # 9) MERGE: BalanceCondition upsert (PRIMARY KEY = balance_id + product_condition)
-    cursor.execute(f"""
+    with span("merge", rows=len(condition_rows)), timed(f"merge {CONDITION_TABLE}"):
+        cursor.execute(f"""
 MERGE {CONDITION_TABLE} AS T
 USING (
     SELECT DISTINCT balance_id, product_condition
@@ -733,15 +777,231 @@ WHEN NOT MATCHED THEN
     VALUES (S.balance_id, S.product_condition);
 """)
 
-    # 10) Tozalash va commit
+    # 10) Tozalash (commit — chaqiruvchida)
     cursor.execute("DROP TABLE #TmpFact; DROP TABLE #TmpGroup; DROP TABLE #TmpCond;")
+
+
+def aggregate_source() -> AggSource:
+    """Agregatlar manbasi: FACT_STORAGE bo‘yicha fakt/holat jadvali, GROUP_STORAGE bo‘yicha guruhlar."""
+    product_join = f"LEFT JOIN {PRODUCT_GROUP_TABLE} AS g ON g.product_id = ISNULL(f.product_id, N'')"
+    if FACT_STORAGE == "monthly":
+        return AggSource(MONTHLY_FACT_TABLE, MONTHLY_CONDITION_TABLE, product_join, dated_conditions=True)
+    if GROUP_STORAGE == "product":
+        return AggSource(FACT_TABLE, CONDITION_TABLE, product_join)
+    return AggSource(FACT_TABLE, CONDITION_TABLE, f"LEFT JOIN {GROUP_TABLE} AS g ON g.balance_id = f.balance_id")
+
+
+def store_rows(cursor, fact_rows, group_rows, condition_rows, commit_each: bool = PARTITION_COMMITS):
+    """FACT_STORAGE bo‘yicha: kunlik MERGE (load_rows), INT kalitli (keyed), oylik SWITCH yoki intervallar (SCD2).
+    Kunlik rejimda guruhlar GROUP_STORAGE bo‘yicha: mahsulot ko‘prigi (product_groups) yoki BalanceGroup.
+    Kunlik/oylik rejimda so‘ng agregatlar (AGGREGATES). Avval — VALIDATE_ROWS (karantin).
+    commit_each — oylik rejimda har oydan keyin commit (False — hammasi chaqiruvchining tranzaksiyasida)."""
+    if VALIDATE_ROWS:
+        fact_rows, (group_rows, condition_rows) = quarantine.screen(
+            cursor, "balance_data", ("#TmpFact", fact_rows, balance_fact_schema()),
+            [("#TmpGroup", group_rows, BALANCE_GROUP_SCHEMA), ("#TmpCond", condition_rows, BALANCE_CONDITION_SCHEMA)])
+    if FACT_STORAGE == "keyed":
+        load_keyed(cursor, fact_rows, group_rows, condition_rows)
+        return
+    if FACT_STORAGE == "interval":
+        with span("transform", rows=len(fact_rows)):
+            interval_rows, i_group_rows, i_condition_rows, skipped = collapse(fact_rows, group_rows, condition_rows)
+        if skipped:
+            print(f"⚠️ Sanasiz {skipped} ta qator intervalga kirmadi")
+        print(f"🗜 {len(fact_rows)} kunlik qator → {len(interval_rows)} interval")
+        load_intervals(cursor, interval_rows, i_group_rows, i_condition_rows)
+        return
+
+    if FACT_STORAGE == "monthly":
+        load_monthly(cursor, fact_rows, condition_rows, commit_each=commit_each)
+        PRODUCT_GROUPS.refresh(cursor, fact_rows, group_rows)
+    elif GROUP_STORAGE == "product":
+        # BalanceGroup MERGE o‘rniga — faqat guruhlari o‘zgargan mahsulotlar
+        load_rows(cursor, fact_rows, [], condition_rows)
+        PRODUCT_GROUPS.refresh(cursor, fact_rows, group_rows)
+    else:
+        load_rows(cursor, fact_rows, group_rows, condition_rows)
+    if AGGREGATES:
+        refresh_aggregates(cursor, fact_rows, aggregate_source())
+
+
+# ====== NAVBAT: bir nechta jarayon / mashina ======
+def plan_units(cursor, filial_warehouse_list, product_conditions, begin_date: datetime, end_date: datetime):
+    """
+    (units, tail): (scope_key, begin, end) ro‘yxatlari. Oynalar BEGIN_DATE_STR dan 30 kunlik qadam bilan —
+    chegaralar har safar bir xil, shuning uchun takroriy rejalash dublikat bermaydi.
+    LoadState bo‘yicha allaqachon yuklangan (bufferdan oldingi) oynalar tashlab ketiladi.
+    tail — [state_last - INCREMENTAL_BUFFER_DAYS, bugun] bilan kesishgan oynalar: navbatda 'done'
+    bo‘lsa ham qayta yuklanadi (navbatsiz rejimdagi kabi kechikkan tuzatishlar uchun). Yaqinda
+    (REOPEN_MIN_AGE ichida) bajarilganlari qayta ochilmaydi — har bir jarayon rejalaydi, lekin
+    hamma jarayonlar birga ishga tushganda dum faqat bir marta yuklanadi.
+    """
+    windows = [(start.date(), finish.date()) for start, finish in daterange(begin_date, end_date, step_days=30)]
+    units, tail = [], []
+    for entry in filial_warehouse_list:
+        for cond in product_conditions:
+            scope_key = make_scope_key(entry.get("filial_id"), entry.get("warehouse_id"), cond)
+            state_last = get_scope_state(cursor, scope_key)
+            floor = state_last - timedelta(days=INCREMENTAL_BUFFER_DAYS) if state_last else None
+            scope_units = [(scope_key, start, finish) for start, finish in windows
+                           if floor is None or finish >= floor]
+            units.extend(scope_units)
+            if floor is not None:
+                tail.extend(scope_units)
+    return units, tail
+
+
+def run_queue(filial_warehouse_list, product_conditions, session=None, plan: bool = True) -> int:
+    """
+    --queue: (scope, oyna) birliklarini dbo.WorkLease orqali bir nechta jarayon bo‘lishadi.
+    Har bir oyna o‘z tranzaksiyasida: MERGE + LoadState + unit 'done' birga commit qilinadi
+    (oylik rejimda ham — oy commit’lari o‘chirilgan).
+    Jarayon yiqilsa, uning ijarasi tugaydi va oynani boshqa jarayon oladi.
+    """
+    session = session or make_session()
+    stats = RetryStats()
+    queue = WorkQueue(QUEUE_NAME, connect_sql)
+
+    conn = connect_sql()
+    cursor = conn.cursor()
+    ensure_tables(cursor)
+    ensure_loadstate_table(cursor)
+    queue.ensure(cursor)
     conn.commit()
+
+    if plan:
+        begin_date = datetime.strptime(BEGIN_DATE_STR, DATE_FORMAT)
+        end_date = datetime.strptime(today_samarkand_date().strftime(DATE_FORMAT), DATE_FORMAT)
+        units, tail = plan_units(cursor, filial_warehouse_list, product_conditions, begin_date, end_date)
+        added = queue.enqueue(conn, units)
+        reopened = queue.reopen(conn, tail)
+        print(f"📋 Navbatga qo‘shildi: {added} ta oyna, qayta ochildi (buffer): {reopened}")
+
+    scopes = {make_scope_key(e.get("filial_id"), e.get("warehouse_id"), cond): (e, cond)
+              for e in filial_warehouse_list for cond in product_conditions}
+    total = 0
+    for unit in queue.claims(conn):
+        try:
+            if unit.scope not in scopes:
+                raise LookupError(f"{unit.scope} bu jarayon konfiguratsiyasida yo‘q")
+            entry, cond = scopes[unit.scope]
+            balance = fetch_window(session, stats, entry, cond, unit.begin, unit.end)
+
+            fact_rows, group_rows, condition_rows = [], [], []
+            added_f, added_g, added_c, max_date = collect_rows(balance, entry, cond,
+                                                               (fact_rows, group_rows, condition_rows),
+                                                               (set(), set(), set()))
+            if fact_rows:
+                store_rows(cursor, fact_rows, group_rows, condition_rows, commit_each=False)
+            if max_date:
+                upsert_scope_state(cursor, unit.scope, max_date, added_f)
+            queue.complete(cursor, unit)
+            with span("commit"):
+                conn.commit()
+            total += added_f + added_g + added_c
+            print(f"✅ {unit} | items:{len(balance)} → +F:{added_f}, +G:{added_g}, +C:{added_c}")
+        except Exception as e:
+            conn.rollback()
+            DIM_CACHE.clear()  # rollback bo‘lgan yangi kalitlar keshda qolmasin
+            PRODUCT_GROUPS.clear()
+            print(f"⚠️ {unit} | urinish {unit.attempts} | {e}")
+            if not isinstance(e, LeaseLost):
+                queue.fail(conn, unit, e)
+            stats.add(failed_units=1)
+
     cursor.close()
-    conn.close()
+    stats.print_summary()
+    queue.print_status(conn)
+    print_timings()
+    print_transfer_stats()
+    return total
+
+
+# ====== MAIN ======
+def load_config():
+    """filial_warehouse.json va product_condition.json ni o‘qiydi."""
+    with open(FILIAL_WAREHOUSE_JSON, "r", encoding="utf-8") as f:
+        filial_warehouse_list = json.load(f)
 
+    # read product conditions as simple list of strings: ["T","B","F"]
+    with open(PRODUCT_CONDITION_JSON, "r", encoding="utf-8") as f:
+        cond_json = json.load(f)
+    # cond_json expected like: [ {"product_conditions":["T"]}, {"product_conditions":["B"]} ... ]
+    product_conditions = []
+    for entry in cond_json:
+        pcs = entry.get("product_conditions") or []
+        for p in pcs:
+            if p and p not in product_conditions:
+                product_conditions.append(p)
+    return filial_warehouse_list, product_conditions
+
+
+def main(filial_warehouse_list=None, product_conditions=None, session=None, resume: bool = False,
+         queue: bool = False):
+    """
+    Qaytadi: MERGE ga yuborilgan qatorlar soni (fact + group + condition).
+    run_all.py konfiguratsiya va HTTP sessiyani tayyor holda uzatishi mumkin.
+    resume=True (--resume): faqat oldingi ishga tushirishda yuklanmagan oynalar.
+    queue=True (--queue): navbat rejimi, bir nechta jarayon parallel (run_queue).
+    """
+    # 1) JSON ni UTF-8 da o‘qiymiz
+    if filial_warehouse_list is None or product_conditions is None:
+        filial_warehouse_list, product_conditions = load_config()
+
+    if queue:
+        return run_queue(filial_warehouse_list, product_conditions, session=session)
+
+    # 2) Sana oynasi: 01.01.2025 → bugun (Asia/Samarkand)
+    begin_date = datetime.strptime(BEGIN_DATE_STR, DATE_FORMAT)
+    end_date = datetime.strptime(today_samarkand_date().strftime(DATE_FORMAT), DATE_FORMAT)
+
+    # 3) SQL ga ulanib, jadvallarni tekshiramiz
+    conn = connect_sql()
+    cursor = conn.cursor()
+    print("✅ SQL Serverga ulandik")
+
+    ensure_tables(cursor)
+    ensure_loadstate_table(cursor)
+    conn.commit()
+
+    # 4) API dan ma’lumotlarni yig‘amiz (INCREMENTAL, per-scope per-condition)
+    # oynalar journal’dan faqat commit’dan keyin o‘chiriladi: MERGE yiqilsa --resume ularni qayta oladi
+    # LoadState ham store_rows dan keyin yoziladi: oylik rejimda oxirgi oy commit’idan keyin
+    journal = FailureJournal("balance_data")
+    done, states = [], []
+    fact_rows, group_rows, condition_rows = fetch_balance_chunks(cursor, filial_warehouse_list, product_conditions,
+                                                                 begin_date, end_date, session=session,
+                                                                 journal=journal, resume=resume, done=done,
+                                                                 states=states)
+    if not fact_rows and not group_rows and not condition_rows:
+        print("ℹ️ Yangi yozuvlar topilmadi.")
+        for state in states:
+            upsert_scope_state(cursor, *state)
+        conn.commit()  # LoadState
+        journal.mark_many(done)
+        journal.print_pending()
+        cursor.close()
+        return 0
+
+    # 5-10) Temp jadvallar, bulk insert, MERGE (FACT_STORAGE bo‘yicha)
+    store_rows(cursor, fact_rows, group_rows, condition_rows)
+    for state in states:
+        upsert_scope_state(cursor, *state)
+    with span("commit"):
+        conn.commit()
+    journal.mark_many(done)
+    journal.print_pending()
+    cursor.close()
+
+    print_timings()
+    print_transfer_stats()
     print(
         f"💾 Yuklash yakunlandi | Fact yozuvlar: {len(fact_rows)} | Group yozuvlar: {len(group_rows)} | Condition yozuvlar: {len(condition_rows)}")
+    return len(fact_rows) + len(group_rows) + len(condition_rows)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--queue-status" in sys.argv[1:]:
+        WorkQueue(QUEUE_NAME, connect_sql).print_status(connect_sql())
+    else:
+        main(resume=resume_requested(), queue="--queue" in sys.argv[1:])
\ No newline at end of file
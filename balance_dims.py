@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Справочники с целочисленными суррогатными ключами для остатков.
+
+    DimWarehouse (warehouse_code -> warehouse_key; warehouse_id, filial_id, filial_code)
+    DimProduct   (product_id     -> product_key;   product_code, product_barcode, card_code)
+    DimMeasure   (measure_code   -> measure_key)
+    DimGroup     (group_code     -> group_key;     type_code)
+
+DimCache держит соответствие код -> ключ на клиенте: справочник читается
+один раз за процесс, в SQL уходят только новые коды и коды с изменёнными
+атрибутами (SCD1 — атрибут перезаписывается).
+
+balance_data.FACT_STORAGE = "keyed": факты пишутся в dbo.FactBalanceKeyed с
+INT-ключами вместо строк; dbo.vFactBalanceKeyed отдаёт прежние колонки FactBalance.
+"""
+import threading
+
+from db import timed
+from run_report import span
+
+COLLATION = "Cyrillic_General_CI_AS"  # как в dbo.FactBalance
+
+KEYED_FACT_TABLE = "dbo.FactBalanceKeyed"
+KEYED_GROUP_TABLE = "dbo.BalanceGroupKeyed"
+KEYED_CONDITION_TABLE = "dbo.BalanceConditionKeyed"
+KEYED_VIEW = "dbo.vFactBalanceKeyed"
+
+
+class Dim:
+    __slots__ = ("table", "key", "natural", "attrs")
+
+    def __init__(self, table, key, natural, attrs):
+        self.table = table
+        self.key = key
+        self.natural = natural  # (колонка, SQL-тип)
+        self.attrs = attrs      # [(колонка, SQL-тип), ...]
+
+
+DIMS = {
+    "warehouse": Dim("dbo.DimWarehouse", "warehouse_key", ("warehouse_code", f"NVARCHAR(200) COLLATE {COLLATION}"),
+                     [("warehouse_id", "INT"), ("filial_id", "INT"),
+                      ("filial_code", f"NVARCHAR(100) COLLATE {COLLATION}")]),
+    "product": Dim("dbo.DimProduct", "product_key", ("product_id", f"NVARCHAR(50) COLLATE {COLLATION}"),
+                   [("product_code", f"NVARCHAR(100) COLLATE {COLLATION}"),
+                    ("product_barcode", f"NVARCHAR(100) COLLATE {COLLATION}"),
+                    ("card_code", f"NVARCHAR(100) COLLATE {COLLATION}")]),
+    "measure": Dim("dbo.DimMeasure", "measure_key", ("measure_code", f"NVARCHAR(50) COLLATE {COLLATION}"), []),
+    "group": Dim("dbo.DimGroup", "group_key", ("group_code", f"NVARCHAR(100) COLLATE {COLLATION}"),
+                 [("type_code", f"NVARCHAR(200) COLLATE {COLLATION}")]),
+}
+
+
+# ====== CACHE ======
+def _norm(code):
+    # Cyrillic_General_CI_AS: регистр и хвостовые пробелы не различаются
+    return code.rstrip().casefold() if isinstance(code, str) else code
+
+
+class DimCache:
+    def __init__(self):
+        self._maps = {}  # dim -> {код: (ключ, атрибуты)}
+        self._lock = threading.Lock()
+
+    def ensure(self, cursor):
+        for dim in DIMS.values():
+            col, sql_type = dim.natural
+            attrs_sql = "".join(f"\n        {c} {t} NULL," for c, t in dim.attrs)
+            cursor.execute(f"""
+IF OBJECT_ID('{dim.table}', 'U') IS NULL
+    CREATE TABLE {dim.table} (
+        {dim.key} INT IDENTITY(1,1) NOT NULL CONSTRAINT PK_{dim.table.split('.')[-1]} PRIMARY KEY,
+        {col} {sql_type} NOT NULL CONSTRAINT UQ_{dim.table.split('.')[-1]}_{col} UNIQUE,{attrs_sql}
+        updated_utc DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+""")
+
+    def _load(self, cursor, name):
+        dim = DIMS[name]
+        cols = [dim.key, dim.natural[0]] + [c for c, _ in dim.attrs]
+        with timed(f"load {dim.table}"):
+            cursor.execute(f"SELECT {', '.join(cols)} FROM {dim.table}")
+            rows = cursor.fetchall()
+        return {_norm(row[1]): (row[0], tuple(row[2:])) for row in rows}
+
+    def keys(self, cursor, name: str, values: dict) -> dict:
+        """values: {код: (атрибуты...)} -> {код: ключ}. None-коды пропускаются."""
+        dim = DIMS[name]
+        with self._lock:
+            cache = self._maps.get(name)
+            if cache is None:
+                cache = self._maps[name] = self._load(cursor, name)
+            pending = {}
+            for code, attrs in values.items():
+                known = cache.get(_norm(code))
+                if code is not None and (known is None or known[1] != tuple(attrs)):
+                    pending.setdefault(_norm(code), (code, *attrs))
+            if pending:
+                self._upsert(cursor, dim, list(pending.values()), cache)
+            return {code: cache[_norm(code)][0] for code in values if code is not None}
+
+    def clear(self):
+        """После ROLLBACK: новые ключи из этой транзакции в БД не попали."""
+        with self._lock:
+            self._maps.clear()
+
+    @staticmethod
+    def _upsert(cursor, dim, rows, cache):
+        col = dim.natural[0]
+        attrs = [c for c, _ in dim.attrs]
+        cols_sql = ", ".join(f"{c} {t}" for c, t in [dim.natural] + dim.attrs)
+        cursor.execute(f"IF OBJECT_ID('tempdb..#TmpDim') IS NOT NULL DROP TABLE #TmpDim; "
+                       f"CREATE TABLE #TmpDim ({cols_sql});")
+        cursor.fast_executemany = True
+        cursor.executemany(f"INSERT INTO #TmpDim VALUES ({','.join('?' * (1 + len(attrs)))})", rows)
+        # WHEN MATCHED всегда (и без атрибутов, как у DimMeasure): код, вставленный другим
+        # процессом, должен попасть в OUTPUT, иначе keys() не найдёт его ключ
+        update_sql = "WHEN MATCHED THEN UPDATE SET " + "".join(f"{c} = S.{c}, " for c in attrs) + \
+                     "updated_utc = SYSUTCDATETIME()"
+        with span("merge", rows=len(rows)), timed(f"merge {dim.table}"):
+            cursor.execute(f"""
+SET NOCOUNT ON;
+MERGE {dim.table} WITH (HOLDLOCK) AS T
+USING #TmpDim AS S
+ON T.{col} = S.{col}
+{update_sql}
+WHEN NOT MATCHED THEN
+    INSERT ({', '.join([col] + attrs)}) VALUES ({', '.join(f'S.{c}' for c in [col] + attrs)})
+OUTPUT inserted.{dim.key}, inserted.{', inserted.'.join([col] + attrs)};
+""")
+            for row in cursor.fetchall():
+                cache[_norm(row[1])] = (row[0], tuple(row[2:]))
+        cursor.execute("DROP TABLE #TmpDim; SET NOCOUNT OFF;")
+
+
+# один кэш на процесс: справочники общие для всех scope и окон
+DIM_CACHE = DimCache()
+
+
+# ====== KEYED FACT ======
+def ensure_keyed_tables(cursor, collation: str = COLLATION):
+    DIM_CACHE.ensure(cursor)
+    cursor.execute(f"""
+IF OBJECT_ID('{KEYED_FACT_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {KEYED_FACT_TABLE} (
+        balance_id      CHAR(64)      NOT NULL PRIMARY KEY,
+        inventory_kind  VARCHAR(50)   NULL,
+        balance_date    DATE          NULL,
+        warehouse_key   INT           NULL REFERENCES dbo.DimWarehouse(warehouse_key),
+        product_key     INT           NULL REFERENCES dbo.DimProduct(product_key),
+        expiry_date     DATE          NULL,
+        serial_number   NVARCHAR(100) COLLATE {collation} NULL,
+        batch_number    NVARCHAR(100) COLLATE {collation} NULL,
+        quantity        DECIMAL(18,4) NULL,
+        measure_key     INT           NULL REFERENCES dbo.DimMeasure(measure_key),
+        input_price     DECIMAL(18,4) NULL
+    );
+    CREATE INDEX IX_FactBalanceKeyed_Product
+      ON {KEYED_FACT_TABLE}(product_key, warehouse_key, batch_number, balance_date);
+END
+IF OBJECT_ID('{KEYED_GROUP_TABLE}', 'U') IS NULL
+    CREATE TABLE {KEYED_GROUP_TABLE} (
+        balance_id CHAR(64) NOT NULL,
+        group_key  INT      NOT NULL REFERENCES dbo.DimGroup(group_key),
+        CONSTRAINT PK_BalanceGroupKeyed PRIMARY KEY (balance_id, group_key)
+    );
+IF OBJECT_ID('{KEYED_CONDITION_TABLE}', 'U') IS NULL
+    CREATE TABLE {KEYED_CONDITION_TABLE} (
+        balance_id        CHAR(64)     NOT NULL,
+        product_condition NVARCHAR(50) COLLATE {collation} NOT NULL,
+        CONSTRAINT PK_BalanceConditionKeyed PRIMARY KEY (balance_id, product_condition)
+    );
+""")
+    cursor.execute(f"""
+CREATE OR ALTER VIEW {KEYED_VIEW} AS
+SELECT f.balance_id, f.inventory_kind, f.balance_date, w.warehouse_id, w.warehouse_code,
+       p.product_code, p.product_barcode, p.product_id, p.card_code, f.expiry_date,
+       f.serial_number, f.batch_number, f.quantity, m.measure_code, f.input_price,
+       w.filial_id, w.filial_code
+FROM {KEYED_FACT_TABLE} AS f
+LEFT JOIN dbo.DimWarehouse AS w ON w.warehouse_key = f.warehouse_key
+LEFT JOIN dbo.DimProduct   AS p ON p.product_key = f.product_key
+LEFT JOIN dbo.DimMeasure   AS m ON m.measure_key = f.measure_key;
+""")
+
+
+def load_keyed(cursor, fact_rows, group_rows, condition_rows, cache: DimCache = DIM_CACHE):
+    """Строки balance_data.collect_rows -> ключи справочников -> MERGE в *Keyed. Commit — за вызывающим."""
+    with span("transform", rows=len(fact_rows)):
+        # (balance_id, inv_kind, date, wh_id, wh_code, p_code, p_barcode, p_id, card, expiry,
+        #  serial, batch, qty, measure, price, filial_id, filial_code)
+        wk = cache.keys(cursor, "warehouse", {r[4]: (r[3], r[15], r[16]) for r in fact_rows})
+        pk = cache.keys(cursor, "product", {r[7]: (r[5], r[6], r[8]) for r in fact_rows})
+        mk = cache.keys(cursor, "measure", {r[13]: () for r in fact_rows})
+        gk = cache.keys(cursor, "group", {gc: (tc,) for _, gc, tc in group_rows})
+        keyed_rows = [(r[0], r[1], r[2], wk.get(r[4]), pk.get(r[7]), r[9], r[10], r[11], r[12], mk.get(r[13]), r[14])
+                      for r in fact_rows]
+        keyed_groups = list({(bid, gk[gc]) for bid, gc, _ in group_rows if gc is not None})
+
+    cursor.execute(f"""
+IF OBJECT_ID('tempdb..#TmpFactK') IS NOT NULL DROP TABLE #TmpFactK;
+SELECT TOP 0 * INTO #TmpFactK FROM {KEYED_FACT_TABLE};
+IF OBJECT_ID('tempdb..#TmpGroupK') IS NOT NULL DROP TABLE #TmpGroupK;
+SELECT TOP 0 * INTO #TmpGroupK FROM {KEYED_GROUP_TABLE};
+IF OBJECT_ID('tempdb..#TmpCondK') IS NOT NULL DROP TABLE #TmpCondK;
+SELECT TOP 0 * INTO #TmpCondK FROM {KEYED_CONDITION_TABLE};
+""")
+    with span("stage", rows=len(keyed_rows) + len(keyed_groups) + len(condition_rows)), \
+            timed("stage keyed temp tables"):
+        cursor.fast_executemany = True
+        cursor.executemany("INSERT INTO #TmpFactK VALUES (?,?,?,?,?,?,?,?,?,?,?)", keyed_rows)
+        if keyed_groups:
+            cursor.executemany("INSERT INTO #TmpGroupK VALUES (?,?)", keyed_groups)
+        if condition_rows:
+            cursor.executemany("INSERT INTO #TmpCondK VALUES (?,?)", condition_rows)
+
+    with span("merge", rows=len(keyed_rows)), timed(f"merge {KEYED_FACT_TABLE}"):
+        cursor.execute(f"""
+MERGE {KEYED_FACT_TABLE} AS T
+USING #TmpFactK AS S
+ON (T.balance_id = S.balance_id)
+WHEN MATCHED THEN UPDATE SET
+    inventory_kind = S.inventory_kind,
+    balance_date   = S.balance_date,
+    warehouse_key  = S.warehouse_key,
+    product_key    = S.product_key,
+    expiry_date    = S.expiry_date,
+    serial_number  = S.serial_number,
+    batch_number   = S.batch_number,
+    quantity       = S.quantity,
+    measure_key    = S.measure_key,
+    input_price    = S.input_price
+WHEN NOT MATCHED THEN
+    INSERT (balance_id, inventory_kind, balance_date, warehouse_key, product_key, expiry_date,
+            serial_number, batch_number, quantity, measure_key, input_price)
+    VALUES (S.balance_id, S.inventory_kind, S.balance_date, S.warehouse_key, S.product_key, S.expiry_date,
+            S.serial_number, S.batch_number, S.quantity, S.measure_key, S.input_price);
+""")
+    with span("merge", rows=len(keyed_groups) + len(condition_rows)), timed(f"merge {KEYED_GROUP_TABLE}"):
+        cursor.execute(f"""
+INSERT INTO {KEYED_GROUP_TABLE} (balance_id, group_key)
+SELECT s.balance_id, s.group_key FROM #TmpGroupK AS s
+WHERE NOT EXISTS (SELECT 1 FROM {KEYED_GROUP_TABLE} AS t
+                  WHERE t.balance_id = s.balance_id AND t.group_key = s.group_key);
+
+INSERT INTO {KEYED_CONDITION_TABLE} (balance_id, product_condition)
+SELECT DISTINCT s.balance_id, s.product_condition FROM #TmpCondK AS s
+WHERE NOT EXISTS (SELECT 1 FROM {KEYED_CONDITION_TABLE} AS t
+                  WHERE t.balance_id = s.balance_id AND t.product_condition = s.product_condition);
+""")
+    cursor.execute("DROP TABLE #TmpFactK; DROP TABLE #TmpGroupK; DROP TABLE #TmpCondK;")
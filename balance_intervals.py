@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Интервальное (SCD2) хранение остатков: вместо строки FactBalance на каждый
+(склад, товар, партия, дата) — одна строка на период, пока количество, цена
+и прочие атрибуты не меняются: [valid_from, valid_to] (обе даты включительно).
+
+- collapse(): дневные строки balance_data -> интервалы (при загрузке)
+- load_intervals(): MERGE не по дням, а по интервалам — для каждого ключа
+  перезагружаемый диапазон вырезается из старых интервалов, вставляются
+  новые, затем соседние одинаковые склеиваются (продление / закрытие)
+- dbo.vFactBalanceDaily и dbo.fn_FactBalanceDaily(@from, @to) разворачивают
+  интервалы обратно в дневные строки с теми же колонками, что и FactBalance
+  (balance_id считается так же, как make_balance_id; нужна UTF-8 collation,
+  SQL Server 2019+)
+
+Группы и состояния не зависят от даты, поэтому хранятся по ключу
+(warehouse_id, product_id, batch_number).
+"""
+import hashlib
+from datetime import datetime, timedelta
+
+from db import timed
+from run_report import span
+
+INTERVAL_TABLE = "dbo.FactBalanceInterval"
+INTERVAL_GROUP_TABLE = "dbo.BalanceIntervalGroup"
+INTERVAL_CONDITION_TABLE = "dbo.BalanceIntervalCondition"
+DAILY_VIEW = "dbo.vFactBalanceDaily"
+DAILY_FUNCTION = "dbo.fn_FactBalanceDaily"
+COLLATION = "Cyrillic_General_CI_AS"  # как в dbo.FactBalance
+
+# индексы в кортеже fact_rows (balance_data.collect_rows)
+_F_DATE, _F_WAREHOUSE_ID, _F_PRODUCT_ID, _F_BATCH = 2, 3, 7, 11
+# атрибуты интервала: (индекс в fact_rows, колонка)
+VALUE_COLUMNS = [
+    (1, "inventory_kind"), (4, "warehouse_code"), (5, "product_code"), (6, "product_barcode"),
+    (8, "card_code"), (9, "expiry_date"), (10, "serial_number"), (12, "quantity"),
+    (13, "measure_code"), (14, "input_price"), (15, "filial_id"), (16, "filial_code"),
+]
+KEY_COLUMNS = ["warehouse_id", "product_id", "batch_number"]
+INTERVAL_COLUMNS = KEY_COLUMNS + ["valid_from", "valid_to"] + [c for _, c in VALUE_COLUMNS] + ["row_hash"]
+
+_KEY_JOIN = " AND ".join(f"f.{c} = r.{c}" for c in KEY_COLUMNS)
+
+
+def _key(row):
+    # NULL в ключе PK недопустим: склад -> 0 (вьюха возвращает NULLIF(.., 0) и хеширует как ""),
+    # товар/партия -> "" — как make_balance_id, где None и 0 тоже дают ""
+    return row[_F_WAREHOUSE_ID] or 0, row[_F_PRODUCT_ID] or "", row[_F_BATCH] or ""
+
+
+def _value_hash(values) -> str:
+    return hashlib.sha1("\x1f".join("\x00" if v is None else str(v) for v in values).encode("utf-8")).hexdigest()
+
+
+# ====== PYTHON: дни -> интервалы ======
+def collapse(fact_rows, group_rows, condition_rows):
+    """
+    Склеивает подряд идущие дни с одинаковыми атрибутами.
+    Возвращает (interval_rows, group_rows, condition_rows, пропущено строк без даты).
+    """
+    keys = {}
+    days = []
+    skipped = 0
+    for row in fact_rows:
+        d = row[_F_DATE]
+        if d is None:
+            skipped += 1
+            continue
+        if isinstance(d, datetime):
+            d = d.date()
+        key = _key(row)
+        keys[row[0]] = key
+        values = tuple(row[i] for i, _ in VALUE_COLUMNS)
+        days.append((key, d, values, _value_hash(values)))
+
+    days.sort(key=lambda x: (x[0], x[1]))
+    intervals = []
+    one_day = timedelta(days=1)
+    for key, d, values, value_hash in days:
+        last = intervals[-1] if intervals else None
+        if last is not None and last[0] == key and last[2] + one_day == d and last[4] == value_hash:
+            last[2] = d
+        else:
+            intervals.append([key, d, d, values, value_hash])
+    interval_rows = [(*key, vf, vt, *values, value_hash) for key, vf, vt, values, value_hash in intervals]
+
+    groups = {}
+    for balance_id, group_code, type_code in group_rows:
+        key = keys.get(balance_id)
+        if key is not None:
+            groups[(*key, group_code if group_code is not None else "__NULL__")] = type_code
+    conditions = {(*keys[balance_id], cond) for balance_id, cond in condition_rows if balance_id in keys}
+    return (interval_rows, [(*k, tc) for k, tc in groups.items()], sorted(conditions), skipped)
+
+
+# ====== DDL ======
+def _daily_select(collation: str) -> str:
+    """SELECT-список дневной строки из интервала f и даты d.balance_date (колонки как у FactBalance)."""
+    return f"""
+    LOWER(CONVERT(CHAR(64), HASHBYTES('SHA2_256', CONVERT(VARCHAR(400),
+        CONCAT(NULLIF(f.warehouse_id, 0), '|', f.product_id, '|', f.batch_number, '|', CONVERT(CHAR(10), d.balance_date, 23))
+        COLLATE Latin1_General_100_CI_AS_SC_UTF8)), 2)) AS balance_id,
+    f.inventory_kind, d.balance_date, NULLIF(f.warehouse_id, 0) AS warehouse_id, f.warehouse_code,
+    f.product_code, f.product_barcode, NULLIF(f.product_id, N'') COLLATE {collation} AS product_id,
+    f.card_code, f.expiry_date, f.serial_number,
+    NULLIF(f.batch_number, N'') COLLATE {collation} AS batch_number,
+    f.quantity, f.measure_code, f.input_price, f.filial_id, f.filial_code"""
+
+
+def ensure_interval_tables(cursor, collation: str = COLLATION):
+    cursor.execute(f"""
+IF OBJECT_ID('{INTERVAL_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {INTERVAL_TABLE} (
+        warehouse_id    INT           NOT NULL,
+        product_id      NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        batch_number    NVARCHAR(100) COLLATE {collation} NOT NULL,
+        valid_from      DATE          NOT NULL,
+        valid_to        DATE          NOT NULL,
+        inventory_kind  VARCHAR(50)   NULL,
+        warehouse_code  NVARCHAR(200) COLLATE {collation} NULL,
+        product_code    NVARCHAR(100) COLLATE {collation} NULL,
+        product_barcode NVARCHAR(100) COLLATE {collation} NULL,
+        card_code       NVARCHAR(100) COLLATE {collation} NULL,
+        expiry_date     DATE          NULL,
+        serial_number   NVARCHAR(100) COLLATE {collation} NULL,
+        quantity        DECIMAL(18,4) NULL,
+        measure_code    NVARCHAR(50)  COLLATE {collation} NULL,
+        input_price     DECIMAL(18,4) NULL,
+        filial_id       INT           NULL,
+        filial_code     NVARCHAR(100) COLLATE {collation} NULL,
+        row_hash        CHAR(40)      NOT NULL,
+        CONSTRAINT PK_FactBalanceInterval PRIMARY KEY (warehouse_id, product_id, batch_number, valid_from),
+        CONSTRAINT CK_FactBalanceInterval_Range CHECK (valid_to >= valid_from)
+    );
+    CREATE INDEX IX_FactBalanceInterval_Dates ON {INTERVAL_TABLE}(valid_from, valid_to);
+END
+""")
+    cursor.execute(f"""
+IF OBJECT_ID('{INTERVAL_GROUP_TABLE}', 'U') IS NULL
+    CREATE TABLE {INTERVAL_GROUP_TABLE} (
+        warehouse_id INT           NOT NULL,
+        product_id   NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        batch_number NVARCHAR(100) COLLATE {collation} NOT NULL,
+        group_code   NVARCHAR(100) COLLATE {collation} NOT NULL,
+        type_code    NVARCHAR(200) COLLATE {collation} NULL,
+        CONSTRAINT PK_BalanceIntervalGroup PRIMARY KEY (warehouse_id, product_id, batch_number, group_code)
+    );
+IF OBJECT_ID('{INTERVAL_CONDITION_TABLE}', 'U') IS NULL
+    CREATE TABLE {INTERVAL_CONDITION_TABLE} (
+        warehouse_id      INT           NOT NULL,
+        product_id        NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        batch_number      NVARCHAR(100) COLLATE {collation} NOT NULL,
+        product_condition NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        CONSTRAINT PK_BalanceIntervalCondition
+            PRIMARY KEY (warehouse_id, product_id, batch_number, product_condition)
+    );
+""")
+    # VIEW / FUNCTION — каждый в своём batch
+    cursor.execute(f"""
+CREATE OR ALTER VIEW {DAILY_VIEW} AS
+SELECT {_daily_select(collation)}
+FROM {INTERVAL_TABLE} AS f
+CROSS APPLY (
+    SELECT TOP (DATEDIFF(DAY, f.valid_from, f.valid_to) + 1)
+           DATEADD(DAY, ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1, f.valid_from) AS balance_date
+    FROM sys.all_objects AS a CROSS JOIN sys.all_objects AS b
+) AS d;
+""")
+    cursor.execute(f"""
+CREATE OR ALTER FUNCTION {DAILY_FUNCTION} (@from DATE, @to DATE)
+RETURNS TABLE
+AS RETURN
+WITH n AS (
+    SELECT TOP (DATEDIFF(DAY, @from, @to) + 1) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS i
+    FROM sys.all_objects AS a CROSS JOIN sys.all_objects AS b
+), d AS (
+    SELECT DATEADD(DAY, i, @from) AS balance_date FROM n
+)
+SELECT {_daily_select(collation)}
+FROM d
+JOIN {INTERVAL_TABLE} AS f
+  ON d.balance_date BETWEEN f.valid_from AND f.valid_to
+WHERE f.valid_from <= @to AND f.valid_to >= @from;
+""")
+
+
+# ====== LOAD ======
+def load_intervals(cursor, interval_rows, group_rows, condition_rows):
+    """
+    Для каждого ключа из загрузки: диапазон [min(valid_from), max(valid_to)] заменяется
+    новыми интервалами, затем соседние интервалы с тем же row_hash склеиваются.
+    Commit — за вызывающим.
+    """
+    if not interval_rows:
+        return
+    cursor.execute(f"""
+IF OBJECT_ID('tempdb..#TmpInterval') IS NOT NULL DROP TABLE #TmpInterval;
+SELECT TOP 0 {", ".join(INTERVAL_COLUMNS)} INTO #TmpInterval FROM {INTERVAL_TABLE};
+IF OBJECT_ID('tempdb..#TmpIGroup') IS NOT NULL DROP TABLE #TmpIGroup;
+SELECT TOP 0 warehouse_id, product_id, batch_number, group_code, type_code
+INTO #TmpIGroup FROM {INTERVAL_GROUP_TABLE};
+IF OBJECT_ID('tempdb..#TmpICond') IS NOT NULL DROP TABLE #TmpICond;
+SELECT TOP 0 warehouse_id, product_id, batch_number, product_condition
+INTO #TmpICond FROM {INTERVAL_CONDITION_TABLE};
+""")
+    with span("stage", rows=len(interval_rows) + len(group_rows) + len(condition_rows)), \
+            timed("stage interval temp tables"):
+        cursor.fast_executemany = True
+        cursor.executemany(f"INSERT INTO #TmpInterval VALUES ({','.join('?' * len(INTERVAL_COLUMNS))})",
+                           interval_rows)
+        if group_rows:
+            cursor.executemany("INSERT INTO #TmpIGroup VALUES (?,?,?,?,?)", group_rows)
+        if condition_rows:
+            cursor.executemany("INSERT INTO #TmpICond VALUES (?,?,?,?)", condition_rows)
+
+    keys = ", ".join(KEY_COLUMNS)
+    f_keys = ", ".join(f"f.{c}" for c in KEY_COLUMNS)
+    with span("merge", rows=len(interval_rows)), timed(f"merge {INTERVAL_TABLE}"):
+        cursor.execute(f"""
+SELECT {keys}, MIN(valid_from) AS r_from, MAX(valid_to) AS r_to
+INTO #Range
+FROM #TmpInterval
+GROUP BY {keys};
+CREATE UNIQUE CLUSTERED INDEX IX_Range ON #Range({keys});
+
+-- 1) интервал накрывает весь диапазон: хвост после r_to сохраняем отдельной строкой
+INSERT INTO {INTERVAL_TABLE} ({", ".join(INTERVAL_COLUMNS)})
+SELECT {f_keys}, DATEADD(DAY, 1, r.r_to), f.valid_to,
+       {", ".join(f"f.{c}" for c in INTERVAL_COLUMNS[5:])}
+FROM {INTERVAL_TABLE} AS f
+JOIN #Range AS r ON {_KEY_JOIN}
+WHERE f.valid_from < r.r_from AND f.valid_to > r.r_to;
+
+-- 2) начинается внутри, заканчивается после: сдвигаем начало за r_to
+UPDATE f SET valid_from = DATEADD(DAY, 1, r.r_to)
+FROM {INTERVAL_TABLE} AS f
+JOIN #Range AS r ON {_KEY_JOIN}
+WHERE f.valid_from BETWEEN r.r_from AND r.r_to AND f.valid_to > r.r_to;
+
+-- 3) начинается до, заходит внутрь: закрываем накануне r_from
+UPDATE f SET valid_to = DATEADD(DAY, -1, r.r_from)
+FROM {INTERVAL_TABLE} AS f
+JOIN #Range AS r ON {_KEY_JOIN}
+WHERE f.valid_from < r.r_from AND f.valid_to >= r.r_from;
+
+-- 4) целиком внутри диапазона — заменяется новыми
+DELETE f
+FROM {INTERVAL_TABLE} AS f
+JOIN #Range AS r ON {_KEY_JOIN}
+WHERE f.valid_from >= r.r_from AND f.valid_to <= r.r_to;
+
+INSERT INTO {INTERVAL_TABLE} ({", ".join(INTERVAL_COLUMNS)})
+SELECT {", ".join(INTERVAL_COLUMNS)} FROM #TmpInterval;
+
+-- 5) склейка соседей с тем же row_hash (продление открытого интервала)
+WITH x AS (
+    SELECT {f_keys}, f.valid_from, f.valid_to,
+           CASE WHEN LAG(f.row_hash) OVER (PARTITION BY {f_keys} ORDER BY f.valid_from) = f.row_hash
+                 AND DATEADD(DAY, 1, LAG(f.valid_to) OVER (PARTITION BY {f_keys} ORDER BY f.valid_from)) = f.valid_from
+                THEN 0 ELSE 1 END AS brk
+    FROM {INTERVAL_TABLE} AS f
+    JOIN #Range AS r ON {_KEY_JOIN}
+), g AS (
+    SELECT *, SUM(brk) OVER (PARTITION BY {keys} ORDER BY valid_from ROWS UNBOUNDED PRECEDING) AS grp
+    FROM x
+)
+SELECT {keys}, MIN(valid_from) AS first_from, MAX(valid_to) AS last_to
+INTO #Islands
+FROM g
+GROUP BY {keys}, grp
+HAVING COUNT(*) > 1;
+
+UPDATE f SET valid_to = r.last_to
+FROM {INTERVAL_TABLE} AS f
+JOIN #Islands AS r ON {_KEY_JOIN} AND f.valid_from = r.first_from;
+
+DELETE f
+FROM {INTERVAL_TABLE} AS f
+JOIN #Islands AS r ON {_KEY_JOIN} AND f.valid_from > r.first_from AND f.valid_from <= r.last_to;
+
+DROP TABLE #Islands;
+DROP TABLE #Range;
+""")
+
+    with span("merge", rows=len(group_rows)), timed(f"merge {INTERVAL_GROUP_TABLE}"):
+        cursor.execute(f"""
+MERGE {INTERVAL_GROUP_TABLE} AS T
+USING (SELECT DISTINCT * FROM #TmpIGroup) AS S
+ON (T.warehouse_id = S.warehouse_id AND T.product_id = S.product_id
+    AND T.batch_number = S.batch_number AND T.group_code = S.group_code)
+WHEN MATCHED AND ISNULL(T.type_code, N'') <> ISNULL(S.type_code, N'') THEN UPDATE SET
+    type_code = S.type_code
+WHEN NOT MATCHED THEN
+    INSERT (warehouse_id, product_id, batch_number, group_code, type_code)
+    VALUES (S.warehouse_id, S.product_id, S.batch_number, S.group_code, S.type_code);
+
+INSERT INTO {INTERVAL_CONDITION_TABLE} (warehouse_id, product_id, batch_number, product_condition)
+SELECT DISTINCT s.warehouse_id, s.product_id, s.batch_number, s.product_condition
+FROM #TmpICond AS s
+WHERE NOT EXISTS (SELECT 1 FROM {INTERVAL_CONDITION_TABLE} AS t
+                  WHERE t.warehouse_id = s.warehouse_id AND t.product_id = s.product_id
+                    AND t.batch_number = s.batch_number AND t.product_condition = s.product_condition);
+""")
+
+    cursor.execute("DROP TABLE #TmpInterval; DROP TABLE #TmpIGroup; DROP TABLE #TmpICond;")
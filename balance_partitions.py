@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Помесячное секционирование остатков по balance_date и загрузка через SWITCH.
+
+    dbo.FactBalanceMonthly       — колонки FactBalance, PK (balance_date, balance_id)
+    dbo.BalanceConditionMonthly  — (balance_date, balance_id, product_condition)
+    pf_BalanceMonth / ps_BalanceMonth — RANGE RIGHT, граница = 1-е число месяца
+
+Вместо MERGE по всей таблице каждый затронутый месяц собирается заново в
+выровненной staging-таблице (новые строки + старые строки месяца, которых нет
+среди новых), на ней строятся те же индексы и CHECK по границам месяца, затем
+    TRUNCATE ... WITH (PARTITIONS (p)) + ALTER TABLE stage SWITCH TO ... PARTITION p
+— замена месяца метаданными. Каждый месяц — своя транзакция (commit_each),
+поэтому бэкфилл не держит одну гигантскую транзакцию.
+
+Группы в этом режиме — только мост product_groups (от даты не зависят).
+Нужен SQL Server 2016+ (TRUNCATE WITH PARTITIONS).
+"""
+from datetime import date, datetime
+
+from db import timed
+from run_report import span
+
+COLLATION = "Cyrillic_General_CI_AS"  # как в dbo.FactBalance
+
+MONTHLY_FACT_TABLE = "dbo.FactBalanceMonthly"
+MONTHLY_CONDITION_TABLE = "dbo.BalanceConditionMonthly"
+PARTITION_FUNCTION = "pf_BalanceMonth"
+PARTITION_SCHEME = "ps_BalanceMonth"
+FILEGROUP = "[PRIMARY]"
+# один загрузчик пересобирает месяцы за раз: SWITCH всё равно берёт Sch-M на таблицу,
+# а параллельная сборка одного месяца потеряла бы чужие строки
+APPLOCK = "FactBalanceMonthly"
+
+
+class Part:
+    __slots__ = ("table", "stage", "tmp", "key", "indexes")
+
+    def __init__(self, table, key, indexes):
+        self.table = table
+        self.stage = f"{table}_Stage"
+        self.tmp = f"#Tmp{table.split('.')[-1]}"
+        self.key = key          # колонки PK после balance_date (anti-join старых строк)
+        self.indexes = indexes  # [(имя, колонки)] — некластерные, выровненные
+
+
+PARTS = [
+    Part(MONTHLY_FACT_TABLE, ["balance_id"],
+         [("IX_Product", "product_id, warehouse_id, batch_number, balance_date")]),
+    Part(MONTHLY_CONDITION_TABLE, ["balance_id", "product_condition"],
+         [("IX_Cond", "product_condition")]),
+]
+
+
+def month_start(d) -> date:
+    if isinstance(d, datetime):
+        d = d.date()
+    return d.replace(day=1)
+
+
+def next_month(d: date) -> date:
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+# ====== DDL ======
+def ensure_monthly_tables(cursor, first_month: date, collation: str = COLLATION):
+    first = month_start(first_month).isoformat()
+    cursor.execute(f"""
+IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE name = '{PARTITION_FUNCTION}')
+    CREATE PARTITION FUNCTION {PARTITION_FUNCTION} (DATE) AS RANGE RIGHT FOR VALUES ('{first}');
+IF NOT EXISTS (SELECT 1 FROM sys.partition_schemes WHERE name = '{PARTITION_SCHEME}')
+    CREATE PARTITION SCHEME {PARTITION_SCHEME} AS PARTITION {PARTITION_FUNCTION} ALL TO ({FILEGROUP});
+""")
+    cursor.execute(f"""
+IF OBJECT_ID('{MONTHLY_FACT_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {MONTHLY_FACT_TABLE} (
+        balance_id      CHAR(64)      NOT NULL,
+        inventory_kind  VARCHAR(50)   NULL,
+        balance_date    DATE          NOT NULL,
+        warehouse_id    INT           NULL,
+        warehouse_code  NVARCHAR(200) COLLATE {collation} NULL,
+        product_code    NVARCHAR(100) COLLATE {collation} NULL,
+        product_barcode NVARCHAR(100) COLLATE {collation} NULL,
+        product_id      NVARCHAR(50)  COLLATE {collation} NULL,
+        card_code       NVARCHAR(100) COLLATE {collation} NULL,
+        expiry_date     DATE          NULL,
+        serial_number   NVARCHAR(100) COLLATE {collation} NULL,
+        batch_number    NVARCHAR(100) COLLATE {collation} NULL,
+        quantity        DECIMAL(18,4) NULL,
+        measure_code    NVARCHAR(50)  COLLATE {collation} NULL,
+        input_price     DECIMAL(18,4) NULL,
+        filial_id       INT           NULL,
+        filial_code     NVARCHAR(100) COLLATE {collation} NULL,
+        CONSTRAINT PK_FactBalanceMonthly PRIMARY KEY CLUSTERED (balance_date, balance_id)
+    ) ON {PARTITION_SCHEME}(balance_date);
+END
+IF OBJECT_ID('{MONTHLY_CONDITION_TABLE}', 'U') IS NULL
+    CREATE TABLE {MONTHLY_CONDITION_TABLE} (
+        balance_date      DATE         NOT NULL,
+        balance_id        CHAR(64)     NOT NULL,
+        product_condition NVARCHAR(50) COLLATE {collation} NOT NULL,
+        CONSTRAINT PK_BalanceConditionMonthly PRIMARY KEY CLUSTERED (balance_date, balance_id, product_condition)
+    ) ON {PARTITION_SCHEME}(balance_date);
+""")
+    for part in PARTS:
+        for name, cols in part.indexes:
+            cursor.execute(f"""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{name}' AND object_id = OBJECT_ID('{part.table}'))
+    CREATE INDEX {name} ON {part.table}({cols}) ON {PARTITION_SCHEME}(balance_date);
+""")
+
+
+def ensure_boundaries(cursor, months):
+    """Каждому месяцу — своя секция: границы на 1-е число месяца и следующего (SPLIT пустого хвоста)."""
+    cursor.execute(f"""
+SELECT CAST(v.value AS DATE)
+FROM sys.partition_range_values AS v
+JOIN sys.partition_functions AS f ON f.function_id = v.function_id
+WHERE f.name = '{PARTITION_FUNCTION}'
+""")
+    known = {row[0] for row in cursor.fetchall()}
+    wanted = sorted({m for month in months for m in (month, next_month(month))} - known)
+    for boundary in wanted:
+        cursor.execute(f"""
+ALTER PARTITION SCHEME {PARTITION_SCHEME} NEXT USED {FILEGROUP};
+ALTER PARTITION FUNCTION {PARTITION_FUNCTION}() SPLIT RANGE ('{boundary.isoformat()}');
+""")
+    if wanted:
+        print(f"🧱 Новые границы секций: {', '.join(b.strftime('%m.%Y') for b in wanted)}")
+
+
+# ====== LOAD ======
+def take_applock(cursor):
+    """До commit текущей транзакции; повторный вызов в той же транзакции не блокирует."""
+    cursor.execute("EXEC sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Transaction';",
+                   APPLOCK)
+
+
+def split_by_month(fact_rows, condition_rows):
+    """
+    {месяц: (fact_rows, condition_rows)}; строки без даты пропускаются.
+    Дубли balance_id — последняя строка, как при MERGE по PK.
+    condition_rows получают balance_date впереди (порядок колонок BalanceConditionMonthly).
+    """
+    months, dates, skipped = {}, {}, 0
+    for row in fact_rows:
+        d = row[2]
+        if d is None:
+            skipped += 1
+            continue
+        if isinstance(d, datetime):
+            d = d.date()
+            row = (*row[:2], d, *row[3:])
+        dates[row[0]] = d
+        months.setdefault(month_start(d), ({}, set()))[0][row[0]] = row
+    for balance_id, cond in condition_rows:
+        d = dates.get(balance_id)
+        if d is not None:
+            months[month_start(d)][1].add((d, balance_id, cond))
+    return {m: (list(f.values()), sorted(c)) for m, (f, c) in months.items()}, skipped
+
+
+def _rebuild(cursor, part: Part, month: date, partition: int):
+    m_from, m_to = month.isoformat(), next_month(month).isoformat()
+    short = part.stage.split(".")[-1]
+    key_join = " AND ".join(f"s.{c} = t.{c}" for c in part.key)
+    pk = ", ".join(["balance_date"] + part.key)
+    index_sql = "\n".join(f"CREATE INDEX {name} ON {part.stage}({cols});" for name, cols in part.indexes)
+    # stage создаётся в этом же пакете — ALTER/INDEX отдельными вызовами, после его появления
+    cursor.execute(f"""
+IF OBJECT_ID('{part.stage}', 'U') IS NOT NULL DROP TABLE {part.stage};
+SELECT TOP 0 * INTO {part.stage} FROM {part.table};
+""")
+    cursor.execute(f"""
+INSERT INTO {part.stage} WITH (TABLOCK)
+SELECT * FROM {part.tmp} WHERE balance_date >= '{m_from}' AND balance_date < '{m_to}';
+
+-- старые строки месяца, которых нет среди новых, сохраняются
+INSERT INTO {part.stage} WITH (TABLOCK)
+SELECT t.* FROM {part.table} AS t
+WHERE t.balance_date >= '{m_from}' AND t.balance_date < '{m_to}'
+  AND NOT EXISTS (SELECT 1 FROM {part.tmp} AS s WHERE {key_join});
+""")
+    cursor.execute(f"""
+ALTER TABLE {part.stage} ADD CONSTRAINT PK_{short} PRIMARY KEY CLUSTERED ({pk});
+{index_sql}
+ALTER TABLE {part.stage} WITH CHECK ADD CONSTRAINT CK_{short}_Month
+    CHECK (balance_date >= '{m_from}' AND balance_date < '{m_to}' AND balance_date IS NOT NULL);
+""")
+    cursor.execute(f"""
+TRUNCATE TABLE {part.table} WITH (PARTITIONS ({partition}));
+ALTER TABLE {part.stage} SWITCH TO {part.table} PARTITION {partition};
+DROP TABLE {part.stage};
+""")
+
+
+def load_monthly(cursor, fact_rows, condition_rows, commit_each: bool = True) -> int:
+    """
+    Каждый месяц: temp -> staging (новые + старые строки) -> индексы -> SWITCH.
+    commit_each=True — commit после каждого месяца (cursor.connection), иначе — за вызывающим.
+    Возвращает число пересобранных месяцев.
+    """
+    with span("transform", rows=len(fact_rows)):
+        months, skipped = split_by_month(fact_rows, condition_rows)
+    if skipped:
+        print(f"⚠️ Без даты {skipped} строк — в секции не попали")
+    if not months:
+        return 0
+    # блокировка до SPLIT RANGE: два загрузчика иначе делят одну и ту же границу
+    take_applock(cursor)
+    ensure_boundaries(cursor, months)
+
+    for month in sorted(months):
+        m_fact, m_cond = months[month]
+        take_applock(cursor)  # после commit предыдущего месяца блокировка снята
+        for part in PARTS:
+            cursor.execute(f"IF OBJECT_ID('tempdb..{part.tmp}') IS NOT NULL DROP TABLE {part.tmp}; "
+                           f"SELECT TOP 0 * INTO {part.tmp} FROM {part.table};")
+        with span("stage", rows=len(m_fact) + len(m_cond)), timed(f"stage {month:%m.%Y}"):
+            cursor.fast_executemany = True
+            cursor.executemany(f"INSERT INTO {PARTS[0].tmp} VALUES ({','.join('?' * 17)})", m_fact)
+            if m_cond:
+                cursor.executemany(f"INSERT INTO {PARTS[1].tmp} VALUES (?,?,?)", m_cond)
+
+        cursor.execute(f"SELECT $PARTITION.{PARTITION_FUNCTION}(?)", month)
+        partition = int(cursor.fetchone()[0])
+        with span("merge", rows=len(m_fact) + len(m_cond)), timed(f"switch {MONTHLY_FACT_TABLE} {month:%m.%Y}"):
+            for part in PARTS:
+                _rebuild(cursor, part, month, partition)
+        cursor.execute(" ".join(f"DROP TABLE {part.tmp};" for part in PARTS))
+        if commit_each:
+            with span("commit"):
+                cursor.connection.commit()
+        print(f"🔁 {month:%m.%Y} (секция {partition}): +Fact:{len(m_fact)}, +Cond:{len(m_cond)}")
+    return len(months)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+dbo.BalanceData: ключевые колонки ограниченной длины + индексы под MERGE.
+
+safe.py  MERGE ON (warehouse_id, product_code, [date], batch_number)
+api.py   MERGE ON ([date], product_code, warehouse_code)
+
+NVARCHAR(MAX) нельзя индексировать, поэтому без этого шага каждый MERGE —
+полный скан BalanceData.
+
+stage_rows(): #TempBalanceData с NVARCHAR(n) вместо MAX и setinputsizes —
+с MAX-колонками fast_executemany передаёт значения потоком (data-at-execution)
+и держит буферы под максимальный размер. Строки длиннее лимита идут отдельно,
+в #...Overflow с MAX-колонками, обычным executemany.
+
+pyodbc импортируется только в staging_plan: safe.py и api.py импортируют модуль
+и там, где драйвера ODBC нет (как db.py).
+"""
+TABLE_NAME = "dbo.BalanceData"
+
+# Размеры как в dbo.FactBalance (balance_data.py)
+KEY_COLUMNS = {
+    "warehouse_code": 200,
+    "product_code": 100,
+    "batch_number": 100,
+}
+
+# имя индекса -> ключевые колонки
+MERGE_INDEXES = {
+    "IX_BalanceData_Wh_Product_Date_Batch": ["warehouse_id", "product_code", "[date]", "batch_number"],
+    "IX_BalanceData_Date_Product_WhCode": ["[date]", "product_code", "warehouse_code"],
+}
+
+
+# Размеры текстовых колонок staging (как в dbo.FactBalance); прочие — по данным
+STAGING_TEXT_SIZES = {
+    **KEY_COLUMNS,
+    "inventory_kind": 50,
+    "product_barcode": 100,
+    "product_id": 50,
+    "card_code": 100,
+    "serial_number": 100,
+    "measure_code": 50,
+    "filial_code": 100,
+    "group_code": 100,
+    "type_code": 200,
+}
+MAX_BOUNDED = 4000  # больше — только NVARCHAR(MAX)
+
+
+def _sql_types(pyodbc) -> dict:
+    """Объявленный тип не-текстовой колонки -> тип параметра."""
+    return {
+        "DATE": (pyodbc.SQL_TYPE_DATE, 0, 0),
+        "INT": (pyodbc.SQL_INTEGER, 0, 0),
+        "FLOAT": (pyodbc.SQL_DOUBLE, 0, 0),
+    }
+
+
+def _column_info(cursor, table_name, col):
+    cursor.execute("""
+        SELECT c.max_length, c.collation_name, c.is_nullable
+        FROM sys.columns c
+        WHERE c.object_id = OBJECT_ID(?) AND c.name = ?
+    """, table_name, col)
+    return cursor.fetchone()
+
+
+def _index_exists(cursor, table_name, index_name) -> bool:
+    cursor.execute(
+        "SELECT 1 FROM sys.indexes WHERE name = ? AND object_id = OBJECT_ID(?)",
+        index_name, table_name)
+    return cursor.fetchone() is not None
+
+
+def ensure_balancedata_keys(cursor, table_name: str = TABLE_NAME):
+    """
+    1) NVARCHAR(MAX) ключевые колонки -> NVARCHAR(n) (если данные помещаются)
+    2) индексы под предикаты MERGE из safe.py и api.py
+    Повторный запуск ничего не меняет.
+    Возвращает ключевые колонки, оставшиеся NVARCHAR(MAX).
+    """
+    cursor.execute("SELECT OBJECT_ID(?, 'U')", table_name)
+    if cursor.fetchone()[0] is None:
+        print(f"ℹ️ {table_name} не найдена — пропускаем настройку ключей")
+        return set()
+
+    still_max = set()
+    for col, size in KEY_COLUMNS.items():
+        info = _column_info(cursor, table_name, col)
+        if info is None:
+            continue
+        max_length, collation, is_nullable = info
+        if max_length != -1:
+            continue  # уже ограничена
+
+        # LEN не считает хвостовые пробелы; DATALENGTH — байты NVARCHAR (2 на символ)
+        cursor.execute(f"SELECT MAX(DATALENGTH([{col}])) / 2 FROM {table_name}")
+        longest = cursor.fetchone()[0] or 0
+        if longest > size:
+            print(f"⚠️ {table_name}.{col}: есть значения длиной {longest} > {size}, колонка остаётся MAX")
+            still_max.add(col)
+            continue
+
+        collate = f" COLLATE {collation}" if collation else ""
+        null_sql = "NULL" if is_nullable else "NOT NULL"
+        cursor.execute(f"ALTER TABLE {table_name} ALTER COLUMN [{col}] NVARCHAR({size}){collate} {null_sql}")
+        print(f"🔧 {table_name}.{col}: NVARCHAR(MAX) → NVARCHAR({size})")
+
+    for index_name, cols in MERGE_INDEXES.items():
+        if _index_exists(cursor, table_name, index_name):
+            continue
+        blocked = still_max.intersection(cols)
+        if blocked:
+            print(f"⚠️ {index_name} не создан: {', '.join(sorted(blocked))} остаются NVARCHAR(MAX)")
+            continue
+        cursor.execute(f"CREATE INDEX {index_name} ON {table_name}({', '.join(cols)})")
+        print(f"🔧 Создан индекс {index_name}")
+    return still_max
+
+
+# ====== STAGING ======
+def _bare(col: str) -> str:
+    return col.strip("[]")
+
+
+def _text_size(col: str, rows, i: int) -> int:
+    """Объявленный размер или наблюдаемый максимум, округлённый вверх до 50/100/200/..."""
+    size = STAGING_TEXT_SIZES.get(_bare(col))
+    if size is not None:
+        return size
+    longest = max((len(r[i]) for r in rows if isinstance(r[i], str)), default=0)
+    size = 50
+    while size < longest and size < MAX_BOUNDED:
+        size *= 2
+    return min(size, MAX_BOUNDED)
+
+
+def staging_plan(columns: dict, rows):
+    """
+    columns: {колонка: "TEXT" | "DATE" | "INT" | "FLOAT"} в порядке кортежей rows.
+    Возвращает [(колонка, тип, размер, input size)] для CREATE TABLE и setinputsizes.
+    """
+    import pyodbc
+
+    sql_types = _sql_types(pyodbc)
+    plan = []
+    for i, (col, kind) in enumerate(columns.items()):
+        if kind == "TEXT":
+            size = _text_size(col, rows, i)
+            plan.append((col, kind, size, (pyodbc.SQL_WVARCHAR, size, 0)))
+            continue
+        sample = next((r[i] for r in rows if r[i] is not None), None)
+        if isinstance(sample, str):
+            # строка в DATE/INT (например, дата из JSON как есть): конвертирует сервер, как и раньше
+            size = min(max(len(r[i]) for r in rows if isinstance(r[i], str)), MAX_BOUNDED)
+            plan.append((col, kind, 0, (pyodbc.SQL_WVARCHAR, size, 0)))
+        else:
+            plan.append((col, kind, 0, sql_types[kind]))
+    return plan
+
+
+def _columns_sql(plan, collation: str = None, bounded: bool = True) -> str:
+    collate = f" COLLATE {collation}" if collation else ""
+    parts = []
+    for col, kind, size, _ in plan:
+        if kind == "TEXT":
+            parts.append(f"{col} NVARCHAR({size if bounded else 'MAX'}){collate}")
+        else:
+            parts.append(f"{col} {kind}")
+    return ", ".join(parts)
+
+
+def split_overlong(rows, plan):
+    """(строки в пределах размеров, строки длиннее хотя бы одной TEXT-колонки)."""
+    limits = [(i, size) for i, (_, kind, size, _) in enumerate(plan) if kind == "TEXT"]
+    fit, overlong = [], []
+    for r in rows:
+        if any(isinstance(r[i], str) and len(r[i]) > size for i, size in limits):
+            overlong.append(r)
+        else:
+            fit.append(r)
+    return fit, overlong
+
+
+def stage_rows(cursor, temp: str, columns: dict, rows, collation: str = None, bounded_keys=()) -> str:
+    """
+    Создаёт temp (NVARCHAR(n)) и грузит rows через fast_executemany + setinputsizes.
+    Длинные строки — в {temp}Overflow (NVARCHAR(MAX)); если длинное значение в ключевой
+    колонке, которая в BalanceData ограничена (bounded_keys), строку сохранить нельзя — пропуск.
+    Возвращает источник для MERGE USING: temp или (temp UNION ALL overflow).
+    """
+    plan = staging_plan(columns, rows)
+    fit, overlong = split_overlong(rows, plan)
+    key_limits = [(i, size) for i, (col, _, size, _) in enumerate(plan) if _bare(col) in bounded_keys]
+    kept = [r for r in overlong if not any(isinstance(r[i], str) and len(r[i]) > size for i, size in key_limits)]
+    if len(kept) < len(overlong):
+        print(f"⚠️ {len(overlong) - len(kept)} строк пропущено: ключ длиннее колонки {TABLE_NAME}")
+    overlong = kept
+
+    placeholders = ",".join("?" * len(plan))
+    cursor.execute(f"IF OBJECT_ID('tempdb..{temp}') IS NOT NULL DROP TABLE {temp};")
+    cursor.execute(f"CREATE TABLE {temp} ({_columns_sql(plan, collation)});")
+    cursor.fast_executemany = True
+    cursor.setinputsizes([p[3] for p in plan])
+    if fit:
+        cursor.executemany(f"INSERT INTO {temp} VALUES ({placeholders})", fit)
+    cursor.setinputsizes(None)
+    if not overlong:
+        return temp
+
+    overflow = f"{temp}Overflow"
+    print(f"ℹ️ {len(overlong)} строк длиннее лимитов staging → {overflow}")
+    cursor.execute(f"IF OBJECT_ID('tempdb..{overflow}') IS NOT NULL DROP TABLE {overflow};")
+    cursor.execute(f"CREATE TABLE {overflow} ({_columns_sql(plan, collation, bounded=False)});")
+    cursor.fast_executemany = False
+    cursor.executemany(f"INSERT INTO {overflow} VALUES ({placeholders})", overlong)
+    cursor.fast_executemany = True
+    return f"(SELECT * FROM {temp} UNION ALL SELECT * FROM {overflow})"
+
+
+def drop_staging(cursor, temp: str):
+    cursor.execute(f"IF OBJECT_ID('tempdb..{temp}') IS NOT NULL DROP TABLE {temp}; "
+                   f"IF OBJECT_ID('tempdb..{temp}Overflow') IS NOT NULL DROP TABLE {temp}Overflow;")
@@ -0,0 +1,132 @@
+"""
+MERGE в BalanceData до и после balancedata_schema.ensure_balancedata_keys.
+
+Создаёт dbo.BalanceData_Bench (NVARCHAR(MAX), как сейчас в проде), заполняет
+её синтетикой на стороне сервера, и замеряет оба MERGE (safe.py и api.py)
+до и после перехода на ограниченные ключи + индексы.
+Каждый MERGE выполняется в транзакции с ROLLBACK, чтобы замеры были сравнимы.
+
+Запуск:
+  set BENCH_ODBC=DRIVER={ODBC Driver 18 for SQL Server};SERVER=localhost;DATABASE=BenchDB;Trusted_Connection=Yes;TrustServerCertificate=Yes;
+  python benchmarks/bench_balancedata_merge.py [target_rows] [source_rows]
+"""
+import os
+import sys
+import time
+
+import pyodbc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from balancedata_schema import ensure_balancedata_keys  # noqa: E402
+
+BENCH_TABLE = "dbo.BalanceData_Bench"
+
+
+def setup(cur, target_rows):
+    cur.execute(f"IF OBJECT_ID('{BENCH_TABLE}', 'U') IS NOT NULL DROP TABLE {BENCH_TABLE};")
+    cur.execute(f"""
+CREATE TABLE {BENCH_TABLE} (
+    inventory_kind NVARCHAR(MAX), [date] DATE, warehouse_id INT,
+    warehouse_code NVARCHAR(MAX), product_code NVARCHAR(MAX), product_barcode NVARCHAR(MAX),
+    product_id NVARCHAR(MAX), card_code NVARCHAR(MAX), expiry_date DATE,
+    serial_number NVARCHAR(MAX), batch_number NVARCHAR(MAX), quantity FLOAT,
+    measure_code NVARCHAR(MAX), input_price FLOAT, filial_id INT, filial_code NVARCHAR(MAX)
+);""")
+    # n -> (склад, товар, партия, дата) — генерируем на сервере
+    cur.execute(f"""
+WITH n AS (
+    SELECT TOP ({int(target_rows)}) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS i
+    FROM sys.all_objects a CROSS JOIN sys.all_objects b CROSS JOIN sys.all_objects c
+)
+INSERT INTO {BENCH_TABLE} WITH (TABLOCK)
+SELECT N'T', DATEADD(DAY, i % 365, '2025-01-01'), 65461 + i % 7,
+       CASE WHEN i % 7 = 0 THEN N'Брак' ELSE N'MARKAZ' + CAST(i % 7 AS NVARCHAR(10)) END,
+       N'P' + CAST((i / 365) % 50000 AS NVARCHAR(20)), N'4780' + CAST(i AS NVARCHAR(20)),
+       CAST((i / 365) % 50000 AS NVARCHAR(20)), N'C1', NULL, NULL,
+       N'B' + CAST(i / (365 * 50000) AS NVARCHAR(20)), i % 500, N'шт', 1000.0, 9161160, N'9161160'
+FROM n;""")
+    cur.commit()
+
+
+def make_source(cur, source_rows):
+    # половина совпадает с целевой таблицей, половина — новые даты
+    cur.execute("IF OBJECT_ID('tempdb..#Src') IS NOT NULL DROP TABLE #Src;")
+    cur.execute(f"SELECT TOP 0 * INTO #Src FROM {BENCH_TABLE};")
+    half = int(source_rows) // 2
+    cur.execute(f"INSERT INTO #Src SELECT TOP ({half}) * FROM {BENCH_TABLE} ORDER BY [date] DESC;")
+    cur.execute(f"""
+INSERT INTO #Src
+SELECT TOP ({half}) inventory_kind, DATEADD(YEAR, 5, [date]), warehouse_id, warehouse_code, product_code,
+       product_barcode, product_id, card_code, expiry_date, serial_number, batch_number, quantity,
+       measure_code, input_price, filial_id, filial_code
+FROM {BENCH_TABLE};""")
+    cur.commit()
+
+
+MERGE_SAFE = f"""
+MERGE {BENCH_TABLE} AS target
+USING #Src AS source
+ON target.warehouse_id = source.warehouse_id
+   AND target.product_code = source.product_code
+   AND target.[date] = source.[date]
+   AND target.batch_number = source.batch_number
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT ([date], warehouse_id, warehouse_code, product_code, batch_number, quantity)
+    VALUES (source.[date], source.warehouse_id, source.warehouse_code, source.product_code,
+            source.batch_number, source.quantity);
+"""
+
+MERGE_API = f"""
+MERGE {BENCH_TABLE} AS target
+USING #Src AS src
+ON target.[date] = src.[date]
+   AND target.product_code = src.product_code
+   AND target.warehouse_code = src.warehouse_code
+WHEN MATCHED THEN UPDATE SET target.quantity = src.quantity
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT ([date], warehouse_id, warehouse_code, product_code, batch_number, quantity)
+    VALUES (src.[date], src.warehouse_id, src.warehouse_code, src.product_code,
+            src.batch_number, src.quantity);
+"""
+
+
+def timed_merge(cur, sql):
+    t0 = time.perf_counter()
+    cur.execute(sql)
+    dt = time.perf_counter() - t0
+    cur.rollback()
+    return dt
+
+
+def run(cur, label):
+    for name, sql in (("safe.py MERGE", MERGE_SAFE), ("api.py MERGE", MERGE_API)):
+        print(f"{label:7s} {name:14s} {timed_merge(cur, sql):8.2f} s")
+
+
+def main():
+    target_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    source_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    conn = pyodbc.connect(os.environ["BENCH_ODBC"], autocommit=False)
+    cur = conn.cursor()
+
+    print(f"target={target_rows} rows, source={source_rows} rows")
+    setup(cur, target_rows)
+    make_source(cur, source_rows)
+    run(cur, "before")
+
+    ensure_balancedata_keys(cur, BENCH_TABLE)
+    conn.commit()
+    # #Src тоже с ограниченными ключами, как в safe.py/api.py
+    cur.execute("SELECT * INTO #Src2 FROM #Src; DROP TABLE #Src;")
+    cur.execute(f"SELECT TOP 0 * INTO #Src FROM {BENCH_TABLE}; INSERT INTO #Src SELECT * FROM #Src2; DROP TABLE #Src2;")
+    conn.commit()
+    run(cur, "after")
+
+    cur.execute(f"DROP TABLE {BENCH_TABLE};")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Время импорта загрузчиков (python -X importtime).
+
+Для каждого модуля запускает отдельный интерпретатор с -X importtime,
+суммирует cumulative-время верхнего уровня и показывает самые тяжёлые
+пакеты. Так видно, что selenium / webdriver_manager / pandas / sqlalchemy
+больше не грузятся при старте скрипта.
+
+Запуск:  python benchmarks/bench_importtime.py [module ...]
+"""
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOADERS = ["inventory", "order_group", "return_smart", "new_return", "ishonchsavdo", "run_all"]
+HEAVY = ["pandas", "selenium", "webdriver_manager", "sqlalchemy", "bs4", "numpy"]
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def importtime(module: str):
+    """-> (total_us, {top_level_package: cumulative_us}) либо (None, stderr)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, encoding="utf-8",
+    )
+    if proc.returncode != 0:
+        return None, proc.stderr.strip().splitlines()[-1:]
+
+    per_pkg = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        cumulative, indent, name = int(m.group(2)), len(m.group(3)), m.group(4)
+        if indent == 1:  # импорт верхнего уровня
+            total += cumulative
+            pkg = name.split(".")[0]
+            per_pkg[pkg] = per_pkg.get(pkg, 0) + cumulative
+    return total, per_pkg
+
+
+def main():
+    modules = sys.argv[1:] or LOADERS
+    print(f"{'module':14s} {'total ms':>9s}   heavy packages loaded at import")
+    for module in modules:
+        total, per_pkg = importtime(module)
+        if total is None:
+            print(f"{module:14s} {'error':>9s}   {per_pkg}")
+            continue
+        heavy = [f"{p}={per_pkg[p] / 1000:.0f}ms" for p in HEAVY if p in per_pkg]
+        print(f"{module:14s} {total / 1000:9.1f}   {', '.join(heavy) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+inventory.py: старый разбор (json_normalize + три цикла с мутацией) vs
+extract_inventory() в DataFrame и в Arrow на синтетическом каталоге.
+
+Запуск:  python benchmarks/bench_inventory_extract.py [products]
+"""
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory  # noqa: E402
+from synthetic import inventory_items  # noqa: E402
+
+
+def legacy_extract(items):
+    """Копия исходного разбора из inventory.fetch_inventory."""
+    pd = inventory._pandas()
+    inv_df = pd.json_normalize(items, sep="_", max_level=1)
+    groups_list, kinds_list, sectors_list = [], [], []
+    for it in items:
+        pid = it.get("product_id")
+        for g in it.get("groups", []):
+            g["product_id"] = pid
+            groups_list.append(g)
+        for k in it.get("inventory_kinds", []):
+            k["product_id"] = pid
+            kinds_list.append(k)
+        for s in it.get("sector_codes", []):
+            s["product_id"] = pid
+            sectors_list.append(s)
+    return {
+        "inventory_main": inv_df,
+        "inventory_groups": pd.DataFrame(groups_list),
+        "inventory_kinds": pd.DataFrame(kinds_list),
+        "inventory_sectors": pd.DataFrame(sectors_list),
+    }
+
+
+def measure(fn, make_input, repeat=3):
+    best = None
+    for _ in range(repeat):
+        data = make_input()
+        t0 = time.perf_counter()
+        fn(data)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    data = make_input()
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    n_products = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    catalog = inventory_items(n_products)
+
+    # старый код меняет dict внутри items — ему каждый раз свежая копия
+    fresh = lambda: copy.deepcopy(catalog)  # noqa: E731
+    same = lambda: catalog  # noqa: E731
+
+    old = legacy_extract(fresh())
+    new = inventory.extract_inventory(catalog)
+    for table in old:
+        assert list(old[table].columns) == list(new[table].columns), table
+        # в старом варианте списки groups/... внутри main уже с product_id (мутация)
+        cols = [c for c in old[table].columns if c not in inventory.CHILD_TABLES.values()]
+        assert old[table][cols].astype(str).equals(new[table][cols].astype(str)), table
+
+    variants = [("legacy", legacy_extract, fresh),
+                ("extract", inventory.extract_inventory, same)]
+    try:
+        import pyarrow  # noqa: F401
+        variants.append(("extract arrow", lambda items: inventory.extract_inventory(items, arrow=True), same))
+    except ImportError:
+        print("pyarrow не установлен — вариант arrow пропущен")
+
+    print(f"products={n_products}")
+    for name, fn, make_input in variants:
+        sec, peak = measure(fn, make_input)
+        print(f"{name:14s} {sec * 1000:9.1f} ms   peak {peak / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
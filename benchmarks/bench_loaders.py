@@ -0,0 +1,191 @@
+"""
+Сквозной замер загрузчиков против локального mock smartup.online.
+
+HTTP идёт в mock_smartup (задержка, лимит элементов, доля 503 настраиваются),
+SQL — в заменители из fake_db: pyodbc-загрузчики (balance_data, api) пишут в
+считающий курсор, pandas-загрузчики (order_group, new_return) — в sqlite в памяти.
+После каждого загрузчика проверяется, что строки действительно записаны
+(загрузчики глотают ошибки SQL) — иначе статус failed и код выхода 1.
+inventory замеряется до upload (его MERGE — T-SQL). api_group не входит:
+он сам читает свои конфиги и строит запросы к группам.
+
+Запуск:
+  python benchmarks/bench_loaders.py [--scale 1.0] [--latency 0.05] [--limit 7900]
+                                     [--workers 4] [--loaders balance_data,api,order_group,new_return,inventory]
+                                     [--profile [sample|cprofile]] [--tracemalloc [FRAMES]]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+# журналы неудачных окон и отчёты — рядом с бенчмарком, не в рабочих каталогах загрузчиков
+# (по умолчанию они лежат рядом с модулями); до импорта fetch_retry / run_report
+os.environ.setdefault("FETCH_JOURNAL_DIR", os.path.join(HERE, ".fetch_journal"))
+os.environ.setdefault("RUN_REPORT_DIR", os.path.join(HERE, ".run_reports"))
+
+import mock_smartup  # noqa: E402
+import synthetic  # noqa: E402
+from fake_db import FakeConnection, sqlite_engine  # noqa: E402
+
+import profiling  # noqa: E402
+import run_report  # noqa: E402
+from http_transport import make_session, print_transfer_stats  # noqa: E402
+from rate_limit import SMARTUP  # noqa: E402
+
+LOADERS = ["balance_data", "api", "order_group", "new_return", "inventory"]
+
+
+class LoadCheckError(AssertionError):
+    pass
+
+
+def recording_connect(connections: list):
+    """connect_sql, запоминающий подключения — для проверки, что строки дошли до executemany."""
+    def connect(*args, **kwargs):
+        conn = FakeConnection()
+        connections.append(conn)
+        return conn
+    return connect
+
+
+def check_staged(name, connections, rows):
+    staged = sum(c.rows_staged for c in connections)
+    committed = sum(c.commits for c in connections)
+    if rows and (not staged or not committed):
+        raise LoadCheckError(f"{name}: {rows} строк получено, но записано {staged}, commit {committed}")
+
+
+def check_sqlite(name, engine, tables, rows):
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(engine)
+    with engine.connect() as conn:
+        stored = sum(conn.execute(text(f'SELECT COUNT(*) FROM "{t}"')).scalar()
+                     for t in tables if inspector.has_table(t))
+    if stored != rows:
+        raise LoadCheckError(f"{name}: ожидалось {rows} строк в sqlite ({', '.join(tables)}), есть {stored}")
+
+
+def bench_balance_data(base_url, scale, session):
+    import balance_data
+
+    connections = []
+    balance_data.URL = f"{base_url}/b/anor/mxsx/mkw/balance$export"
+    balance_data.connect_sql = recording_connect(connections)
+    warehouses = synthetic.filial_warehouses(max(1, int(3 * scale)))
+    rows = balance_data.main(warehouses, ["T", "B"], session=session)
+    check_staged("balance_data", connections, rows)
+    return rows
+
+
+def bench_api(base_url, scale, session):
+    import api
+
+    connections = []
+    api.URL = f"{base_url}/b/anor/mxsx/mdeal/return$export"
+    api.connect_sql = recording_connect(connections)
+    warehouses = synthetic.filial_warehouses(max(1, int(2 * scale)))
+    rows = api.fetch_balance_chunks(warehouses, date(2025, 1, 1), date(2025, 6, 30))
+    api.load_to_sql(rows)
+    check_staged("api", connections, len(rows))
+    return len(rows)
+
+
+def bench_order_group(base_url, scale, session):
+    import order_group
+
+    engine = sqlite_engine()
+    order_group.get_engine = lambda *a, **kw: engine
+    url = f"{base_url}/b/trade/txs/tdeal/order$export"
+    rows = 0
+    end = date(2025, 1, 1) + timedelta(days=max(31, int(90 * scale)))
+    for date_from, date_to in order_group.month_ranges(date(2025, 1, 1), end):
+        for df_dict in order_group.safe_fetch(url, None, date_from, date_to, session=session):
+            order_group.upload_to_sql(df_dict)
+            rows += sum(len(df) for df in df_dict.values())
+    check_sqlite("order_group", engine, ["order_main", "order_products", "order_details"], rows)
+    return rows
+
+
+def bench_new_return(base_url, scale, session):
+    import new_return
+    import return_windows
+
+    engine = sqlite_engine()
+    new_return.get_engine = lambda *a, **kw: engine
+    new_return.DATA_URL = f"{base_url}/b/anor/mxsx/mdeal/return$export"
+    rows = new_return.main(session=session)
+    check_sqlite("new_return", engine, list(return_windows.RETURN_KEYS), rows)
+    return rows
+
+
+def bench_inventory(base_url, scale, session):
+    import inventory
+
+    result = inventory.fetch_inventory(f"{base_url}/b/anor/mxsx/mr/inventory$export", None, session=session)
+    return sum(len(df) for df in result.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк загрузчиков на mock smartup")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель объёма данных")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--limit", type=int, default=7900)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--loaders", default=",".join(LOADERS))
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = mock_smartup.start(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        limit=args.limit,
+        balance_items=int(500 * args.scale),
+        returns=int(2000 * args.scale),
+        orders_per_day=int(40 * args.scale),
+        inventory=int(5000 * args.scale),
+    )
+    print(f"🧪 mock smartup: {server.base_url}  scale={args.scale} latency={args.latency}s limit={args.limit}")
+
+    session = make_session(args.workers)
+    results = []
+    for name in [n.strip() for n in args.loaders.split(",") if n.strip()]:
+        bench = globals().get(f"bench_{name}")
+        if bench is None:
+            print(f"⚠️ Неизвестный загрузчик: {name}")
+            continue
+        print(f"\n▶️ {name}")
+        t0 = time.perf_counter()
+        try:
+            with run_report.loader(name):
+                rows = bench(server.base_url, args.scale, session)
+            status = "ok"
+        except Exception as e:
+            rows, status = 0, f"failed: {e}"
+        results.append((name, rows or 0, time.perf_counter() - t0, status))
+
+    server.shutdown()
+    print("\n📊 Итого:")
+    print(f"   {'loader':14s} {'rows':>10s} {'seconds':>9s} {'rows/s':>10s}  status")
+    for name, rows, seconds, status in results:
+        print(f"   {name:14s} {rows:10d} {seconds:9.2f} {rows / seconds if seconds else 0:10.0f}  {status}")
+    stats = server.stats
+    print(f"   mock: {sum(stats.requests.values())} запросов, {stats.bytes_sent / 1e6:.1f} MB, "
+          f"{stats.errors} ответов 503")
+    run_report.print_report()
+    print_transfer_stats()
+    SMARTUP.print_metrics()
+    if any(status != "ok" for *_, status in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
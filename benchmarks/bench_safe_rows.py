@@ -0,0 +1,104 @@
+"""
+safe.py: старый двойной цикл vs build_rows / build_columns на синтетических данных.
+
+Запуск:  python benchmarks/bench_safe_rows.py [items] [groups_per_item]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import safe  # noqa: E402
+
+
+def make_items(n_items, n_groups, seed=42):
+    rnd = random.Random(seed)
+    items = []
+    for i in range(n_items):
+        items.append({
+            "inventory_kind": "T",
+            "date": "2025-03-%02d" % (i % 28 + 1),
+            "warehouse_id": str(65461 + i % 7),
+            "warehouse_code": "Брак" if i % 5 == 0 else "MARKAZ",
+            "product_code": "P%06d" % i,
+            "product_barcode": "4780%09d" % i,
+            "product_id": str(100000 + i),
+            "card_code": "C%d" % (i % 300),
+            "expiry_date": "2026-01-01",
+            "serial_number": None,
+            "batch_number": "B%d" % (i % 50),
+            "quantity": str(rnd.randint(1, 500)),
+            "measure_code": "шт",
+            "input_price": "%.2f" % (rnd.random() * 10000),
+            "filial_id": "9161160",
+            "filial_code": "9161160",
+            "groups": [{"group_code": "G%d" % g, "type_code": "TYPE%d" % (g % 3)} for g in range(n_groups)],
+        })
+    return items
+
+
+def legacy_rows(data):
+    """Копия исходного цикла из safe.py (до рефакторинга)."""
+    rows = []
+    for item in data:
+        groups = item.get("groups", [])
+        if not groups:
+            groups = [{"group_code": None, "type_code": None}]
+        for g in groups:
+            rows.append((
+                item.get("inventory_kind"),
+                item.get("date"),
+                int(item["warehouse_id"]) if item.get("warehouse_id") else None,
+                item.get("warehouse_code"),
+                item.get("product_code"),
+                item.get("product_barcode"),
+                item.get("product_id"),
+                item.get("card_code"),
+                item.get("expiry_date"),
+                item.get("serial_number"),
+                item.get("batch_number"),
+                float(item["quantity"]) if item.get("quantity") else None,
+                item.get("measure_code"),
+                float(item["input_price"]) if item.get("input_price") else None,
+                int(item["filial_id"]) if item.get("filial_id") else None,
+                item.get("filial_code"),
+                g.get("group_code"),
+                g.get("type_code")
+            ))
+    return rows
+
+
+def measure(fn, data, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(data)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    n_groups = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    data = make_items(n_items, n_groups)
+
+    assert legacy_rows(data) == safe.build_rows(data)
+
+    print(f"items={n_items} groups/item={n_groups}")
+    for name, fn in (("legacy", legacy_rows),
+                     ("build_rows", safe.build_rows),
+                     ("build_columns", safe.build_columns)):
+        sec, peak = measure(fn, data)
+        print(f"{name:14s} {sec * 1000:9.1f} ms   peak {peak / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Заменители БД для бенчмарков без SQL Server.
+
+- FakeConnection: pyodbc-подобное подключение; execute/executemany ничего не
+  делают, но считают вызовы и строки (executemany материализует параметры,
+  как это делает pyodbc). SELECT OBJECT_ID(...) отвечает NULL — «таблицы нет».
+- sqlite_engine(): SQLAlchemy engine в памяти для загрузчиков на pandas.to_sql.
+
+Так измеряется клиентская часть (HTTP, JSON, подготовка строк), а не сервер.
+Для замеров самого SQL Server см. bench_balancedata_merge.py (BENCH_ODBC).
+"""
+import re
+
+_CANNED = [
+    (re.compile(r"^\s*SELECT\s+OBJECT_ID", re.I), (None,)),
+]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.connection = conn  # как pyodbc.Cursor.connection
+        self.fast_executemany = False
+        self.rowcount = -1
+        self._last = None
+
+    def execute(self, sql, *params):
+        self.conn.executes += 1
+        self._last = sql
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        rows = [tuple(p) for p in seq_of_params]
+        self.conn.executemany_calls += 1
+        self.conn.rows_staged += len(rows)
+        self.rowcount = len(rows)
+        return self
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def fetchone(self):
+        for pattern, row in _CANNED:
+            if self._last and pattern.search(self._last):
+                return row
+        return None
+
+    def fetchall(self):
+        return []
+
+    def __iter__(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executes = 0
+        self.executemany_calls = 0
+        self.rows_staged = 0
+        self.commits = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def sqlite_engine():
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+
+    return create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
@@ -0,0 +1,174 @@
+"""
+Локальная замена smartup.online для бенчмарков.
+
+Отдаёт balance$export, return$export, order$export и inventory$export
+(GET и POST, любой префикс пути) с синтетическими данными из synthetic.py:
+- latency / jitter — задержка ответа, секунды
+- limit — максимум элементов в ответе (как обрезка у настоящего API)
+- error_rate — доля ответов 503 (проверка повторов и rate limiter)
+- gzip, если клиент прислал Accept-Encoding: gzip
+
+Запуск отдельно:  python benchmarks/mock_smartup.py --port 8765 --latency 0.2
+Из кода:          server = start(latency=0.05); server.base_url ... server.shutdown()
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+
+DEFAULTS = {
+    "latency": 0.0,
+    "jitter": 0.0,
+    "limit": 7900,
+    "error_rate": 0.0,
+    "balance_items": 500,  # на одно окно (склад, период, состояние)
+    "returns": 2000,
+    "orders_per_day": 40,
+    "inventory": 5000,
+}
+
+PATHS = {
+    "balance$export": "balance",
+    "return$export": "return",
+    "order$export": "order",
+    "inventory$export": "inventory",
+}
+
+
+def _date(value, default):
+    if not value:
+        return default
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    return default
+
+
+def build_payload(kind: str, body: dict, cfg: dict) -> dict:
+    today = date.today()
+    if kind == "balance":
+        begin = _date(body.get("begin_date"), date(2025, 1, 1))
+        end = _date(body.get("end_date"), today)
+        warehouse = (body.get("warehouse_codes") or [{}])[0].get("warehouse_code", "MARKAZ")
+        condition = (body.get("product_conditions") or ["T"])[0]
+        return {"balance": synthetic.balance_items(cfg["balance_items"], warehouse, begin, end, condition)}
+    if kind == "return":
+        begin = _date(body.get("begin_date"), date(2025, 1, 1))
+        end = _date(body.get("end_date"), today)
+        return {"return": synthetic.return_items(cfg["returns"], begin, end)}
+    if kind == "order":
+        begin = _date(body.get("begin_deal_date"), today)
+        end = _date(body.get("end_deal_date"), today)
+        return {"order": synthetic.order_items(begin, end, cfg["orders_per_day"])}
+    return {"inventory": synthetic.inventory_items(cfg["inventory"])}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.errors = 0
+
+    def add(self, kind, sent, error=False):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_sent += sent
+            self.errors += error
+
+
+def make_handler(cfg: dict, stats: Stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def _serve(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            kind = PATHS.get(self.path.split("?")[0].rsplit("/", 1)[-1])
+            if kind is None:
+                self._send(404, b'{"error": "unknown export"}', "unknown")
+                return
+
+            delay = cfg["latency"] + random.uniform(0, cfg["jitter"])
+            if delay:
+                time.sleep(delay)
+            if cfg["error_rate"] and random.random() < cfg["error_rate"]:
+                self._send(503, b'{"error": "busy"}', kind, error=True)
+                return
+
+            try:
+                body = json.loads(raw.decode("utf-8")) if raw else {}
+            except ValueError:
+                body = {}
+            payload = build_payload(kind, body, cfg)
+            key = next(iter(payload))
+            payload[key] = payload[key][:cfg["limit"]]
+            self._send(200, json.dumps(payload, ensure_ascii=False).encode("utf-8"), kind)
+
+        def _send(self, status, data, kind, error=False):
+            headers = {"Content-Type": "application/json; charset=utf-8"}
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                data = gzip.compress(data, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            stats.add(kind, len(data), error)
+
+        do_GET = _serve
+        do_POST = _serve
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start(host: str = "127.0.0.1", port: int = 0, **config) -> ThreadingHTTPServer:
+    """Запускает сервер в фоновом потоке. server.base_url, server.stats, server.config."""
+    cfg = {**DEFAULTS, **config}
+    stats = Stats()
+    server = ThreadingHTTPServer((host, port), make_handler(cfg, stats))
+    server.daemon_threads = True
+    server.base_url = f"http://{host}:{server.server_port}"
+    server.stats = stats
+    server.config = cfg
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-smartup").start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный mock smartup.online")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    for name, value in DEFAULTS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    cfg = {k: getattr(args, k) for k in DEFAULTS}
+
+    server = start(args.host, args.port, **cfg)
+    print(f"🧪 mock smartup: {server.base_url}  {cfg}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
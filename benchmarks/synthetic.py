@@ -0,0 +1,162 @@
+"""
+Синтетические ответы smartup.online той же формы, что и настоящие выгрузки:
+
+- balance$export   {"balance": [... groups ...]}
+- return$export    {"return": [... return_products -> details ...]}
+- order$export     {"order": [... order_products -> details ...]}
+- inventory$export {"inventory": [... groups / inventory_kinds / sector_codes ...]}
+
+Данные детерминированы: одинаковые параметры окна -> одинаковый ответ,
+поэтому повторные прогоны бенчмарков сравнимы.
+"""
+import random
+import zlib
+from datetime import date, timedelta
+
+WAREHOUSE_CODES = ["MARKAZ", "Брак", "ВодийEPCO", "ОфисEPCO", "Склад №2"]
+MEASURES = ["шт", "уп", "кг", "фл"]
+CONDITIONS = ["T", "B", "F"]
+
+
+def _rng(*parts) -> random.Random:
+    return random.Random(zlib.crc32("|".join(map(str, parts)).encode("utf-8")))
+
+
+def _d(d: date) -> str:
+    return d.strftime("%d.%m.%Y")
+
+
+def _days(begin: date, end: date):
+    d = begin
+    while d <= end:
+        yield d
+        d += timedelta(days=1)
+
+
+# ====== BALANCE ======
+def balance_items(n: int, warehouse_code: str, begin: date, end: date, condition: str = "T", groups: int = 3):
+    rnd = _rng("balance", warehouse_code, begin, end, condition)
+    span_days = max((end - begin).days, 0)
+    items = []
+    for i in range(n):
+        pid = 100000 + rnd.randrange(50000)
+        items.append({
+            "inventory_kind": condition,
+            "date": _d(begin + timedelta(days=rnd.randint(0, span_days))),
+            "warehouse_code": warehouse_code,
+            "product_code": "P%06d" % pid,
+            "product_barcode": "4780%09d" % pid,
+            "product_id": str(pid),
+            "card_code": "C%d" % (pid % 300),
+            "expiry_date": _d(end + timedelta(days=rnd.randint(30, 720))),
+            "serial_number": None if i % 4 else "SN%08d" % rnd.randrange(10 ** 8),
+            "batch_number": "Партия-%d" % rnd.randrange(500),
+            "quantity": str(rnd.randint(1, 500)),
+            "measure_code": rnd.choice(MEASURES),
+            "input_price": "%.2f" % (rnd.random() * 100000),
+            "groups": [{"group_code": "G%d" % ((pid + g) % 40), "type_code": "TYPE%d" % g}
+                       for g in range(rnd.randint(0, groups))],
+        })
+    return items
+
+
+# ====== RETURN ======
+def return_items(n: int, begin: date = date(2025, 1, 1), end: date = date(2025, 12, 31), products: int = 3):
+    rnd = _rng("return", n, begin, end)
+    span_days = max((end - begin).days, 0)
+    items = []
+    for i in range(n):
+        day = begin + timedelta(days=rnd.randint(0, span_days))
+        ret_products = []
+        for p in range(rnd.randint(1, products)):
+            unit_id = 200000 + rnd.randrange(20000)
+            ret_products.append({
+                "product_unit_id": str(unit_id),
+                "product_code": "P%06d" % unit_id,
+                "warehouse_code": rnd.choice(WAREHOUSE_CODES),
+                "inventory_kind": rnd.choice(CONDITIONS),
+                "card_code": "C%d" % (unit_id % 300),
+                "expiry_date": _d(day + timedelta(days=365)),
+                "serial_number": None,
+                "return_quant": str(rnd.randint(1, 50)),
+                "product_price": "%.2f" % (rnd.random() * 50000),
+                "details": [{"batch_number": "Партия-%d" % rnd.randrange(500),
+                             "quantity": str(rnd.randint(1, 10))} for _ in range(rnd.randint(0, 2))],
+            })
+        items.append({
+            # свой deal_id у каждого окна: new_return заменяет возвраты окна по deal_id
+            "deal_id": str(5000000000 + (begin - date(2024, 1, 1)).days * 100000 + i),
+            "filial_code": "9161160",
+            "delivery_number": "ВЗ-%06d" % i,
+            "deal_time": "%s 10:%02d:00" % (day.strftime("%d.%m.%Y"), i % 60),
+            "delivery_date": _d(day),
+            "booked_date": _d(day),
+            "batch_number": "Партия-%d" % rnd.randrange(500),
+            "client_name": "ООО Клиент %d" % rnd.randrange(3000),
+            "return_products": ret_products,
+        })
+    return items
+
+
+# ====== ORDER ======
+def order_items(begin: date, end: date, per_day: int = 50, products: int = 4):
+    """Заказы по дням: окно [begin, end] — объединение дней, как у настоящего API."""
+    items = []
+    for day in _days(begin, end):
+        rnd = _rng("order", day)
+        for i in range(per_day):
+            deal_id = "%s%04d" % (day.strftime("%Y%m%d"), i)
+            order_products = []
+            for p in range(rnd.randint(1, products)):
+                pid = 100000 + rnd.randrange(50000)
+                order_products.append({
+                    "product_id": str(pid),
+                    "product_code": "P%06d" % pid,
+                    "product_name": "Товар %d" % pid,
+                    "quantity": str(rnd.randint(1, 100)),
+                    "product_price": "%.2f" % (rnd.random() * 50000),
+                    "warehouse_code": rnd.choice(WAREHOUSE_CODES),
+                    "details": [{"batch_number": "Партия-%d" % rnd.randrange(500),
+                                 "quantity": str(rnd.randint(1, 20))} for _ in range(rnd.randint(1, 2))],
+                })
+            items.append({
+                "deal_id": deal_id,
+                "deal_time": day.strftime("%d.%m.%Y") + " 12:00:00",
+                "delivery_date": _d(day + timedelta(days=1)),
+                "status": rnd.choice(["A", "B", "C"]),
+                "filial_code": "9161160",
+                "client": {"client_id": str(rnd.randrange(3000)), "client_name": "ООО Клиент"},
+                "order_products": order_products,
+            })
+    return items
+
+
+# ====== INVENTORY ======
+def inventory_items(n: int, seed: int = 42):
+    rnd = random.Random(seed)
+    items = []
+    for i in range(n):
+        items.append({
+            "product_id": str(100000 + i),
+            "code": "P%06d" % i,
+            "name": "Товар %d" % i,
+            "short_name": "T%d" % i,
+            "barcode": "4780%09d" % i,
+            "measure_code": rnd.choice(MEASURES),
+            "weight_netto": "%.3f" % rnd.random(),
+            "state": "A" if i % 10 else "P",
+            "created_on": "%02d.%02d.2024" % (i % 28 + 1, i % 12 + 1),
+            "producer": {"producer_id": str(i % 400), "producer_name": "Производитель %d" % (i % 400)},
+            "groups": [{"group_id": str(g), "group_code": "G%d" % g, "type_code": "TYPE%d" % (g % 3)}
+                       for g in range(rnd.randint(0, 4))],
+            "inventory_kinds": [{"kind_id": str(k), "kind_name": "Вид %d" % k} for k in range(rnd.randint(1, 2))],
+            "sector_codes": [{"sector_code": "S%d" % (i % 5)}],
+        })
+    return items
+
+
+def filial_warehouses(n: int):
+    """Конфиг как в filial_warehouse.json."""
+    return [{"filial_id": 9161160, "filial_code": "9161160", "warehouse_id": 65461 + i,
+             "warehouse_code": WAREHOUSE_CODES[i % len(WAREHOUSE_CODES)] + ("" if i < len(WAREHOUSE_CODES) else str(i)),
+             "warehouse_name": WAREHOUSE_CODES[i % len(WAREHOUSE_CODES)]} for i in range(n)]
@@ -1,12 +1,6 @@
-import pyodbc
+from db import get_connection
 
-conn = pyodbc.connect(
-    "Driver={ODBC Driver 18 for SQL Server};"
-    "Server=TAKEDA;"  
-    "Database=SmartUpDB;"
-    "Trusted_Connection=yes;"
-    "TrustServerCertificate=yes;"
-)
+conn = get_connection("TAKEDA", "SmartUpDB")
 
 cursor = conn.cursor()
 print("✅ Успешное подключение к базе SmartUpDB")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Общая фабрика подключений к SQL Server для всех загрузчиков.
+
+- поиск ODBC-драйвера выполняется один раз на процесс
+- pyodbc-подключение кэшируется по (server, database) на поток,
+  Unicode-кодировки выставляются один раз при открытии
+- SQLAlchemy engine (для pandas.to_sql) кэшируется с пулом соединений
+- время connect/execute накапливается в TIMINGS (см. timed / print_timings)
+- pyodbc импортируется при первом подключении: загрузчикам на pandas/SQLAlchemy
+  (и импорту db вообще) он не нужен
+"""
+import atexit
+import platform
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from functools import lru_cache
+
+from run_report import span
+
+DRIVER_PREFERENCE = [
+    "ODBC Driver 18 for SQL Server",
+    "ODBC Driver 17 for SQL Server",
+    "SQL Server Native Client 11.0",
+    "SQL Server",
+]
+
+# label -> [кол-во вызовов, суммарные секунды]
+TIMINGS = {}
+_timings_lock = threading.Lock()
+
+_local = threading.local()
+_all_connections = []
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _pick_driver():
+    import pyodbc
+
+    drivers = [d.strip() for d in pyodbc.drivers()]
+    for name in DRIVER_PREFERENCE:
+        if name in drivers:
+            return name, tuple(drivers)
+    return None, tuple(drivers)
+
+
+def _record(label: str, seconds: float):
+    with _timings_lock:
+        stat = TIMINGS.setdefault(label, [0, 0.0])
+        stat[0] += 1
+        stat[1] += seconds
+
+
+@contextmanager
+def timed(label: str):
+    """with timed("merge FactBalance"): cursor.execute(...)"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(label, time.perf_counter() - t0)
+
+
+def timed_execute(cursor, sql: str, *params, label: str = "execute"):
+    with timed(label):
+        return cursor.execute(sql, *params)
+
+
+def connection_string(server: str, database: str, trusted: str = "Yes") -> str:
+    driver, all_drivers = _pick_driver()
+    if not driver:
+        arch = platform.architecture()[0]
+        raise RuntimeError(
+            f"ODBC drayver topilmadi. Python: {arch}. O'rnatilganlar: {list(all_drivers)}\n"
+            "Iltimos, 'ODBC Driver 17/18 for SQL Server' ni o'rnating."
+        )
+    return (
+        f"DRIVER={{{driver}}};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"Trusted_Connection={trusted};"
+        "Encrypt=No;"
+        "TrustServerCertificate=Yes;"
+    )
+
+
+def get_connection(server: str, database: str, trusted: str = "Yes"):
+    """
+    pyodbc-подключение (autocommit=False), общее для всех вызовов в потоке.
+    Закрывать его не нужно — все подключения закрываются при выходе из процесса.
+    """
+    cache = getattr(_local, "connections", None)
+    if cache is None:
+        cache = _local.connections = {}
+
+    key = (server.lower(), database.lower())
+    conn = cache.get(key)
+    if conn is not None and not getattr(conn, "closed", False):
+        return conn
+
+    import pyodbc
+
+    conn_str = connection_string(server, database, trusted)
+    with timed("connect"):
+        conn = pyodbc.connect(conn_str, autocommit=False)
+    # Unicode
+    conn.setdecoding(pyodbc.SQL_CHAR, encoding="utf-8")
+    conn.setdecoding(pyodbc.SQL_WCHAR, encoding="utf-16le")
+    conn.setencoding(encoding="utf-16le")
+
+    print(f"➡️  Using ODBC driver: {{{_pick_driver()[0]}}} | {server}/{database}")
+    cache[key] = conn
+    _all_connections.append(conn)
+    return conn
+
+
+def get_engine(server: str, database: str, trusted: str = "Yes", **engine_kwargs):
+    """SQLAlchemy engine с пулом, один на (server, database) на весь процесс."""
+    from sqlalchemy import create_engine
+
+    key = (server.lower(), database.lower())
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            params = urllib.parse.quote_plus(connection_string(server, database, trusted))
+            engine_kwargs.setdefault("pool_pre_ping", True)
+            with timed("create_engine"):
+                engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}", **engine_kwargs)
+            _engines[key] = engine
+    return engine
+
+
+@contextmanager
+def transaction(engine):
+    """Как engine.begin(), но commit замеряется отдельно (этап commit в run_report)."""
+    with engine.connect() as conn:
+        tx = conn.begin()
+        try:
+            yield conn
+        except BaseException:
+            tx.rollback()
+            raise
+        with span("commit"), timed("commit"):
+            tx.commit()
+
+
+def print_timings():
+    if not TIMINGS:
+        return
+    print("⏱  SQL timings:")
+    for label, (count, seconds) in sorted(TIMINGS.items(), key=lambda kv: -kv[1][1]):
+        print(f"   {label:30s} x{count:<5d} {seconds:9.3f} s")
+
+
+@atexit.register
+def close_all():
+    for conn in _all_connections:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _all_connections.clear()
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Устойчивые запросы к smartup.online для выгрузок по окнам (scope, begin, end).
+
+- post_json(): повтор с экспоненциальной задержкой и jitter, только для
+  временных ошибок (таймаут, обрыв, 408/425/429/5xx, битый JSON);
+  остальные ошибки (401, 400, ...) — сразу наверх
+- FailureJournal: файл с окнами, которые не удалось скачать даже после
+  повторов. Запуск с --resume скачивает только их.
+- RetryStats: сколько времени ушло впустую (неудачные попытки + ожидание)
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from rate_limit import SMARTUP
+from run_report import span
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BASE_DELAY = 2.0
+MAX_DELAY = 60.0
+
+JOURNAL_DIR = os.environ.get(
+    "FETCH_JOURNAL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fetch_journal"),
+)
+_JOURNAL_DATE = "%Y-%m-%d"
+
+
+def resume_requested(argv=None) -> bool:
+    return "--resume" in (sys.argv[1:] if argv is None else argv)
+
+
+# ====== STATS ======
+class RetryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failed_units = 0
+        self.wasted_seconds = 0.0
+
+    def add(self, requests_=0, retries=0, failed_units=0, wasted=0.0):
+        with self._lock:
+            self.requests += requests_
+            self.retries += retries
+            self.failed_units += failed_units
+            self.wasted_seconds += wasted
+
+    def print_summary(self):
+        print(f"🔁 HTTP: {self.requests} запросов | повторов: {self.retries} | "
+              f"потеряно времени: {self.wasted_seconds:.1f} s | неудачных окон: {self.failed_units}")
+
+
+# ====== RETRY ======
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status in RETRYABLE_STATUS
+    if isinstance(exc, ValueError):  # JSONDecodeError — обрезанный ответ
+        return True
+    return False
+
+
+def _backoff(attempt: int, retry_after=None) -> float:
+    if retry_after:
+        try:
+            return min(MAX_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    # full jitter
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempt)))
+
+
+def post_json(session, url, stats: RetryStats = None, max_attempts: int = MAX_ATTEMPTS, limiter=SMARTUP,
+              **kwargs):
+    """session.post(url, **kwargs) -> resp.json() с повторами временных ошибок (через limiter)."""
+    attempt = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            with span("fetch"):
+                resp = limiter.call(session.post, url, **kwargs)
+            resp.encoding = "utf-8"
+            resp.raise_for_status()
+            with span("parse", bytes_=len(resp.content)):
+                data = resp.json()
+            if stats:
+                stats.add(requests_=1)
+            return data
+        except Exception as e:
+            spent = time.perf_counter() - t0
+            attempt += 1
+            if not is_retryable(e) or attempt >= max_attempts:
+                if stats:
+                    stats.add(requests_=1, wasted=spent)
+                raise
+            response = getattr(e, "response", None)
+            delay = _backoff(attempt, response.headers.get("Retry-After") if response is not None else None)
+            print(f"   ↻ повтор {attempt}/{max_attempts - 1} через {delay:.1f}s | {type(e).__name__}: {e}")
+            time.sleep(delay)
+            if stats:
+                stats.add(requests_=1, retries=1, wasted=spent + delay)
+
+
+# ====== JOURNAL ======
+class FailureJournal:
+    """
+    {loader}.json: [{"scope": ..., "begin": "YYYY-MM-DD", "end": "YYYY-MM-DD", "error": ..., "failed_at": ...}]
+    """
+
+    def __init__(self, loader: str, directory: str = JOURNAL_DIR):
+        self.path = os.path.join(directory, f"{loader}.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                units = json.load(f)
+        except (OSError, ValueError):
+            units = []
+        self._units = {(u["scope"], u["begin"], u["end"]): u for u in units}
+
+    @staticmethod
+    def _key(scope, begin, end):
+        return str(scope), begin.strftime(_JOURNAL_DATE), end.strftime(_JOURNAL_DATE)
+
+    def record_failure(self, scope, begin, end, error):
+        key = self._key(scope, begin, end)
+        with self._lock:
+            self._units[key] = {"scope": key[0], "begin": key[1], "end": key[2], "error": str(error)[:500],
+                                "failed_at": datetime.now().isoformat(timespec="seconds")}
+            self._save()
+
+    def mark_done(self, scope, begin, end):
+        key = self._key(scope, begin, end)
+        with self._lock:
+            if self._units.pop(key, None) is not None:
+                self._save()
+
+    def mark_many(self, units):
+        """units: [(scope, begin, end)] — после commit загрузки; журнал пишется один раз."""
+        with self._lock:
+            removed = [self._units.pop(self._key(*u), None) for u in units]
+            if any(r is not None for r in removed):
+                self._save()
+
+    def windows(self, scope):
+        """Неудачные окна scope как (datetime, datetime), по возрастанию."""
+        out = [(datetime.strptime(b, _JOURNAL_DATE), datetime.strptime(e, _JOURNAL_DATE))
+               for s, b, e in self._units if s == str(scope)]
+        return sorted(out)
+
+    def __len__(self):
+        return len(self._units)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(sorted(self._units.values(), key=lambda u: (u["scope"], u["begin"])), f,
+                      ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def print_pending(self):
+        if self._units:
+            print(f"⚠️ Не загружено окон: {len(self._units)} → {self.path}. "
+                  f"Дозагрузка: --resume")
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP-транспорт для выгрузок smartup.online.
+
+make_session(workers) -> requests.Session:
+- Accept-Encoding: gzip, deflate (+ br, если установлен brotli/brotlicffi —
+  без него urllib3 не умеет распаковывать br)
+- пул keep-alive соединений по числу параллельных воркеров
+- учёт по endpoint: байт по сети (сжатых) против байт после распаковки;
+  если большой ответ пришёл без Content-Encoding — предупреждение
+
+    session = make_session(workers=4)
+    ...
+    print_transfer_stats()
+"""
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_WORKERS = 4
+# ответы больше этого без сжатия — повод проверить сервер/прокси
+UNCOMPRESSED_WARN_BYTES = 64 * 1024
+
+
+def _brotli_available() -> bool:
+    for name in ("brotli", "brotlicffi"):
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+ACCEPT_ENCODING = "gzip, deflate, br" if _brotli_available() else "gzip, deflate"
+
+
+# ====== STATS ======
+# endpoint -> {"requests", "wire", "decoded", "compressed", "encodings"}
+TRANSFER = {}
+_lock = threading.Lock()
+_warned = set()
+
+
+def _endpoint(url: str) -> str:
+    return urlsplit(url).path.rsplit("/", 1)[-1] or url
+
+
+def _record(response, *args, **kwargs):
+    if kwargs.get("stream"):
+        return response  # тело читает вызывающий код, размер здесь неизвестен
+    decoded = len(response.content)
+    try:
+        wire = response.raw.tell()  # байты, прочитанные из сокета (до распаковки)
+    except Exception:
+        wire = 0
+    if not wire:
+        wire = int(response.headers.get("Content-Length") or decoded)
+    encoding = response.headers.get("Content-Encoding", "identity").lower()
+    name = _endpoint(response.url)
+
+    with _lock:
+        s = TRANSFER.setdefault(name, {"requests": 0, "wire": 0, "decoded": 0, "compressed": 0, "encodings": set()})
+        s["requests"] += 1
+        s["wire"] += wire
+        s["decoded"] += decoded
+        s["encodings"].add(encoding)
+        if encoding != "identity":
+            s["compressed"] += 1
+        warn = encoding == "identity" and decoded >= UNCOMPRESSED_WARN_BYTES and name not in _warned
+        if warn:
+            _warned.add(name)
+    if warn:
+        print(f"⚠️ {name}: ответ {decoded / 1024:.0f} KB пришёл без сжатия "
+              f"(Accept-Encoding: {ACCEPT_ENCODING})")
+    return response
+
+
+def print_transfer_stats():
+    with _lock:
+        items = sorted(TRANSFER.items())
+    if not items:
+        return
+    print("📦 Трафик по endpoint:")
+    for name, s in items:
+        ratio = s["decoded"] / s["wire"] if s["wire"] else 0
+        print(f"   {name:28s} {s['requests']:5d} req | сеть {s['wire'] / 1e6:8.2f} MB | "
+              f"JSON {s['decoded'] / 1e6:8.2f} MB | x{ratio:.1f} | "
+              f"сжато {s['compressed']}/{s['requests']} ({', '.join(sorted(s['encodings']))})")
+
+
+# ====== SESSION ======
+def make_session(workers: int = DEFAULT_WORKERS) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(1, workers))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    session.hooks["response"].append(_record)
+    return session
@@ -1,31 +1,32 @@
+from __future__ import annotations
+
+import hashlib
 import warnings
-import pandas as pd
 import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from sqlalchemy import create_engine, text, inspect
-from sqlalchemy.types import Float, Integer, String, DateTime, Boolean, NVARCHAR
 import math
-import urllib
 
-pd.set_option('future.no_silent_downcasting', True)
+from db import get_engine, transaction
+from rate_limit import SMARTUP
+from run_report import span
+from smartup_session import get_session
+
 warnings.filterwarnings(
     "ignore",
     message="Could not infer format",
     category=UserWarning
 )
 
-def get_cookies_from_browser(url: str) -> dict:
-    chrome_options = Options()
-    chrome_options.add_argument("--start-maximized")
-    driver = webdriver.Chrome(options=chrome_options)
-    driver.get(url)
-    input("🌐 Авторизуйтесь в браузере и нажмите Enter...")
-    cookies = {c['name']: c['value'] for c in driver.get_cookies()}
-    driver.quit()
-    return cookies
+
+def _pandas():
+    """pandas грузится только когда реально нужен (быстрый старт скрипта)."""
+    import pandas as pd
+    pd.set_option('future.no_silent_downcasting', True)
+    return pd
+
 
 def auto_cast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    pd = _pandas()
+
     if df is None or df.empty:
         return df
     df = df.copy()
@@ -47,37 +48,115 @@ def auto_cast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
 
 
 
-def fetch_inventory(data_url: str, cookies: dict) -> dict:
+def fetch_inventory(data_url: str, cookies: dict, session=None, arrow: bool = False) -> dict:
     print("⬇️ Загрузка inventory...")
-    r = requests.post(data_url, cookies=cookies, json={}, headers={"Content-Type": "application/json"})
+    http = session or requests
+    with span("fetch"):
+        r = SMARTUP.call(http.post, data_url, cookies=cookies, json={}, headers={"Content-Type": "application/json"})
     r.raise_for_status()
-    data = r.json()
+    with span("parse", bytes_=len(r.content)):
+        data = r.json()
     items = data.get("inventory", [])
     print("📡 Всего элементов в inventory (raw):", len(items))
     if not items:
         return {}
-    inv_df = pd.json_normalize(items, sep="_", max_level=1)
-    print("🔎 После json_normalize:", inv_df.shape)
+    with span("transform", rows=len(items)):
+        result = extract_inventory(items, arrow=arrow)
+    print("🔎 inventory_main:", len(result["inventory_main"]), "строк")
+    return result
+
+
+# ====== EXTRACT ======
+# один проход по items сразу для всех четырёх таблиц; исходные dict не меняются
+CHILD_TABLES = {
+    "inventory_groups": "groups",
+    "inventory_kinds": "inventory_kinds",
+    "inventory_sectors": "sector_codes",
+}
+
+
+def _columns_to_arrow(columns: dict):
+    import pyarrow as pa
+
+    arrays = {}
+    for name, values in columns.items():
+        try:
+            arrays[name] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # смешанные типы в одной колонке — как строки
+            arrays[name] = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+    return pa.table(arrays)
+
+
+def extract_inventory(items: list, arrow: bool = False) -> dict:
+    """
+    То же, что json_normalize(items, sep="_", max_level=1) + дочерние таблицы
+    с product_id, но за один проход:
+    - inventory_main: колонки заранее размером len(items)
+    - groups / inventory_kinds / sector_codes -> inventory_* (+ product_id)
+    arrow=True: pyarrow.Table вместо pandas.DataFrame.
+    """
+    n = len(items)
+    main = {}  # колонка -> [None] * n
+    children = {t: {} for t in CHILD_TABLES}  # таблица -> колонка -> список
+    child_rows = dict.fromkeys(CHILD_TABLES, 0)
+
+    def put(name, i, value):
+        col = main.get(name)
+        if col is None:
+            col = main[name] = [None] * n
+        col[i] = value
+
+    for i, it in enumerate(items):
+        nested = []
+        for key, value in it.items():
+            if isinstance(value, dict):
+                nested.append((key, value))
+            else:
+                put(key, i, value)
+        # json_normalize ставит развёрнутые dict-колонки после обычных
+        for key, value in nested:
+            for sub, sub_value in value.items():
+                put(f"{key}_{sub}", i, sub_value)
 
-    groups_list, kinds_list, sectors_list = [], [], []
-    for it in items:
         pid = it.get("product_id")
-        for g in it.get("groups", []):
-            g["product_id"] = pid
-            groups_list.append(g)
-        for k in it.get("inventory_kinds", []):
-            k["product_id"] = pid
-            kinds_list.append(k)
-        for s in it.get("sector_codes", []):
-            s["product_id"] = pid
-            sectors_list.append(s)
-
-    return {
-        "inventory_main":   inv_df,
-        "inventory_groups": pd.DataFrame(groups_list),
-        "inventory_kinds":  pd.DataFrame(kinds_list),
-        "inventory_sectors":pd.DataFrame(sectors_list)
-    }
+        for table, field in CHILD_TABLES.items():
+            sub_items = it.get(field)
+            if not sub_items:
+                continue
+            cols = children[table]
+            r = child_rows[table]
+            for sub in sub_items:
+                for key, value in sub.items():
+                    if key == "product_id":
+                        continue
+                    col = cols.get(key)
+                    if col is None:
+                        col = cols[key] = [None] * r
+                    col.append(value)
+                pid_col = cols.get("product_id")
+                if pid_col is None:
+                    pid_col = cols["product_id"] = [None] * r
+                pid_col.append(pid)
+                r += 1
+                # колонки, которых не было в этом sub
+                for col in cols.values():
+                    if len(col) < r:
+                        col.append(None)
+            child_rows[table] = r
+
+    # product_id в дочерних таблицах — последней колонкой, как раньше
+    for cols in children.values():
+        if "product_id" in cols:
+            cols["product_id"] = cols.pop("product_id")
+
+    if arrow:
+        build = _columns_to_arrow
+    else:
+        pd = _pandas()
+        build = pd.DataFrame
+    return {"inventory_main": build(main), **{t: build(cols) for t, cols in children.items()}}
+
 
 UNIQUE_KEYS = {
     "inventory_main":   ["product_id"],
@@ -95,6 +174,9 @@ def build_dtype_map(df: pd.DataFrame, table_name: str) -> dict:
     • object/строки → String(n) (с расчётом длины)
     • inventory_groups.group_code / type_code → NVARCHAR
     """
+    pd = _pandas()
+    from sqlalchemy.types import Float, Integer, String, DateTime, Boolean, NVARCHAR
+
     dtype_map: dict[str, object] = {}
 
     for col in df.columns:
@@ -129,18 +211,209 @@ def build_dtype_map(df: pd.DataFrame, table_name: str) -> dict:
 
     return dtype_map
 
-def upload_to_sql(df_dict: dict):
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=localhost;"
-        "DATABASE=Epco;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+# ====== INCREMENTAL SYNC ======
+# row_hash — sha1 нормализованной строки; в dbo.{table} хранится рядом с данными.
+# В {table}_stg попадают только новые/изменённые строки (_op='U') и, при
+# soft_delete, ключи исчезнувших строк (_op='D'). _stg не пересоздаётся
+# каждый запуск: TRUNCATE + индекс по ключам.
+HASH_COLUMN = "row_hash"
+SOFT_DELETE = False
+
+
+def _norm(v) -> str:
+    """Одинаковое строковое представление значения из DataFrame и из SQL."""
+    if v is None:
+        return ""
+    if isinstance(v, float):
+        if math.isnan(v):
+            return ""
+        if v.is_integer():
+            return str(int(v))
+    if hasattr(v, "isoformat"):
+        return v.isoformat()
+    if isinstance(v, bool):
+        return str(int(v))
+    return str(v).strip()
+
+
+def _column_values(df, col):
+    pd = _pandas()
+    return [None if v is pd.NA or v is pd.NaT else v for v in df[col].tolist()]
+
+
+def row_hashes(df, cols) -> list:
+    values = [_column_values(df, c) for c in cols]
+    return [hashlib.sha1("\x1f".join(_norm(v) for v in row).encode("utf-8")).hexdigest()
+            for row in zip(*values)]
+
+
+def row_keys(df, keys) -> list:
+    return list(zip(*[[_norm(v) for v in _column_values(df, k)] for k in keys]))
+
+
+def ensure_sync_columns(conn, table_name: str):
+    from sqlalchemy import text
+
+    conn.execute(text(f"""
+IF COL_LENGTH('dbo.{table_name}', '{HASH_COLUMN}') IS NULL
+    ALTER TABLE dbo.{table_name} ADD {HASH_COLUMN} CHAR(40) NULL;
+IF COL_LENGTH('dbo.{table_name}', 'is_deleted') IS NULL
+    ALTER TABLE dbo.{table_name} ADD is_deleted BIT NOT NULL
+        CONSTRAINT DF_{table_name}_is_deleted DEFAULT 0 WITH VALUES;
+IF COL_LENGTH('dbo.{table_name}', 'deleted_at') IS NULL
+    ALTER TABLE dbo.{table_name} ADD deleted_at DATETIME2 NULL;
+"""))
+
+
+TEXT_TYPES = ("varchar", "nvarchar", "char", "nchar")
+MAX_BOUNDED = {"varchar": 8000, "nvarchar": 4000, "char": 8000, "nchar": 4000}
+
+
+def widen_columns(conn, table_name: str, df) -> list:
+    """
+    Ширины String(n) заданы первым запуском (build_dtype_map) — если в df значение длиннее,
+    колонка dbo.{table} расширяется с тем же запасом (или до MAX). Возвращает расширенные колонки.
+    """
+    from sqlalchemy import text
+
+    info = conn.execute(text("""
+SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE, COLLATION_NAME
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = :t
+"""), {"t": table_name}).fetchall()
+    widened = []
+    for name, data_type, width, nullable, collation in info:
+        if name not in df.columns or data_type not in TEXT_TYPES or width == -1:
+            continue
+        s = df[name].dropna()
+        longest = int(s.astype(str).str.len().max()) if not s.empty else 0
+        if longest <= width:
+            continue
+        size = max(50, math.ceil(longest * 1.2))
+        size_sql = str(size) if size <= MAX_BOUNDED[data_type] else "MAX"
+        collate = f" COLLATE {collation}" if collation else ""
+        null_sql = "NULL" if nullable == "YES" else "NOT NULL"
+        conn.execute(text(f"ALTER TABLE dbo.{table_name} ALTER COLUMN [{name}] "
+                          f"{data_type.upper()}({size_sql}){collate} {null_sql};"))
+        print(f"🔧 {table_name}.{name}: {data_type}({width}) → {data_type}({size_sql}) (значение длиной {longest})")
+        widened.append(name)
+    return widened
+
+
+def ensure_stg(conn, table_name: str, cols: list, keys: list, rebuild: bool = False) -> str:
+    """dbo.{table}_stg с колонками cols + row_hash + _op и индексом по ключам.
+    rebuild=True — типы колонок dbo.{table} изменились (widen_columns), _stg копируется заново."""
+    from sqlalchemy import inspect, text
+
+    stg = f"{table_name}_stg"
+    wanted = [*cols, HASH_COLUMN, "_op"]
+    inspector = inspect(conn)
+    if inspector.has_table(stg):
+        existing = [c["name"] for c in inspector.get_columns(stg)]
+        if existing == wanted and not rebuild:
+            conn.execute(text(f"TRUNCATE TABLE dbo.{stg};"))
+            return stg
+        print(f"🔁 {stg}: набор или типы колонок изменились — пересоздаём.")
+        conn.execute(text(f"DROP TABLE dbo.{stg};"))
+
+    select_cols = ", ".join(f"[{c}]" for c in [*cols, HASH_COLUMN])
+    key_cols = ", ".join(f"[{k}]" for k in keys)
+    conn.execute(text(f"""
+SELECT TOP 0 {select_cols} INTO dbo.{stg} FROM dbo.{table_name};
+ALTER TABLE dbo.{stg} ADD _op CHAR(1) NOT NULL;
+CREATE CLUSTERED INDEX IX_{stg}_keys ON dbo.{stg}({key_cols});
+"""))
+    return stg
+
+
+def sync_table(conn, table_name: str, df, keys: list, soft_delete: bool = SOFT_DELETE) -> dict:
+    """
+    Сравнивает row_hash с уже сохранёнными и переносит в dbo.{table} только разницу.
+    Возвращает {"new", "changed", "unchanged", "deleted"}.
+    """
+    pd = _pandas()
+    from sqlalchemy import inspect, text
+
+    ensure_sync_columns(conn, table_name)
+    target_cols = {c["name"] for c in inspect(conn).get_columns(table_name)}
+    cols = [c for c in df.columns if c in target_cols and c != HASH_COLUMN]
+    missing = [c for c in df.columns if c not in target_cols]
+    if missing:
+        print(f"⚠️ {table_name}: нет в таблице колонок {missing} — пропущены.")
+
+    df = df[cols].copy()
+    with span("transform", rows=len(df)):
+        df[HASH_COLUMN] = row_hashes(df, cols)
+        new_keys = row_keys(df, keys)
+
+    # сохранённые хэши: ключ -> (row_hash, is_deleted)
+    key_cols = ", ".join(f"[{k}]" for k in keys)
+    stored = {}
+    for row in conn.execute(text(f"SELECT {key_cols}, {HASH_COLUMN}, is_deleted FROM dbo.{table_name}")):
+        stored[tuple(_norm(v) for v in row[:len(keys)])] = (row[-2], row[-1])
+
+    upsert_mask = []
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+    for key, h in zip(new_keys, df[HASH_COLUMN]):
+        prev = stored.get(key)
+        if prev is None:
+            counts["new"] += 1
+            upsert_mask.append(True)
+        elif prev[0] != h or prev[1]:
+            counts["changed"] += 1
+            upsert_mask.append(True)
+        else:
+            counts["unchanged"] += 1
+            upsert_mask.append(False)
+
+    stage = df[upsert_mask].assign(_op="U")
+    if soft_delete:
+        gone = set(k for k, (_, deleted) in stored.items() if not deleted) - set(new_keys)
+        if gone:
+            counts["deleted"] = len(gone)
+            gone_df = pd.DataFrame(sorted(gone), columns=keys).assign(_op="D")
+            # типы ключей как в основном DataFrame
+            for k in keys:
+                gone_df[k] = gone_df[k].astype(df[k].dtype, errors="ignore")
+            stage = pd.concat([stage, gone_df], ignore_index=True)
+
+    if stage.empty:
+        return counts
+
+    widened = widen_columns(conn, table_name, stage)
+    stg = ensure_stg(conn, table_name, cols, keys, rebuild=bool(widened))
+    with span("stage", rows=len(stage)):
+        stage.to_sql(stg, con=conn, index=False, if_exists="append")
+
+    on_clause = " AND ".join([f"t.[{k}] = s.[{k}]" for k in keys])
+    sync_cols = [*cols, HASH_COLUMN]
+    update_set = ", ".join(f"t.[{c}] = s.[{c}]" for c in sync_cols if c not in keys)
+    insert_cols = ", ".join(f"[{c}]" for c in sync_cols)
+    insert_vals = ", ".join(f"s.[{c}]" for c in sync_cols)
+    with span("merge", rows=len(stage)):
+        conn.execute(text(f"""
+MERGE INTO dbo.{table_name} AS t
+USING dbo.{stg} AS s
+ON {on_clause}
+WHEN MATCHED AND s._op = 'D' THEN
+    UPDATE SET t.is_deleted = 1, t.deleted_at = SYSUTCDATETIME()
+WHEN MATCHED THEN
+    UPDATE SET {update_set}, t.is_deleted = 0, t.deleted_at = NULL
+WHEN NOT MATCHED BY TARGET AND s._op = 'U' THEN
+    INSERT ({insert_cols}) VALUES ({insert_vals});
+"""))
+    return counts
+
+
+def upload_to_sql(df_dict: dict, soft_delete: bool = SOFT_DELETE):
+    pd = _pandas()
+    from sqlalchemy import inspect
+    from sqlalchemy.types import CHAR
+
+    engine = get_engine("localhost", "Epco")
     inspector = inspect(engine)
 
-    with engine.begin() as conn:
+    with transaction(engine) as conn:
         for table_name, df in df_dict.items():
             if df is None or df.empty:
                 print(f"⏭ {table_name} пуст – пропущено.")
@@ -163,47 +436,52 @@ def upload_to_sql(df_dict: dict):
 
             # --- загрузка ---
             if not inspector.has_table(table_name):
-                df.to_sql(
-                    table_name,
-                    con=conn,
-                    index=False,
-                    if_exists="replace",
-                    dtype=dtype_map
-                )
+                if keys:
+                    # хэши сразу, чтобы следующий запуск был инкрементальным
+                    df[HASH_COLUMN] = row_hashes(df, list(df.columns))
+                    dtype_map[HASH_COLUMN] = CHAR(40)
+                with span("stage", rows=len(df)):
+                    df.to_sql(
+                        table_name,
+                        con=conn,
+                        index=False,
+                        if_exists="replace",
+                        dtype=dtype_map
+                    )
+                if keys:
+                    ensure_sync_columns(conn, table_name)
                 print(f"🆕 {table_name} создана и загружено {len(df)} строк.")
                 continue
 
             if keys:
-                stg = f"{table_name}_stg"
-                df.to_sql(stg, con=conn, index=False,
-                          if_exists="replace", dtype=dtype_map)
-                on_clause = " AND ".join([f"t.[{k}] = s.[{k}]" for k in keys])
-                cols = [f"[{c}]" for c in df.columns]
-                insert_cols = ", ".join(cols)
-                insert_vals = ", ".join([f"s.[{c}]" for c in df.columns])
-                merge_sql = f"""
-MERGE INTO dbo.{table_name} AS t
-USING dbo.{stg} AS s
-ON {on_clause}
-WHEN NOT MATCHED BY TARGET THEN
-    INSERT ({insert_cols}) VALUES ({insert_vals});
-DROP TABLE dbo.{stg};
-"""
-                conn.execute(text(merge_sql))
-                print(f"📥 {table_name} → добавлены только новые строки ({len(df)} проверено).")
+                c = sync_table(conn, table_name, df, keys, soft_delete=soft_delete)
+                print(f"📥 {table_name}: новых {c['new']}, изменено {c['changed']}, "
+                      f"без изменений {c['unchanged']}, помечено удалёнными {c['deleted']}.")
             else:
-                df.to_sql(
-                    table_name,
-                    con=conn,
-                    index=False,
-                    if_exists="append",
-                    dtype=dtype_map
-                )
+                widen_columns(conn, table_name, df)
+                with span("stage", rows=len(df)):
+                    df.to_sql(
+                        table_name,
+                        con=conn,
+                        index=False,
+                        if_exists="append",
+                        dtype=dtype_map
+                    )
                 print(f"⚠️ {table_name}: нет ключей, добавлены все {len(df)} строк.")
 
+DATA_URL = "https://smartup.online/b/anor/mxsx/mr/inventory$export"
+
+
+def main(cookies: dict = None, session=None) -> int:
+    """Возвращает количество строк во всех таблицах inventory_*."""
+    if cookies is None and session is None:
+        session = get_session()
+    result = fetch_inventory(DATA_URL, cookies, session=session)
+    if not result:
+        return 0
+    upload_to_sql(result)
+    return sum(len(df) for df in result.values())
+
+
 if __name__ == "__main__":
-    DATA_URL = "https://smartup.online/b/anor/mxsx/mr/inventory$export"
-    cookies = get_cookies_from_browser("https://smartup.online")
-    result = fetch_inventory(DATA_URL, cookies)
-    if result:
-        upload_to_sql(result)
+    main()
@@ -1,17 +1,8 @@
 import re
 import time
-import urllib.parse
-import pandas as pd
-from bs4 import BeautifulSoup
-from sqlalchemy import create_engine, text
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from db import get_engine, transaction
+from run_report import span
 
 
 BASE_URL = "https://ishonchsavdo.uz/ru/branches"
@@ -28,6 +19,13 @@ def clean_work_time(raw: str) -> str:
 
 # --- Selenium скрапинг ---
 def scrape_with_selenium(url: str):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+    from webdriver_manager.chrome import ChromeDriverManager
+    from selenium.webdriver.common.by import By
+    from bs4 import BeautifulSoup
+
     print("🔁 Запуск Selenium (headless Chrome)...")
     options = Options()
     options.add_argument("--headless=new")
@@ -116,15 +114,11 @@ def scrape_with_selenium(url: str):
 
 # --- SQL MERGE ---
 def upload_to_sql(data):
+    import pandas as pd
+    from sqlalchemy import text
+
     print("🔌 Подключение к SQL Server...")
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=localhost;"
-        "DATABASE=SOFT;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+    engine = get_engine("localhost", "SOFT")
 
 
     df = pd.DataFrame(data)
@@ -135,7 +129,7 @@ def upload_to_sql(data):
             df[c] = ""
     df = df[expected_cols]
 
-    with engine.begin() as conn:
+    with transaction(engine) as conn:
         # создаём таблицу если нет
         conn.execute(text("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Branches' AND xtype='U')
@@ -149,28 +143,33 @@ def upload_to_sql(data):
         """))
 
         # MERGE для вставки без дублей
-        for _, row in df.iterrows():
-            conn.execute(text("""
-            MERGE Branches AS target
-            USING (SELECT :name AS name, :location AS location, :work_time AS work_time, :phone AS phone, :adress AS adress) AS src
-            ON (target.name = src.name AND target.location = src.location AND target.phone = src.phone)
-            WHEN NOT MATCHED THEN
-                INSERT (name, location, work_time, phone, adress)
-                VALUES (src.name, src.location, src.work_time, src.phone, src.adress);
-            """), {
-                "name": row["name"],
-                "location": row["location"],
-                "work_time": row["work_time"],
-                "phone": row["phone"],
-                "adress": row["adress"]
-            })
+        with span("merge", rows=len(df)):
+            for _, row in df.iterrows():
+                conn.execute(text("""
+                MERGE Branches AS target
+                USING (SELECT :name AS name, :location AS location, :work_time AS work_time, :phone AS phone, :adress AS adress) AS src
+                ON (target.name = src.name AND target.location = src.location AND target.phone = src.phone)
+                WHEN NOT MATCHED THEN
+                    INSERT (name, location, work_time, phone, adress)
+                    VALUES (src.name, src.location, src.work_time, src.phone, src.adress);
+                """), {
+                    "name": row["name"],
+                    "location": row["location"],
+                    "work_time": row["work_time"],
+                    "phone": row["phone"],
+                    "adress": row["adress"]
+                })
 
     print(f"✅ Данные ({len(df)} строк) синхронизированы в таблицу Branches.")
 
 
 # --- Main ---
 def main():
-    data = scrape_with_selenium(BASE_URL)
+    import pandas as pd
+
+    with span("fetch") as sp:
+        data = scrape_with_selenium(BASE_URL)
+        sp.rows = len(data)
 
     if not data:
         print("❗ Данных нет, проверяй сайт.")
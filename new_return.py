@@ -1,61 +1,68 @@
 import json
-import pandas as pd
 import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from sqlalchemy import create_engine, NVARCHAR, DateTime, Integer
-import urllib
+
+from db import get_engine, transaction
+from rate_limit import SMARTUP
+from return_windows import (align_columns, delete_keys, drop_nested, plan_windows, return_ids, set_watermark,
+                            window_payload)
+from run_report import span
+from smartup_session import get_session
 from datetime import datetime
 
+LOADER = "new_return"
 
-def get_cookies_from_browser(url):
-    chrome_options = Options()
-    chrome_options.add_argument("--start-maximized")
-    driver = webdriver.Chrome(options=chrome_options)
-    driver.get(url)
-    input("🌐 Зайдите на сайт и нажмите Enter после авторизации...")
-    cookies = driver.get_cookies()
-    driver.quit()
-    return {cookie['name']: cookie['value'] for cookie in cookies}
 
+def fetch_and_flatten(data_url, cookies=None, session=None, date_from=None, date_to=None):
+    """С date_from/date_to — одно окно (POST begin_date/end_date), без них — вся история (GET)."""
+    import pandas as pd
 
-def fetch_and_flatten(data_url):
-    cookies = get_cookies_from_browser("https://smartup.online")
-    print("⬇️ Загружаем данные...")
-    response = requests.get(data_url, cookies=cookies)
+    if cookies is None and session is None:
+        session = get_session()
+    http = session or requests
+    if date_from is not None:
+        print(f"⬇️ Загружаем данные: {date_from:%d.%m.%Y} → {date_to:%d.%m.%Y}")
+        with span("fetch"):
+            response = SMARTUP.call(http.post, data_url, cookies=cookies, json=window_payload(date_from, date_to))
+    else:
+        print("⬇️ Загружаем данные...")
+        with span("fetch"):
+            response = SMARTUP.call(http.get, data_url, cookies=cookies)
     response.raise_for_status()
-    data = response.json()
+    with span("parse", bytes_=len(response.content)):
+        data = response.json()
 
     if isinstance(data, dict) and "return" in data:
         data = data["return"]
 
-    order_df = pd.json_normalize(data, sep="_")
-
-    # Гарантируем наличие ключевых колонок
-    for col in ["deal_time", "delivery_date", "delivery_number", "booked_date"]:
-        if col not in order_df.columns:
-            order_df[col] = None
-
-    # Таблица товаров
-    order_products_list = []
-    for order in data:
-        order_id = order.get("deal_id")
-        for product in order.get("return_products", []):
-            product["order_id"] = order_id
-            order_products_list.append(product)
-    order_products_df = pd.DataFrame(order_products_list)
-
-    # Таблица деталей
-    details_list = []
-    for product in order_products_list:
-        product_id = product.get("product_unit_id")
-        order_id = product.get("order_id")
-        if isinstance(product.get("details"), list):
-            for detail in product.get("details", []):
-                detail["product_id"] = product_id
-                detail["order_id"] = order_id
-                details_list.append(detail)
-    details_df = pd.DataFrame(details_list)
+    with span("transform") as tr:
+        order_df = pd.json_normalize(data, sep="_")
+
+        # Гарантируем наличие ключевых колонок
+        for col in ["deal_time", "delivery_date", "delivery_number", "booked_date"]:
+            if col not in order_df.columns:
+                order_df[col] = None
+
+        # Таблица товаров
+        order_products_list = []
+        for order in data:
+            order_id = order.get("deal_id")
+            for product in order.get("return_products", []):
+                product["order_id"] = order_id
+                order_products_list.append(product)
+        order_products_df = pd.DataFrame(order_products_list)
+
+        # Таблица деталей
+        details_list = []
+        for product in order_products_list:
+            product_id = product.get("product_unit_id")
+            order_id = product.get("order_id")
+            if isinstance(product.get("details"), list):
+                for detail in product.get("details", []):
+                    detail["product_id"] = product_id
+                    detail["order_id"] = order_id
+                    details_list.append(detail)
+        details_df = pd.DataFrame(details_list)
+        tr.rows = len(order_df) + len(order_products_df) + len(details_df)
 
     print(f"✅ Получено: {len(order_df)} возвратов, {len(order_products_df)} товаров, {len(details_df)} деталей")
     return {
@@ -66,6 +73,8 @@ def fetch_and_flatten(data_url):
 
 
 def parse_date(val):
+    import pandas as pd
+
     if pd.isna(val) or val in ("", None):
         return None
     try:
@@ -77,55 +86,85 @@ def parse_date(val):
             return None
 
 
-def upload_to_sql(df_dict):
+def upload_to_sql(df_dict, watermark=None):
+    """
+    Окно — одна транзакция: строки его возвратов удаляются по ключу (RETURN_KEYS)
+    и дописываются заново; watermark=(loader, дата, строк) сохраняется вместе с ними.
+    Возвращает True, если окно записано.
+    """
+    import pandas as pd
+    from sqlalchemy import NVARCHAR, DateTime, Integer
+
     print("🔌 Подключение к SQL Server...")
-    params = urllib.parse.quote_plus(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=localhost;"
-        "DATABASE=SOFT;"
-        "Trusted_Connection=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-    for table_name, df in df_dict.items():
-        if df.empty or len(df.columns) == 0:
-            continue
-
-        # Типизация колонок
-        for col in df.columns:
-            if "id" in col.lower():
-                df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
-            elif "date" in col.lower() or "time" in col.lower():
-                if col in ["delivery_date", "booked_date"]:
-                    df[col] = df[col].apply(parse_date)
-                else:
-                    df[col] = pd.to_datetime(df[col], errors="coerce")
-
-        # Маппинг типов для SQL
-        dtype_map = {col: NVARCHAR(255) for col in df.columns}
-        for col in df.columns:
-            if "id" in col.lower():
-                dtype_map[col] = Integer()
-            elif "date" in col.lower() or "time" in col.lower():
-                dtype_map[col] = DateTime()
-
-        print(f"📥 Загрузка в таблицу: {table_name} ({len(df)} строк)")
-        try:
-            df.to_sql(
-                name=table_name,
-                con=engine,
-                index=False,
-                if_exists="append",
-                dtype=dtype_map
-            )
-            print(f"✅ Таблица {table_name} успешно загружена.")
-        except Exception as e:
-            print(f"❌ Ошибка при записи в SQL таблицу {table_name}: {e}")
+    engine = get_engine("localhost", "SOFT")
+
+    try:
+        ids = return_ids(df_dict)
+        with transaction(engine) as conn:
+            for table_name, df in df_dict.items():
+                # старые строки возвратов окна — и там, где у них теперь нет строк
+                deleted = delete_keys(conn, table_name, ids)
+                if df.empty or len(df.columns) == 0:
+                    continue
+                # return_products / details — уже разложены в дочерние таблицы
+                df = drop_nested(df)
+
+                # Типизация колонок
+                for col in df.columns:
+                    if "id" in col.lower():
+                        df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+                    elif "date" in col.lower() or "time" in col.lower():
+                        if col in ["delivery_date", "booked_date"]:
+                            df[col] = df[col].apply(parse_date)
+                        else:
+                            df[col] = pd.to_datetime(df[col], errors="coerce")
+
+                # Маппинг типов для SQL
+                dtype_map = {col: NVARCHAR(255) for col in df.columns}
+                for col in df.columns:
+                    if "id" in col.lower():
+                        dtype_map[col] = Integer()
+                    elif "date" in col.lower() or "time" in col.lower():
+                        dtype_map[col] = DateTime()
+
+                df = align_columns(conn, table_name, df)
+                print(f"📥 Загрузка в таблицу: {table_name} ({len(df)} строк, заменено старых: {deleted})")
+                with span("stage", rows=len(df)):
+                    df.to_sql(
+                        name=table_name,
+                        con=conn,
+                        index=False,
+                        if_exists="append",
+                        dtype=dtype_map
+                    )
+                print(f"✅ Таблица {table_name} успешно загружена.")
+            if watermark:
+                set_watermark(conn, *watermark)
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при записи в SQL: {e}")
+        return False
+
+
+DATA_URL = "https://smartup.online/b/anor/mxsx/mdeal/return$export"
+
+
+def main(cookies=None, session=None):
+    """Окнами от водяного знака (return_windows); возвращает количество строк во всех таблицах anor_*."""
+    if cookies is None and session is None:
+        session = get_session()
+    engine = get_engine("localhost", "SOFT")
+    rows = 0
+    for date_from, date_to in plan_windows(engine, LOADER):
+        df_dict = fetch_and_flatten(DATA_URL, cookies=cookies, session=session, date_from=date_from, date_to=date_to)
+        window_rows = sum(len(df) for df in df_dict.values())
+        if not upload_to_sql(df_dict, watermark=(LOADER, date_to, window_rows)):
+            print(f"⛔ Окно {date_from:%d.%m.%Y} → {date_to:%d.%m.%Y} не записано — остановка, "
+                  f"следующий запуск начнёт с него")
+            break
+        rows += window_rows
+    return rows
 
 
 if __name__ == "__main__":
-    DATA_URL = "https://smartup.online/b/anor/mxsx/mdeal/return$export"
-    df_dict = fetch_and_flatten(DATA_URL)
-    if df_dict:
-        upload_to_sql(df_dict)
+    main()
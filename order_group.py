@@ -1,25 +1,18 @@
-import urllib
+from __future__ import annotations
+
 from datetime import datetime, timedelta
-from sqlalchemy.types import Float, Integer, String
-import pandas as pd
 import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from sqlalchemy import create_engine
-
 
-def get_cookies_from_browser(url):
-    chrome_options = Options()
-    chrome_options.add_argument("--start-maximized")
-    driver = webdriver.Chrome(options=chrome_options)
-    driver.get(url)
-    input("🌐 Login qilib bo‘lgach Enter ni bosing...")
-    cookies = driver.get_cookies()
-    driver.quit()
-    return {cookie['name']: cookie['value'] for cookie in cookies}
+from db import get_engine
+from rate_limit import SMARTUP
+from return_windows import drop_nested
+from run_report import span
+from smartup_session import get_session
 
 
 def auto_cast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    import pandas as pd
+
     for col in df.columns:
         try:
             s = df[col].dropna().astype(str)
@@ -58,30 +51,48 @@ def auto_cast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
 
 
 
-def fetch_and_flatten(data_url, cookies, date_from, date_to):
+def _deal_date(order):
+    """deal_time "dd.mm.yyyy HH:MM:SS" -> date (None, если нет/не парсится)."""
+    try:
+        return datetime.strptime((order.get("deal_time") or "")[:10], "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+def fetch_orders(data_url, cookies, date_from, date_to, session=None):
+    """Сырые order'ы окна без flatten: (orders, размер ответа в байтах); (None, 0) при ошибке."""
     try:
         print(f"⬇️ Yuklanmoqda: {date_from} → {date_to}")
-        response = requests.post(
-            data_url,
-            cookies=cookies,
-             json={
-        "begin_deal_date": datetime.strptime(date_from, "%Y-%m-%d").strftime("%d.%m.%Y"),
-        "end_deal_date": datetime.strptime(date_to, "%Y-%m-%d").strftime("%d.%m.%Y")
-    }
-)
+        http = session or requests
+        with span("fetch"):
+            response = SMARTUP.call(
+                http.post,
+                data_url,
+                cookies=cookies,
+                 json={
+            "begin_deal_date": datetime.strptime(date_from, "%Y-%m-%d").strftime("%d.%m.%Y"),
+            "end_deal_date": datetime.strptime(date_to, "%Y-%m-%d").strftime("%d.%m.%Y")
+        }
+    )
         response.raise_for_status()
-        data = response.json()
-
-        orders = data.get("order", [])
-        if not orders:
-            print("⚠️ Bu oyda 'order' topilmadi")
-            return None
+        with span("parse", bytes_=len(response.content)) as ps:
+            data = response.json()
+            orders = data.get("order", [])
+            ps.rows = len(orders)
 
         print("🔎 HTTP status:", response.status_code)
         print("📦 Размер JSON:", len(response.content))
-        data = response.json()
-        print("📊 Кол-во order:", len(data.get("order", [])))
+        print("📊 Кол-во order:", len(orders))
+        return orders, len(response.content)
+    except Exception as e:
+        print(f"❌ Xatolik: {e}")
+        return None, 0
+
 
+def flatten_orders(orders):
+    import pandas as pd
+
+    with span("transform") as tr:
         # order_main
         order_df = pd.json_normalize(orders, sep="_", max_level=1)
 
@@ -112,62 +123,136 @@ def fetch_and_flatten(data_url, cookies, date_from, date_to):
             order_products_df = order_products_df.drop_duplicates(subset=["order_id", "product_id"])
         if "order_id" in details_df.columns:
             details_df = details_df.drop_duplicates(subset=["order_id", "product_id"])
+        tr.rows = len(order_df) + len(order_products_df) + len(details_df)
 
-        print(f"✅ {len(order_df)} order, {len(order_products_df)} product, {len(details_df)} detail")
+    print(f"✅ {len(order_df)} order, {len(order_products_df)} product, {len(details_df)} detail")
 
-        return {
-            "order_main": order_df,
-            "order_products": order_products_df,
-            "order_details": details_df
-        }
+    return {
+        "order_main": order_df,
+        "order_products": order_products_df,
+        "order_details": details_df
+    }
+
+
+def fetch_and_flatten(data_url, cookies, date_from, date_to, session=None):
+    orders, _ = fetch_orders(data_url, cookies, date_from, date_to, session=session)
+    if not orders:
+        if orders is not None:
+            print("⚠️ Bu oyda 'order' topilmadi")
+        return None
+    try:
+        return flatten_orders(orders)
     except Exception as e:
         print(f"❌ Xatolik: {e}")
         return None
-    
-def safe_fetch(data_url, cookies, date_from, date_to, limit=7900):
-    result = []
+
+
+# повторно скачанное при упоре в limit: {"requests", "bytes"} за процесс
+REFETCH = {"requests": 0, "bytes": 0}
+
+
+def _day(d) -> str:
+    return d.strftime("%Y-%m-%d")
+
+
+def safe_fetch(data_url, cookies, date_from, date_to, limit=7900, session=None):
+    """
+    Окно [date_from, date_to]; ответ упёрся в limit — он, видимо, обрезан.
+    Если order'ы в ответе идут по deal_time (в любую сторону), все дни, кроме
+    последнего в ответе, — полные: они остаются, а повторяется только остаток
+    окна начиная с этого дня (продолжение).
+    Весь ответ — один день D: он остаётся (с предупреждением, дробить некуда),
+    остаток окна по обе стороны от D запрашивается отдельно.
+    Иначе (неупорядочено) — пополам без пересечения: [start, mid] и [mid+1, end].
+    Число order'ов проверяется до flatten; flatten — один раз по всем принятым.
+    """
+    kept = {}  # deal_id -> order
     stack = [(date_from, date_to)]
+    refetch_requests = refetch_bytes = 0
+    one_day = timedelta(days=1)
 
     while stack:
         start, end = stack.pop()
-        data = fetch_and_flatten(data_url, cookies, start, end)
-        if not data:
+        orders, size = fetch_orders(data_url, cookies, start, end, session=session)
+        if not orders:
             continue
 
-        count = len(data["order_main"])
-        if count >= limit:  # достигнут лимит → делим период пополам
-            start_dt = datetime.strptime(start, "%Y-%m-%d")
-            end_dt = datetime.strptime(end, "%Y-%m-%d")
-            mid_dt = start_dt + (end_dt - start_dt) / 2
-            stack.append((mid_dt.strftime("%Y-%m-%d"), end))
-            stack.append((start, mid_dt.strftime("%Y-%m-%d")))
-        else:
-            result.append(data)
+        if len(orders) >= limit:
+            start_d = datetime.strptime(start, "%Y-%m-%d").date()
+            end_d = datetime.strptime(end, "%Y-%m-%d").date()
+            dates = [_deal_date(o) for o in orders]
+            if None in dates or not all(start_d <= d <= end_d for d in dates):
+                ascending = descending = False
+            else:
+                ascending = all(a <= b for a, b in zip(dates, dates[1:]))
+                descending = all(a >= b for a, b in zip(dates, dates[1:]))
+            first, last = dates[0], dates[-1]
+
+            if (ascending or descending) and first == last:
+                # весь ответ — один день: его не раздробить, остальные дни окна — отдельно
+                print(f"⚠️ {_day(last)}: bitta kunda {len(orders)} order (limit {limit}) — "
+                      f"javob kesilgan bo‘lishi mumkin")
+                kept.update((o.get("deal_id"), o) for o in orders)
+                rest = []
+                if last > start_d:
+                    rest.append((start, _day(last - one_day)))
+                if last < end_d:
+                    rest.append((_day(last + one_day), end))
+                stack.extend(rest)
+                refetch_requests += len(rest)
+                continue
 
-    return result
+            if ascending or descending:
+                # ответ обрезан на дне last: остальные дни — целиком, last добирается следующим запросом
+                covered = [o for o, d in zip(orders, dates) if d != last]
+                kept.update((o.get("deal_id"), o) for o in covered)
+                rest = (_day(last), end) if ascending else (start, _day(last))
+                stack.append(rest)
+                refetch_requests += 1
+                refetch_bytes += size * (len(orders) - len(covered)) // len(orders)
+                print(f"↪️ Limit {limit}: {len(covered)} order оставлены, продолжаем: {rest[0]} → {rest[1]}")
+                continue
 
+            if end_d > start_d:  # неупорядочено → делим период пополам, ответ выброшен
+                mid = start_d + (end_d - start_d) // 2
+                stack.append((_day(mid + one_day), end))
+                stack.append((start, _day(mid)))
+                refetch_requests += 2
+                refetch_bytes += size
+                continue
+            print(f"⚠️ {start}: bitta kunda {len(orders)} order (limit {limit}) — javob kesilgan bo‘lishi mumkin")
+
+        kept.update((o.get("deal_id"), o) for o in orders)
+
+    if refetch_requests:
+        REFETCH["requests"] += refetch_requests
+        REFETCH["bytes"] += refetch_bytes
+        print(f"🔁 {date_from} → {date_to}: повторных запросов {refetch_requests}, "
+              f"скачано повторно ~{refetch_bytes / 1024 / 1024:.2f} MB")
+    if not kept:
+        return []
+    try:
+        return [flatten_orders(list(kept.values()))]
+    except Exception as e:
+        print(f"❌ Xatolik: {e}")
+        return []
 
-from sqlalchemy import create_engine
-from sqlalchemy.types import Float, Integer, String, DateTime, Boolean
-import urllib
 
 def upload_to_sql(df_dict):
+    from sqlalchemy.types import Float, Integer, String, DateTime, Boolean
+
     try:
         # Подключение к SQL Server
-        params = urllib.parse.quote_plus(
-            "DRIVER={ODBC Driver 17 for SQL Server};"
-            "SERVER=localhost;"
-            "DATABASE=Epco;"
-            "Trusted_Connection=yes;"
-            "TrustServerCertificate=yes;"
-        )
-        engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+        engine = get_engine("localhost", "Epco")
 
         for table_name, df in df_dict.items():
             if df is None or df.empty or df.columns.empty:
                 print(f"⏭ {table_name} bo‘sh – o‘tkazib yuborildi.")
                 continue
 
+            # order_products / details — уже разложены в свои таблицы, список в SQL не пишется
+            df = drop_nested(df)
+
             # Автоматическое приведение типов в DataFrame
             df = auto_cast_dataframe(df)
 
@@ -191,13 +276,14 @@ def upload_to_sql(df_dict):
                     dtype_mapping[col] = String()
 
             # Создаём таблицу заново, полностью под DataFrame
-            df.to_sql(
-                table_name,
-                con=engine,
-                index=False,
-                if_exists="append",  #  append
-                dtype=dtype_mapping
-            )
+            with span("stage", rows=len(df)):
+                df.to_sql(
+                    table_name,
+                    con=engine,
+                    index=False,
+                    if_exists="append",  #  append
+                    dtype=dtype_mapping
+                )
 
         print("✅ SQL Serverga yozildi.")
     except Exception as e:
@@ -214,14 +300,25 @@ def month_ranges(start_date, end_date):
         current = next_month
 
 
-if __name__ == "__main__":
-    DATA_URL = "https://smartup.online/b/trade/txs/tdeal/order$export"
-    cookies = get_cookies_from_browser("https://smartup.online")
+DATA_URL = "https://smartup.online/b/trade/txs/tdeal/order$export"
+
+
+def main(cookies=None, session=None):
+    """Oyma-oy yuklaydi; yozilgan satrlar sonini qaytaradi."""
+    if cookies is None and session is None:
+        session = get_session()
     start_date = datetime(2025, 1, 1)
     end_date = datetime.today()
+    rows = 0
     for date_from, date_to in month_ranges(start_date, end_date):
-     results = safe_fetch(DATA_URL, cookies, date_from, date_to)
-     for df_dict in results:
-        if df_dict:
-            upload_to_sql(df_dict)
+        results = safe_fetch(DATA_URL, cookies, date_from, date_to, session=session)
+        for df_dict in results:
+            if df_dict:
+                upload_to_sql(df_dict)
+                rows += sum(len(df) for df in df_dict.values())
+    return rows
+
+
+if __name__ == "__main__":
+    main()
 
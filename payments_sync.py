@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Google Sheets (лист F222) -> dbo.PaymentsRaw без полной перезаливки.
+
+- read_used_range(): заголовок и колонка A одним batch_get -> последняя
+  заполненная строка, затем данные кусками по CHUNK_ROWS строк одним batch_get
+- prepare_frame(): заголовки как раньше в ф.py (#, Name, Surname, Contract, ...)
+- sync_payments(): row_key (Contract, при повторе Contract#2 ...) и row_hash
+  по каждой строке (без колонки "#" — номер строки сдвигается от вставки
+  выше и не должен помечать всё ниже изменённым); в SQL уходят только
+  новые/изменённые строки (MERGE) и удаляются договора, которых больше нет
+- #PaymentsStage — копия типов dbo.PaymentsRaw (NVARCHAR(MAX)); строки с
+  ячейками длиннее STAGE_CELL_LEN грузятся без fast_executemany
+- LocalSheet: локальная замена gspread.Worksheet (batch_get по A1-диапазонам)
+  для проверки без Google API:  python ф.py --stub payments.csv
+"""
+import csv
+import hashlib
+import re
+
+from db import get_connection, timed
+from run_report import span
+
+TABLE_NAME = "dbo.PaymentsRaw"
+HEADER_ROW = 6  # строка с заголовками (нумерация с нуля → это 7-я строка)
+KEY_COLUMN = "Contract"
+CHUNK_ROWS = 5000
+STAGE_CELL_LEN = 4000  # размер буфера fast_executemany на ячейку; длиннее — обычным executemany
+HASH_EXCLUDE = ("#",)  # номер строки в листе
+
+
+# ====== A1 ======
+def col_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+# ====== READ ======
+def read_used_range(sheet, header_row: int = HEADER_ROW):
+    """
+    -> (header, rows): только заполненная область, без пустого хвоста листа.
+    Два запроса batch_get вместо get_all_values() по всей сетке.
+    """
+    header_line = header_row + 1  # A1-нумерация с 1
+    header, col_a = sheet.batch_get([f"{header_line}:{header_line}", "A:A"])
+    header = list(header[0]) if header else []
+    last_row = len(col_a)
+    if not header or last_row <= header_line:
+        return header, []
+
+    # целые строки "8:5007": колонки без заголовка тоже приходят (станут col_N)
+    ranges = [f"{start}:{min(start + CHUNK_ROWS - 1, last_row)}"
+              for start in range(header_line + 1, last_row + 1, CHUNK_ROWS)]
+    rows = [list(row) for chunk in sheet.batch_get(ranges) for row in chunk]
+    width = max([len(header), *map(len, rows)])
+    header += [""] * (width - len(header))
+    for row in rows:
+        row += [""] * (width - len(row))
+    return header, rows
+
+
+def make_unique(seq):
+    """Amount, Amount -> Amount, Amount_1"""
+    seen = {}
+    result = []
+    for x in seq:
+        if x not in seen:
+            seen[x] = 0
+            result.append(x)
+        else:
+            seen[x] += 1
+            result.append(f"{x}_{seen[x]}")
+    return result
+
+
+def prepare_frame(header, rows):
+    import pandas as pd
+
+    headers = list(header)
+    # подставляем свои заголовки для первых колонок
+    headers[:4] = ["#", "Name", "Surname", "Contract"]
+    # заменяем пустые имена колонок
+    headers = [h if h.strip() != "" else f"col_{i}" for i, h in enumerate(headers)]
+    headers = make_unique(headers)
+
+    df = pd.DataFrame(rows, columns=headers)
+    # убираем пустые строки и итоги
+    df = df[df["#"] != ""]
+    df = df[~df["#"].str.contains("TOTAL", na=False)]
+    return df.reset_index(drop=True)
+
+
+# ====== HASH ======
+def row_keys(df, key_column: str = KEY_COLUMN):
+    """Contract; повторяющийся договор -> Contract#2, Contract#3 ... в порядке листа."""
+    seen = {}
+    keys = []
+    for value in df[key_column].tolist():
+        value = (value or "").strip()
+        seen[value] = seen.get(value, 0) + 1
+        keys.append(value if seen[value] == 1 else f"{value}#{seen[value]}")
+    return keys
+
+
+def row_hashes(df, exclude=HASH_EXCLUDE):
+    columns = [df[c].tolist() for c in df.columns if c not in exclude]
+    return [hashlib.sha1("\x1f".join(row).encode("utf-8")).hexdigest() for row in zip(*columns)]
+
+
+# ====== SQL ======
+def _q(name: str) -> str:
+    return "[" + name.replace("]", "]]") + "]"
+
+
+def ensure_table(cursor, columns, table_name: str = TABLE_NAME):
+    # старая таблица из to_sql(if_exists="replace") — без ключа, пересоздаём один раз
+    cursor.execute(f"""
+IF OBJECT_ID('{table_name}', 'U') IS NOT NULL AND COL_LENGTH('{table_name}', 'row_key') IS NULL
+    DROP TABLE {table_name};
+""")
+    cols_sql = ",\n    ".join(f"{_q(c)} NVARCHAR(MAX) NULL" for c in columns)
+    cursor.execute(f"""
+IF OBJECT_ID('{table_name}', 'U') IS NULL
+CREATE TABLE {table_name} (
+    row_key NVARCHAR(400) NOT NULL CONSTRAINT PK_PaymentsRaw PRIMARY KEY,
+    row_hash CHAR(40) NOT NULL,
+    {cols_sql}
+);
+""")
+    # новые колонки в листе
+    cursor.execute("SELECT name FROM sys.columns WHERE object_id = OBJECT_ID(?)", table_name)
+    existing = {r[0] for r in cursor.fetchall()}
+    for c in columns:
+        if c not in existing:
+            cursor.execute(f"ALTER TABLE {table_name} ADD {_q(c)} NVARCHAR(MAX) NULL;")
+            print(f"➕ {table_name}: новая колонка {c}")
+
+
+def stage_rows(cursor, columns, stage):
+    """
+    Строки в #PaymentsStage: обычные — fast_executemany с буфером STAGE_CELL_LEN
+    на ячейку, строки с более длинными ячейками — отдельно, без fast_executemany.
+    """
+    import pyodbc
+
+    sql = f"INSERT INTO #PaymentsStage (row_key, row_hash, {', '.join(_q(c) for c in columns)}) " \
+          f"VALUES ({', '.join('?' * (len(columns) + 2))})"
+    short, long_ = [], []
+    for row in stage:
+        (long_ if any(isinstance(v, str) and len(v) > STAGE_CELL_LEN for v in row[2:]) else short).append(row)
+    if short:
+        cursor.fast_executemany = True
+        cursor.setinputsizes([(pyodbc.SQL_WVARCHAR, 400, 0), (pyodbc.SQL_CHAR, 40, 0)]
+                             + [(pyodbc.SQL_WVARCHAR, STAGE_CELL_LEN, 0)] * len(columns))
+        cursor.executemany(sql, short)
+        cursor.setinputsizes(None)
+    if long_:
+        cursor.fast_executemany = False
+        cursor.executemany(sql, long_)
+        print(f"📏 #PaymentsStage: {len(long_)} строк с ячейками > {STAGE_CELL_LEN} символов — без fast_executemany")
+
+
+def sync_payments(conn, df, table_name: str = TABLE_NAME) -> dict:
+    """-> {"inserted", "changed", "removed", "unchanged"}"""
+    if df.empty:
+        # пустое чтение не должно стереть таблицу
+        raise RuntimeError(f"{table_name}: из листа не прочитано ни одной строки — синхронизация отменена")
+    columns = list(df.columns)
+    with span("transform", rows=len(df)):
+        keys = row_keys(df)
+        hashes = row_hashes(df)
+
+    cursor = conn.cursor()
+    ensure_table(cursor, columns, table_name)
+
+    cursor.execute(f"SELECT row_key, row_hash FROM {table_name}")
+    stored = dict(cursor.fetchall())
+
+    counts = {"inserted": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    values = df.values.tolist()
+    stage = []
+    for key, h, row in zip(keys, hashes, values):
+        prev = stored.pop(key, None)
+        if prev == h:
+            counts["unchanged"] += 1
+            continue
+        counts["inserted" if prev is None else "changed"] += 1
+        stage.append((key, h, *row))
+    gone = [(k,) for k in stored]  # остались только ключи, которых нет в листе
+    counts["removed"] = len(gone)
+
+    col_list = ", ".join(_q(c) for c in columns)
+    if stage:
+        with span("stage", rows=len(stage)), timed("stage #PaymentsStage"):
+            # типы — как в целевой таблице, иначе длинные ячейки обрежутся или уронят вставку
+            cursor.execute(f"""
+IF OBJECT_ID('tempdb..#PaymentsStage') IS NOT NULL DROP TABLE #PaymentsStage;
+SELECT TOP 0 row_key, row_hash, {col_list} INTO #PaymentsStage FROM {table_name};
+""")
+            stage_rows(cursor, columns, stage)
+        update_set = ", ".join(f"t.{_q(c)} = s.{_q(c)}" for c in columns)
+        with span("merge", rows=len(stage)), timed(f"merge {table_name}"):
+            cursor.execute(f"""
+MERGE {table_name} AS t
+USING #PaymentsStage AS s
+ON t.row_key = s.row_key
+WHEN MATCHED THEN
+    UPDATE SET t.row_hash = s.row_hash, {update_set}
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT (row_key, row_hash, {col_list})
+    VALUES (s.row_key, s.row_hash, {", ".join(f"s.{_q(c)}" for c in columns)});
+""")
+
+    if gone:
+        with span("merge", rows=len(gone)), timed(f"delete {table_name}"):
+            cursor.execute("""
+IF OBJECT_ID('tempdb..#PaymentsGone') IS NOT NULL DROP TABLE #PaymentsGone;
+CREATE TABLE #PaymentsGone (row_key NVARCHAR(400) NOT NULL PRIMARY KEY);
+""")
+            cursor.fast_executemany = True
+            cursor.executemany("INSERT INTO #PaymentsGone (row_key) VALUES (?)", gone)
+            cursor.execute(f"DELETE t FROM {table_name} t JOIN #PaymentsGone g ON g.row_key = t.row_key;")
+
+    with span("commit"):
+        conn.commit()
+    cursor.close()
+    return counts
+
+
+def connect_sql():
+    return get_connection("localhost", "Epco")
+
+
+# ====== LOCAL STUB ======
+_A1 = re.compile(r"^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+
+
+class LocalSheet:
+    """
+    Замена gspread.Worksheet для локальной проверки: batch_get по A1-диапазонам
+    с обрезкой пустых хвостов строк/колонок, как делает Sheets API.
+    """
+
+    def __init__(self, values):
+        self.values = [list(r) for r in values]
+        self.calls = 0
+
+    @classmethod
+    def from_csv(cls, path: str):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            return cls(csv.reader(f))
+
+    def _get(self, a1: str):
+        m = _A1.match(a1.split("!")[-1])
+        if not m:
+            raise ValueError(f"Неверный диапазон: {a1}")
+        c1, r1, c2, r2 = m.groups()
+        if m.group(3) is None and m.group(4) is None:  # одна ячейка "B3"
+            c2, r2 = c1, r1
+        row_from = int(r1) if r1 else 1
+        row_to = int(r2) if r2 else len(self.values)
+        col_from = col_number(c1) if c1 else 1
+        col_to = col_number(c2) if c2 else None
+
+        out = []
+        for row in self.values[row_from - 1:row_to]:
+            cells = row[col_from - 1:col_to]
+            while cells and cells[-1] == "":
+                cells.pop()
+            out.append(cells)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def batch_get(self, ranges):
+        self.calls += 1
+        return [self._get(r) for r in ranges]
+
+    def get_all_values(self):
+        self.calls += 1
+        return self._get("A:ZZZ")
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Группы товара — мост product_id -> group_code вместо строки на каждый balance_id.
+
+    dbo.ProductGroup    (product_id, group_code; type_code)
+    dbo.ProductGroupSet (product_id; set_hash, balance_date) — хэш текущего набора групп товара
+                        и дата остатка, с которой он взят
+    dbo.vBalanceGroup   (balance_id, group_code, type_code) — прежняя форма BalanceGroup
+
+Группы — атрибут товара, а BalanceGroup повторял их на каждую дату и партию.
+Здесь набор групп товара берётся по самой поздней дате в пачке, хэшируется, и
+в SQL уходят только товары, у которых хэш изменился (кэш хэшей — на клиенте,
+читается один раз за процесс). Изменившийся товар перезаписывается целиком
+(DELETE + INSERT своих строк), но только если дата пачки не старше сохранённой:
+окна грузятся в любом порядке (run_queue), и старое окно не должно затирать
+более свежий набор.
+
+GROUP_STORAGE = "product" (balance_data, api_group): старый dbo.BalanceGroup больше
+не пишется, но остаётся источником для товаров, которых в мосте ещё нет —
+vBalanceGroup добирает их оттуда.
+"""
+import hashlib
+import threading
+from datetime import datetime
+
+from db import timed
+from run_report import span
+
+COLLATION = "Cyrillic_General_CI_AS"  # как в dbo.FactBalance
+
+PRODUCT_GROUP_TABLE = "dbo.ProductGroup"
+PRODUCT_GROUP_SET_TABLE = "dbo.ProductGroupSet"
+GROUP_VIEW = "dbo.vBalanceGroup"
+NULL_GROUP = "__NULL__"  # как ISNULL(group_code, N'__NULL__') в MERGE BalanceGroup
+
+
+def _pid(product_id) -> str:
+    # PK без NULL: товар без id — пустая строка (во view — ISNULL(product_id, N''))
+    return "" if product_id is None else str(product_id)
+
+
+def _norm(code):
+    # Cyrillic_General_CI_AS: регистр и хвостовые пробелы не различаются
+    return code.rstrip().casefold()
+
+
+def group_sets(fact_rows, group_rows) -> dict:
+    """
+    {product_id: (balance_date, [(group_code, type_code), ...])} — набор групп с самой
+    поздней balance_date товара в пачке. fact_rows/group_rows — как у collect_rows.
+    """
+    by_balance = {}
+    for bid, gc, tc in group_rows:
+        gc = NULL_GROUP if gc is None else gc
+        by_balance.setdefault(bid, {})[_norm(gc)] = (gc, tc)
+
+    latest = {}
+    for r in fact_rows:
+        groups = by_balance.get(r[0])
+        if groups is None:
+            continue
+        pid, d = _pid(r[7]), r[2]
+        if isinstance(d, datetime):
+            d = d.date()
+        known = latest.get(pid)
+        if known is None or (d is not None and (known[0] is None or d > known[0])):
+            latest[pid] = (d, groups)
+    return {pid: (d, sorted(groups.values(), key=lambda g: _norm(g[0]))) for pid, (d, groups) in latest.items()}
+
+
+def _is_older(d, stored) -> bool:
+    """Набор с даты d старше сохранённого (без даты — старше любого датированного)."""
+    return stored is not None and (d is None or d < stored)
+
+
+def set_hash(groups) -> str:
+    return hashlib.sha1("\x1e".join(f"{_norm(gc)}\x1f{tc or ''}" for gc, tc in groups).encode("utf-8")).hexdigest()
+
+
+def ensure_product_group_tables(cursor, fact_table: str, legacy_table: str, collation: str = COLLATION):
+    cursor.execute(f"""
+IF OBJECT_ID('{PRODUCT_GROUP_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {PRODUCT_GROUP_TABLE} (
+        product_id  NVARCHAR(50)  COLLATE {collation} NOT NULL,
+        group_code  NVARCHAR(100) COLLATE {collation} NOT NULL,
+        type_code   NVARCHAR(200) COLLATE {collation} NULL,
+        CONSTRAINT PK_ProductGroup PRIMARY KEY (product_id, group_code)
+    );
+    CREATE INDEX IX_ProductGroup_Code ON {PRODUCT_GROUP_TABLE}(group_code);
+END
+IF OBJECT_ID('{PRODUCT_GROUP_SET_TABLE}', 'U') IS NULL
+    CREATE TABLE {PRODUCT_GROUP_SET_TABLE} (
+        product_id   NVARCHAR(50) COLLATE {collation} NOT NULL CONSTRAINT PK_ProductGroupSet PRIMARY KEY,
+        set_hash     CHAR(40)     NOT NULL,
+        balance_date DATE         NULL,
+        updated_utc  DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+IF COL_LENGTH('{PRODUCT_GROUP_SET_TABLE}', 'balance_date') IS NULL
+    ALTER TABLE {PRODUCT_GROUP_SET_TABLE} ADD balance_date DATE NULL;
+""")
+    cursor.execute(f"""
+CREATE OR ALTER VIEW {GROUP_VIEW} AS
+SELECT f.balance_id, g.group_code, g.type_code
+FROM {fact_table} AS f
+JOIN {PRODUCT_GROUP_TABLE} AS g ON g.product_id = ISNULL(f.product_id, N'')
+UNION ALL
+-- мост ещё не видел товар: строки из прежнего {legacy_table}
+SELECT b.balance_id, b.group_code, b.type_code
+FROM {legacy_table} AS b
+JOIN {fact_table} AS f ON f.balance_id = b.balance_id
+WHERE NOT EXISTS (SELECT 1 FROM {PRODUCT_GROUP_SET_TABLE} AS s WHERE s.product_id = ISNULL(f.product_id, N''));
+""")
+
+
+# ====== CACHE ======
+class ProductGroupCache:
+    def __init__(self):
+        self._hashes = None  # product_id -> (set_hash, balance_date) (как в ProductGroupSet)
+        self._lock = threading.Lock()
+
+    def _load(self, cursor):
+        with timed(f"load {PRODUCT_GROUP_SET_TABLE}"):
+            cursor.execute(f"SELECT product_id, set_hash, balance_date FROM {PRODUCT_GROUP_SET_TABLE}")
+            return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    def refresh(self, cursor, fact_rows, group_rows) -> int:
+        """Обновляет мост для товаров с изменившимся набором групп. Commit — за вызывающим."""
+        with self._lock:
+            if self._hashes is None:
+                self._hashes = self._load(cursor)
+            with span("transform", rows=len(group_rows)):
+                sets = group_sets(fact_rows, group_rows)
+                changed, stale = {}, 0
+                for pid, (d, groups) in sets.items():
+                    h = set_hash(groups)
+                    known_hash, known_date = self._hashes.get(pid, (None, None))
+                    if known_hash == h:
+                        continue
+                    if known_hash is not None and _is_older(d, known_date):
+                        stale += 1
+                        continue
+                    changed[pid] = (h, d, groups)
+            if changed:
+                # в кэш — то, что в итоге лежит в таблице (параллельный процесс мог записать более свежий набор)
+                self._hashes.update(self._apply(cursor, changed))
+            print(f"🏷 Группы товаров: {len(sets)} товаров, изменилось: {len(changed)}"
+                  + (f", старше сохранённых: {stale}" if stale else ""))
+            return len(changed)
+
+    def clear(self):
+        """После ROLLBACK: хэши из этой транзакции в БД не попали."""
+        with self._lock:
+            self._hashes = None
+
+    @staticmethod
+    def _apply(cursor, changed: dict) -> dict:
+        """Возвращает {product_id: (set_hash, balance_date)} из таблицы после записи."""
+        set_rows = [(pid, h, d) for pid, (h, d, _) in changed.items()]
+        group_rows = [(pid, gc, tc) for pid, (_, _, groups) in changed.items() for gc, tc in groups]
+        cursor.execute(f"""
+IF OBJECT_ID('tempdb..#TmpProductSet') IS NOT NULL DROP TABLE #TmpProductSet;
+SELECT TOP 0 product_id, set_hash, balance_date INTO #TmpProductSet FROM {PRODUCT_GROUP_SET_TABLE};
+IF OBJECT_ID('tempdb..#TmpProductGroup') IS NOT NULL DROP TABLE #TmpProductGroup;
+SELECT TOP 0 * INTO #TmpProductGroup FROM {PRODUCT_GROUP_TABLE};
+""")
+        with span("stage", rows=len(set_rows) + len(group_rows)), timed("stage product groups"):
+            cursor.fast_executemany = True
+            cursor.executemany("INSERT INTO #TmpProductSet VALUES (?,?,?)", set_rows)
+            cursor.executemany("INSERT INTO #TmpProductGroup VALUES (?,?,?)", group_rows)
+
+        with span("merge", rows=len(group_rows)), timed(f"merge {PRODUCT_GROUP_TABLE}"):
+            cursor.execute(f"""
+SET NOCOUNT ON;
+-- хэш и дата сверяются ещё раз под UPDLOCK: параллельный процесс мог уже обновить товар
+SELECT s.product_id, s.set_hash, s.balance_date
+INTO #ProductChanged
+FROM #TmpProductSet AS s
+LEFT JOIN {PRODUCT_GROUP_SET_TABLE} AS t WITH (UPDLOCK, HOLDLOCK) ON t.product_id = s.product_id
+WHERE t.set_hash IS NULL
+   OR (t.set_hash <> s.set_hash AND (t.balance_date IS NULL OR s.balance_date >= t.balance_date));
+
+DELETE g
+FROM {PRODUCT_GROUP_TABLE} AS g
+JOIN #ProductChanged AS c ON c.product_id = g.product_id;
+
+INSERT INTO {PRODUCT_GROUP_TABLE} (product_id, group_code, type_code)
+SELECT g.product_id, g.group_code, g.type_code
+FROM #TmpProductGroup AS g
+JOIN #ProductChanged AS c ON c.product_id = g.product_id;
+
+MERGE {PRODUCT_GROUP_SET_TABLE} WITH (HOLDLOCK) AS T
+USING #ProductChanged AS S
+ON T.product_id = S.product_id
+WHEN MATCHED THEN UPDATE SET set_hash = S.set_hash, balance_date = S.balance_date, updated_utc = SYSUTCDATETIME()
+WHEN NOT MATCHED THEN INSERT (product_id, set_hash, balance_date) VALUES (S.product_id, S.set_hash, S.balance_date);
+SET NOCOUNT OFF;
+""")
+        cursor.execute(f"""
+SELECT t.product_id, t.set_hash, t.balance_date
+FROM {PRODUCT_GROUP_SET_TABLE} AS t
+JOIN #TmpProductSet AS s ON s.product_id = t.product_id;
+""")
+        stored = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        cursor.execute("DROP TABLE #ProductChanged; DROP TABLE #TmpProductSet; DROP TABLE #TmpProductGroup;")
+        return stored
+
+
+# один кэш на процесс: товары общие для всех scope и окон
+PRODUCT_GROUPS = ProductGroupCache()
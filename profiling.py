@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Профилирование любого загрузчика без правки кода.
+
+    SMARTUP_PROFILE=sample python balance_data.py        # семплер, collapsed stacks
+    SMARTUP_PROFILE=cprofile python balance_data.py      # cProfile, .prof
+    SMARTUP_TRACEMALLOC=10 python balance_data.py        # tracemalloc на границах этапов (глубина 10)
+    python run_all.py --profile --tracemalloc --profile-out D:/prof/nightly.collapsed.txt
+
+Включается при импорте run_report (он есть у всех загрузчиков), поэтому
+профиль покрывает весь запуск, включая fetch_balance_chunks и MERGE.
+Файлы пишутся рядом с отчётом запуска (run_report.report_path):
+- sample   -> <run>.collapsed.txt: "поток;функция;...;функция N" — готово для
+              flamegraph.pl, speedscope, inferno. Время настенное: ожидание сети
+              и SQL Server тоже видно, во всех потоках.
+- cprofile -> <run>.prof (snakeviz, flameprof, pstats); только поток, где включён.
+- tracemalloc -> <run>.tracemalloc.json: рост памяти по (loader, stage) и
+              топ мест выделения (первый вызов этапа, если он вырос >= 1 MB).
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+MODES = ("sample", "cprofile")
+PROFILE_MODE = os.environ.get("SMARTUP_PROFILE", "").strip().lower()
+PROFILE_OUT = os.environ.get("SMARTUP_PROFILE_OUT", "")
+SAMPLE_INTERVAL = float(os.environ.get("SMARTUP_PROFILE_INTERVAL", "0.005"))  # секунды
+TRACEMALLOC_FRAMES = int(os.environ.get("SMARTUP_TRACEMALLOC", "0") or 0)
+TOP_ALLOCATIONS = 10
+
+# вид -> путь к файлу (попадает в отчёт запуска)
+OUTPUTS = {}
+_state = {"started": False, "sampler": None, "cprofile": None, "memory": None, "out": None}
+
+
+# ====== SAMPLER ======
+class Sampler:
+    """Раз в interval снимает стеки всех потоков (sys._current_frames)."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# ====== TRACEMALLOC ======
+class StageMemory:
+    """
+    Хук run_report.STAGE_HOOKS. На каждом span — объём под tracemalloc до/после.
+    Снимок (take_snapshot) — только на первых SNAPSHOT_CALLS вызовах каждого
+    (loader, stage); compare_to проходит по всем трассам и стоит секунды, поэтому
+    считается лишь если этап вырос хотя бы на MIN_GROWTH_MB.
+    """
+
+    SNAPSHOT_CALLS = 1
+    MIN_GROWTH_MB = 1.0
+    _skip = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>")
+
+    def __init__(self, frames: int):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, frames))
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _totals(self, s):
+        with self._lock:
+            return self.stages.setdefault((s.loader, s.stage), {"calls": 0, "snapshots": 0, "max_growth_mb": 0.0,
+                                                                "max_traced_mb": 0.0, "peak_traced_mb": 0.0,
+                                                                "top": []})
+
+    def _top(self, before):
+        # filter_traces(fnmatch по каждой трассе) дороже самого сравнения — фильтруем результат
+        stats = tracemalloc.take_snapshot().compare_to(before, "traceback")
+        top = []
+        for stat in stats:
+            if stat.traceback[0].filename in self._skip:
+                continue
+            top.append({"where": str(stat.traceback), "size_diff_kb": round(stat.size_diff / 1024, 1),
+                        "count_diff": stat.count_diff})
+            if len(top) >= TOP_ALLOCATIONS:
+                break
+        return top
+
+    def hook(self, event: str, s):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if event == "start":
+            t = self._totals(s)
+            with self._lock:
+                snap = t["snapshots"] < self.SNAPSHOT_CALLS
+                t["snapshots"] += snap
+            stack.append((tracemalloc.take_snapshot() if snap else None, tracemalloc.get_traced_memory()[0]))
+            return
+        if not stack:
+            return
+        before, traced_before = stack.pop()
+        traced, peak = tracemalloc.get_traced_memory()
+        growth_mb = (traced - traced_before) / 1e6
+        top = self._top(before) if before is not None and growth_mb >= self.MIN_GROWTH_MB else None
+
+        t = self._totals(s)
+        with self._lock:
+            t["calls"] += 1
+            t["max_growth_mb"] = max(t["max_growth_mb"], round(growth_mb, 2))
+            t["max_traced_mb"] = max(t["max_traced_mb"], round(traced / 1e6, 2))
+            t["peak_traced_mb"] = max(t["peak_traced_mb"], round(peak / 1e6, 2))
+            if top is not None:
+                t["top"] = top
+
+    def write(self, path: str):
+        with self._lock:
+            data = [{"loader": l, "stage": st, **t} for (l, st), t in sorted(self.stages.items())]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+# ====== START / STOP ======
+def _argv_value(argv, flag: str, accept):
+    """--flag, --flag=value или --flag value (value проверяется accept). None — флага нет."""
+    for i, arg in enumerate(argv):
+        if arg == flag:
+            nxt = argv[i + 1] if i + 1 < len(argv) else None
+            return nxt if nxt is not None and accept(nxt) else ""
+        if arg.startswith(flag + "="):
+            return arg.split("=", 1)[1]
+    return None
+
+
+def add_arguments(parser):
+    """Те же флаги для argparse (run_all.py, ф.py), чтобы parse_args их не отвергал."""
+    parser.add_argument("--profile", nargs="?", const="sample", choices=MODES,
+                        help="профилирование: sample (collapsed stacks) или cprofile")
+    parser.add_argument("--profile-out", help="файл профиля (по умолчанию рядом с отчётом запуска)")
+    parser.add_argument("--tracemalloc", nargs="?", const=1, type=int, metavar="FRAMES",
+                        help="снимки tracemalloc на границах этапов")
+
+
+def start_requested(argv=None):
+    """Режим из SMARTUP_PROFILE* и флагов командной строки (флаги важнее)."""
+    argv = sys.argv[1:] if argv is None else argv
+    mode = _argv_value(argv, "--profile", lambda v: v in MODES)
+    out = _argv_value(argv, "--profile-out", lambda v: not v.startswith("-"))
+    frames = _argv_value(argv, "--tracemalloc", str.isdigit)
+    start(
+        mode=(mode or "sample") if mode is not None else PROFILE_MODE,
+        out=out or PROFILE_OUT,
+        tracemalloc_frames=(int(frames) if frames else 1) if frames is not None else TRACEMALLOC_FRAMES,
+    )
+
+
+def start(mode: str = "sample", out: str = None, tracemalloc_frames: int = 0):
+    if _state["started"]:
+        return
+    if mode and mode not in MODES:
+        print(f"⚠️ SMARTUP_PROFILE={mode!r}: ожидается одно из {MODES}")
+        mode = ""
+    if not mode and not tracemalloc_frames:
+        return
+    _state["started"] = True
+    _state["out"] = out or None
+
+    if mode == "sample":
+        _state["sampler"] = Sampler()
+        _state["sampler"].start()
+    elif mode == "cprofile":
+        import cProfile
+
+        _state["cprofile"] = cProfile.Profile()
+        _state["cprofile"].enable()
+
+    if tracemalloc_frames:
+        import run_report
+
+        _state["memory"] = StageMemory(tracemalloc_frames)
+        run_report.STAGE_HOOKS.append(_state["memory"].hook)
+
+    print(f"🔬 Профилирование: {mode or '-'}" + (f" | tracemalloc x{tracemalloc_frames}" if tracemalloc_frames else ""))
+    # atexit — LIFO: stop() отработает раньше, чем run_report запишет отчёт
+    atexit.register(stop)
+
+
+def _output(kind: str, suffix: str, explicit: str = None) -> str:
+    from run_report import report_path
+
+    path = explicit or report_path(suffix)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    OUTPUTS[kind] = path
+    return path
+
+
+def stop():
+    if not _state["started"]:
+        return
+    _state["started"] = False
+    try:
+        sampler, profiler, memory = _state["sampler"], _state["cprofile"], _state["memory"]
+        if sampler is not None:
+            sampler.stop()
+            path = _output("sample", ".collapsed.txt", _state["out"])
+            sampler.write(path)
+            print(f"🔬 Профиль ({sampler.samples} снимков): {path}")
+        if profiler is not None:
+            profiler.disable()
+            path = _output("cprofile", ".prof", _state["out"])
+            profiler.dump_stats(path)
+            print(f"🔬 Профиль cProfile: {path}")
+        if memory is not None:
+            import run_report
+
+            if memory.hook in run_report.STAGE_HOOKS:
+                run_report.STAGE_HOOKS.remove(memory.hook)
+            path = _output("tracemalloc", ".tracemalloc.json")
+            memory.write(path)
+            tracemalloc.stop()
+            print(f"🔬 tracemalloc по этапам: {path}")
+    except OSError as e:
+        print(f"⚠️ Профиль не записан: {e}")
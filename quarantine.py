@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка строк перед staging и карантин для тех, что не пройдут.
+
+Одна строка с длинным штрихкодом или ценой вне DECIMAL(18,4) роняет весь
+fast_executemany, и загрузчик повторяет пакет с fast_executemany = False —
+на порядки медленнее. Здесь каждая строка заранее сверяется со схемой temp
+таблицы (длина, NOT NULL, диапазон DECIMAL/INT, тип даты), плохие уходят в
+dbo.LoadQuarantine с причиной, а основной пакет всегда идёт быстрым путём.
+
+    fact_rows, (group_rows,) = screen(cursor, "api_group",
+                                      ("#TmpFact", fact_rows, balance_fact_schema(5)),
+                                      [("#TmpGroup", group_rows, BALANCE_GROUP_SCHEMA)])
+"""
+import json
+import math
+from datetime import date, datetime
+
+from db import timed
+from run_report import span
+
+QUARANTINE_TABLE = "dbo.LoadQuarantine"
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def balance_fact_schema(inventory_kind_size: int = 50):
+    """#TmpFact balance_data/api_group — кортеж collect_rows (в api_group inventory_kind VARCHAR(5))."""
+    return [
+        ("balance_id", "char", 64, False),
+        ("inventory_kind", "text", inventory_kind_size, True),
+        ("balance_date", "date", None, True),
+        ("warehouse_id", "int", None, True),
+        ("warehouse_code", "text", 200, True),
+        ("product_code", "text", 100, True),
+        ("product_barcode", "text", 100, True),
+        ("product_id", "text", 50, True),
+        ("card_code", "text", 100, True),
+        ("expiry_date", "date", None, True),
+        ("serial_number", "text", 100, True),
+        ("batch_number", "text", 100, True),
+        ("quantity", "decimal", (18, 4), True),
+        ("measure_code", "text", 50, True),
+        ("input_price", "decimal", (18, 4), True),
+        ("filial_id", "int", None, True),
+        ("filial_code", "text", 100, True),
+    ]
+
+
+BALANCE_GROUP_SCHEMA = [("balance_id", "char", 64, False), ("group_code", "text", 100, True),
+                        ("type_code", "text", 200, True)]
+BALANCE_CONDITION_SCHEMA = [("balance_id", "char", 64, False), ("product_condition", "text", 50, False)]
+
+
+def _check(kind: str, size, nullable: bool):
+    """Функция значение -> причина (None — годится)."""
+    def check(v):
+        if v is None:
+            return None if nullable else "NULL"
+        if kind in ("text", "char"):
+            if not isinstance(v, str):
+                v = str(v)
+            return f"длина {len(v)} > {size}" if len(v) > size else None
+        if kind == "decimal":
+            precision, scale = size
+            if isinstance(v, bool) or not isinstance(v, (int, float)) and not hasattr(v, "as_tuple"):
+                return f"не число: {v!r}"[:100]
+            if isinstance(v, float) and not math.isfinite(v):
+                return f"не число: {v!r}"
+            return f"не влезает в DECIMAL({precision},{scale}): {v}" if abs(v) >= 10 ** (precision - scale) else None
+        if kind == "int":
+            if isinstance(v, bool) or not isinstance(v, int):
+                return f"не INT: {v!r}"[:100]
+            return f"вне диапазона INT: {v}" if not INT_MIN <= v <= INT_MAX else None
+        if kind == "date":
+            return None if isinstance(v, date) else f"не дата: {v!r}"[:100]
+        raise ValueError(kind)
+    return check
+
+
+def validate(rows, schema):
+    """
+    schema: [(колонка, вид, размер, nullable)] в порядке кортежа; вид — text/char/decimal/int/date.
+    Возвращает (годные строки, [(строка, причина)]).
+    """
+    checks = [(i, col, _check(kind, size, nullable)) for i, (col, kind, size, nullable) in enumerate(schema)]
+    good, bad = [], []
+    for row in rows:
+        for i, col, check in checks:
+            reason = check(row[i])
+            if reason is not None:
+                bad.append((row, f"{col}: {reason}"))
+                break
+        else:
+            good.append(row)
+    return good, bad
+
+
+def drop_orphans(rows, bad_ids: set, target: str):
+    """Дочерние строки (balance_id первым) отбракованных фактов — тоже в карантин (FK на факт)."""
+    if not bad_ids:
+        return rows, []
+    good, bad = [], []
+    for row in rows:
+        if row[0] in bad_ids:
+            bad.append((row, f"факт в карантине ({target})"))
+        else:
+            good.append(row)
+    return good, bad
+
+
+def screen(cursor, loader: str, fact, children=()):
+    """
+    fact: (target, rows, schema); children: [(target, rows, schema)] — balance_id первым.
+    Плохие строки (и дети плохих фактов) -> LoadQuarantine. Возвращает (факты, [дети...]).
+    """
+    target, rows, schema = fact
+    with span("transform", rows=len(rows) + sum(len(c[1]) for c in children)):
+        good_fact, bad = validate(rows, schema)
+        bad_ids = {row[0] for row, _ in bad}
+        parts, good_children = [(target, bad)], []
+        for c_target, c_rows, c_schema in children:
+            c_good, c_bad = validate(c_rows, c_schema)
+            c_good, orphans = drop_orphans(c_good, bad_ids, target)
+            parts.append((c_target, c_bad + orphans))
+            good_children.append(c_good)
+    for p_target, p_bad in parts:
+        store(cursor, loader, p_target, p_bad)
+    return good_fact, good_children
+
+
+def ensure_table(cursor):
+    cursor.execute(f"""
+IF OBJECT_ID('{QUARANTINE_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {QUARANTINE_TABLE} (
+        id          BIGINT IDENTITY(1,1) NOT NULL PRIMARY KEY,
+        loader      NVARCHAR(64)  NOT NULL,
+        target      NVARCHAR(128) NOT NULL,
+        reason      NVARCHAR(400) NOT NULL,
+        row_json    NVARCHAR(MAX) NOT NULL,
+        created_utc DATETIME2(0)  NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+    CREATE INDEX IX_LoadQuarantine_Loader ON {QUARANTINE_TABLE}(loader, created_utc);
+END
+""")
+
+
+def _json(row) -> str:
+    def default(v):
+        if isinstance(v, (date, datetime)):
+            return v.isoformat()
+        return str(v)
+    return json.dumps(list(row), ensure_ascii=False, default=default)
+
+
+def store(cursor, loader: str, target: str, bad) -> int:
+    """bad: [(строка, причина)] -> LoadQuarantine. Commit — за вызывающим."""
+    if not bad:
+        return 0
+    params = [(loader, target, reason[:400], _json(row)) for row, reason in bad]
+    with span("stage", rows=len(params)), timed(f"quarantine {target}"):
+        # строк мало, а row_json — NVARCHAR(MAX): обычный executemany
+        fast = cursor.fast_executemany
+        cursor.fast_executemany = False
+        cursor.executemany(f"INSERT INTO {QUARANTINE_TABLE} (loader, target, reason, row_json) VALUES (?,?,?,?)",
+                           params)
+        cursor.fast_executemany = fast
+    reasons = {}
+    for _, reason in bad:
+        key = reason.split(":", 1)[0]
+        reasons[key] = reasons.get(key, 0) + 1
+    print(f"🚧 {target}: {len(bad)} строк в {QUARANTINE_TABLE} "
+          f"({', '.join(f'{k}: {n}' for k, n in sorted(reasons.items()))})")
+    return len(bad)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Общий для всех выгрузок ограничитель запросов к smartup.online.
+
+- token bucket: не больше `rate` запросов в секунду (с запасом `burst`)
+- AIMD по параллельности: успех с нормальной задержкой -> лимит +1/лимит
+  (≈ +1 за «круг»), 429/5xx/таймаут или задержка выше порога ->
+  лимит и rate делятся пополам (не чаще раза в DECREASE_COOLDOWN секунд)
+- порог задержки — на вызов: latency_target=..., иначе доля timeout запроса
+  (тяжёлая выгрузка с timeout=120 медленная в норме), иначе LATENCY_TARGET
+- метрики: in-flight, p50/p95 задержки, количество throttle-событий
+
+    from rate_limit import SMARTUP
+    resp = SMARTUP.call(session.post, url, json=payload, timeout=60)
+    SMARTUP.print_metrics()
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+
+THROTTLE_STATUS = {429, 500, 502, 503, 504}
+
+LATENCY_TARGET = 30.0  # сек; ответы дольше — сигнал перегрузки сервера (если у запроса нет timeout)
+TIMEOUT_SHARE = 0.75  # порог = доля timeout запроса: ответ у самой границы таймаута — перегрузка
+DECREASE_COOLDOWN = 5.0
+LATENCY_WINDOW = 200  # последних запросов для p50/p95
+REPORT_EVERY = 30.0  # сек; 0 — не печатать метрики по ходу работы
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, rate: float = 5.0, burst: int = 5, concurrency: float = 4,
+                 min_concurrency: int = 1, max_concurrency: int = 16, min_rate: float = 0.2,
+                 max_rate: float = 20.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._last_report = time.monotonic()
+
+        self.in_flight = 0
+        self.requests = 0
+        self.throttle_events = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    # ====== token bucket ======
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.in_flight < int(self.limit) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+
+    # ====== AIMD ======
+    def _release(self, latency: float, throttled: bool, latency_target: float = LATENCY_TARGET):
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            self._latencies.append(latency)
+            now = time.monotonic()
+            if throttled or latency > latency_target:
+                self.throttle_events += 1
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self._last_decrease = now
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    print(f"🐢 {self.name}: throttle → concurrency={int(self.limit)}, rate={self.rate:.2f}/s")
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + 0.1)
+            self._cond.notify_all()
+            report = REPORT_EVERY and now - self._last_report >= REPORT_EVERY
+            if report:
+                self._last_report = now
+        if report:
+            self.print_metrics()
+
+    @contextmanager
+    def slot(self, latency_target: float = LATENCY_TARGET):
+        """with SMARTUP.slot() as s: resp = ...; s["status"] = resp.status_code"""
+        self._acquire()
+        state = {"status": None}
+        t0 = time.monotonic()
+        throttled = False
+        try:
+            yield state
+        except (requests.Timeout, requests.ConnectionError):
+            throttled = True
+            raise
+        finally:
+            throttled = throttled or state["status"] in THROTTLE_STATUS
+            self._release(time.monotonic() - t0, throttled, latency_target)
+
+    def call(self, fn, *args, latency_target: float = None, **kwargs):
+        """fn(*args, **kwargs) внутри слота; статус ответа учитывается в AIMD."""
+        if latency_target is None:
+            timeout = kwargs.get("timeout")
+            if isinstance(timeout, tuple):  # (connect, read)
+                timeout = timeout[-1]
+            latency_target = timeout * TIMEOUT_SHARE if timeout else LATENCY_TARGET
+        with self.slot(latency_target) as state:
+            resp = fn(*args, **kwargs)
+            state["status"] = getattr(resp, "status_code", None)
+            return resp
+
+    # ====== metrics ======
+    def _percentile(self, values, q):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            lat = list(self._latencies)
+            return {
+                "name": self.name,
+                "in_flight": self.in_flight,
+                "concurrency_limit": int(self.limit),
+                "rate_per_s": round(self.rate, 2),
+                "requests": self.requests,
+                "throttle_events": self.throttle_events,
+                "p50_s": self._percentile(lat, 0.50),
+                "p95_s": self._percentile(lat, 0.95),
+            }
+
+    def print_metrics(self):
+        m = self.snapshot()
+        p50 = f"{m['p50_s']:.2f}s" if m["p50_s"] is not None else "-"
+        p95 = f"{m['p95_s']:.2f}s" if m["p95_s"] is not None else "-"
+        print(f"📈 {m['name']}: in-flight {m['in_flight']}/{m['concurrency_limit']} | "
+              f"rate {m['rate_per_s']}/s | req {m['requests']} | p50 {p50} p95 {p95} | "
+              f"throttle {m['throttle_events']}")
+
+
+# Один ограничитель на процесс для всех запросов к smartup.online
+SMARTUP = AdaptiveLimiter("smartup.online")
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Возвраты (mdeal/return$export) окнами по датам вместо полной выгрузки.
+
+    for date_from, date_to in plan_windows(engine, "new_return"):
+        df_dict = fetch_and_flatten(..., date_from=date_from, date_to=date_to)
+        upload_to_sql(df_dict, watermark=("new_return", date_to, rows))
+
+Окно — begin_date/end_date запроса (как в api.py: по дате доставки/брони),
+WINDOW_DAYS дней; в памяти — только одно окно. После записи окна его конец
+сохраняется в LoadState_Return (в той же транзакции), следующий запуск
+начинает с него минус BUFFER_DAYS — правки недавних возвратов подтягиваются.
+
+Запись по ключу: все строки возвратов окна (deal_id из anor_return) сначала
+удаляются из трёх таблиц (RETURN_KEYS), потом дописываются — повторная
+загрузка окна не даёт дублей, а убранные из возврата товары не остаются.
+"""
+from datetime import date, datetime, timedelta
+
+from run_report import span
+
+BEGIN_DATE = date(2025, 1, 1)
+WINDOW_DAYS = 30
+BUFFER_DAYS = 7
+STATE_TABLE = "LoadState_Return"
+DATE_FORMAT = "%d.%m.%Y"
+
+# таблица -> колонка возврата; дочерние строки заменяются вместе с возвратом
+RETURN_KEYS = {
+    "anor_return": "deal_id",
+    "anor_returnproducts": "order_id",
+    "anor_details": "order_id",
+}
+DELETE_CHUNK = 1000  # SQL Server: не больше 2100 параметров в запросе
+
+
+def today_samarkand() -> date:
+    """Asia/Samarkand ~ UTC+5 (без pytz)"""
+    return (datetime.utcnow() + timedelta(hours=5)).date()
+
+
+def _state_table():
+    from sqlalchemy import Column, Date, DateTime, Integer, MetaData, String, Table
+
+    return Table(STATE_TABLE, MetaData(),
+                 Column("loader", String(64), primary_key=True),
+                 Column("last_date", Date, nullable=False),
+                 Column("last_run_utc", DateTime, nullable=False),
+                 Column("last_rowcount", Integer))
+
+
+def get_watermark(engine, loader: str):
+    from sqlalchemy import select
+
+    table = _state_table()
+    table.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return conn.execute(select(table.c.last_date).where(table.c.loader == loader)).scalar()
+
+
+def set_watermark(conn, loader: str, last_date: date, rows: int):
+    table = _state_table()
+    conn.execute(table.delete().where(table.c.loader == loader))
+    conn.execute(table.insert().values(loader=loader, last_date=last_date, last_run_utc=datetime.utcnow(),
+                                       last_rowcount=rows))
+
+
+def plan_windows(engine, loader: str, end: date = None, step_days: int = WINDOW_DAYS):
+    """[(date_from, date_to)] от водяного знака (минус буфер) или BEGIN_DATE до сегодня."""
+    end = end or today_samarkand()
+    last = get_watermark(engine, loader)
+    current = max(BEGIN_DATE, last - timedelta(days=BUFFER_DAYS)) if last else BEGIN_DATE
+    print(f"🗓 {loader}: с {current:%d.%m.%Y} по {end:%d.%m.%Y}"
+          + (f" (загружено по {last:%d.%m.%Y})" if last else " (первый запуск)"))
+    windows = []
+    while current <= end:
+        finish = min(current + timedelta(days=step_days - 1), end)
+        windows.append((current, finish))
+        current = finish + timedelta(days=1)
+    return windows
+
+
+def window_payload(date_from: date, date_to: date) -> dict:
+    return {"begin_date": date_from.strftime(DATE_FORMAT), "end_date": date_to.strftime(DATE_FORMAT)}
+
+
+def return_ids(df_dict) -> list:
+    """deal_id возвратов окна (из anor_return, до приведения типов)."""
+    import pandas as pd
+
+    df = df_dict.get("anor_return")
+    if df is None or "deal_id" not in df.columns:
+        return []
+    return sorted({int(v) for v in pd.to_numeric(df["deal_id"], errors="coerce").dropna()})
+
+
+def delete_keys(conn, table_name: str, ids) -> int:
+    """Удаляет из table_name строки возвратов ids (колонка — RETURN_KEYS) перед дозаписью."""
+    from sqlalchemy import bindparam, inspect, text
+
+    column = RETURN_KEYS.get(table_name)
+    if column is None or not ids or not inspect(conn).has_table(table_name):
+        return 0
+    stmt = text(f"DELETE FROM {table_name} WHERE {column} IN :ids").bindparams(bindparam("ids", expanding=True))
+    deleted = 0
+    with span("merge", rows=len(ids)):
+        for i in range(0, len(ids), DELETE_CHUNK):
+            deleted += conn.execute(stmt, {"ids": ids[i:i + DELETE_CHUNK]}).rowcount or 0
+    return deleted
+
+
+def drop_nested(df):
+    """Колонки со списками/словарями (вложенные товары, детали) в SQL не пишутся."""
+    nested = [c for c in df.columns if df[c].dtype == object
+              and df[c].map(lambda v: isinstance(v, (list, dict))).any()]
+    return df.drop(columns=nested) if nested else df
+
+
+def align_columns(conn, table_name: str, df):
+    """Окно может принести колонку, которой нет в таблице (её создало первое окно) — такие отбрасываются."""
+    from sqlalchemy import inspect
+
+    inspector = inspect(conn)
+    if not inspector.has_table(table_name):
+        return df
+    existing = {c["name"] for c in inspector.get_columns(table_name)}
+    extra = [c for c in df.columns if c not in existing]
+    if extra:
+        print(f"⚠️ {table_name}: нет колонок {', '.join(extra)} — пропущены")
+        df = df.drop(columns=extra)
+    return df
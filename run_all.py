@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Единая точка запуска всех выгрузок SmartUp в одном процессе.
+
+    python run_all.py                      # все задачи
+    python run_all.py --jobs balance,order # только выбранные (+ их зависимости)
+    python run_all.py --workers 2
+    python run_all.py --profile --tracemalloc  # см. profiling.py
+
+Конфигурация читается один раз, вход в smartup.online (smartup_session.py)
+выполняется один раз, HTTP-сессия и пул подключений к БД (db.py) общие для всех задач.
+Задачи описаны как DAG (JOBS): задача стартует, когда выполнены все её
+зависимости; независимые задачи идут параллельно.
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+import db
+import profiling
+import run_report
+from http_transport import make_session, print_transfer_stats
+from rate_limit import SMARTUP
+
+# ====== JOBS ======
+# Каждая задача получает общий ctx и возвращает количество строк.
+def job_auth(ctx):
+    from smartup_session import get_session
+
+    # сохранённые cookies -> Basic auth -> браузер (см. smartup_session.py)
+    get_session(ctx["session"])
+    return 0
+
+
+def job_balance(ctx):
+    import balance_data
+
+    filial_warehouse_list, product_conditions = ctx["balance_config"]
+    return balance_data.main(filial_warehouse_list, product_conditions, session=ctx["session"],
+                             resume=ctx["resume"], queue=ctx["queue"])
+
+
+def job_inventory(ctx):
+    import inventory
+
+    return inventory.main(cookies=ctx["cookies"], session=ctx["session"])
+
+
+def job_order(ctx):
+    import order_group
+
+    return order_group.main(cookies=ctx["cookies"], session=ctx["session"])
+
+
+def job_return(ctx):
+    import new_return
+
+    return new_return.main(cookies=ctx["cookies"], session=ctx["session"])
+
+
+# имя -> (функция, зависимости)
+JOBS = {
+    "auth": (job_auth, []),
+    "balance": (job_balance, []),  # Basic auth, cookies не нужны
+    "inventory": (job_inventory, ["auth"]),
+    "order": (job_order, ["auth"]),
+    "return": (job_return, ["auth"]),
+}
+
+
+def resolve(selected):
+    """Выбранные задачи + все их зависимости."""
+    result = set()
+    stack = list(selected)
+    while stack:
+        name = stack.pop()
+        if name not in JOBS:
+            raise SystemExit(f"❌ Неизвестная задача: {name}. Есть: {', '.join(JOBS)}")
+        if name not in result:
+            result.add(name)
+            stack.extend(JOBS[name][1])
+    return result
+
+
+def run_dag(names, ctx, workers: int):
+    """Запускает задачи по готовности зависимостей. Возвращает {name: report}."""
+    report = {}
+    pending = set(names)
+    running = {}
+
+    def _run(name):
+        fn = JOBS[name][0]
+        t0 = time.perf_counter()
+        try:
+            with run_report.loader(name):
+                rows = fn(ctx)
+            return {"status": "ok", "rows": rows or 0, "seconds": time.perf_counter() - t0}
+        except Exception as e:
+            return {"status": "failed", "rows": 0, "seconds": time.perf_counter() - t0, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job") as pool:
+        while pending or running:
+            for name in sorted(pending):
+                deps = JOBS[name][1]
+                if any(report.get(d, {}).get("status") not in (None, "ok") for d in deps):
+                    report[name] = {"status": "skipped", "rows": 0, "seconds": 0.0,
+                                    "error": "dependency failed"}
+                    pending.discard(name)
+                elif all(report.get(d, {}).get("status") == "ok" for d in deps):
+                    print(f"▶️  {name}")
+                    running[pool.submit(_run, name)] = name
+                    pending.discard(name)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                report[name] = fut.result()
+                r = report[name]
+                mark = "✅" if r["status"] == "ok" else "❌"
+                print(f"{mark} {name}: {r['status']} | {r['seconds']:.1f} s | rows={r['rows']}"
+                      + (f" | {r['error']}" if r.get("error") else ""))
+    return report
+
+
+def print_report(report):
+    print("\n📊 Итог:")
+    print(f"   {'job':12s} {'status':8s} {'seconds':>9s} {'rows':>10s}")
+    for name in JOBS:
+        if name in report:
+            r = report[name]
+            print(f"   {name:12s} {r['status']:8s} {r['seconds']:9.1f} {r['rows']:10d}")
+    SMARTUP.print_metrics()
+    run_report.print_report()
+    print_transfer_stats()
+    db.print_timings()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SmartUp: все выгрузки в одном процессе")
+    parser.add_argument("--jobs", default=",".join(n for n in JOBS if n != "auth"),
+                        help="через запятую: " + ", ".join(JOBS))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--resume", action="store_true",
+                        help="balance: только окна из журнала неудачных загрузок")
+    parser.add_argument("--queue", action="store_true",
+                        help="balance: режим очереди dbo.WorkLease (несколько процессов/машин)")
+    # сами флаги разбирает profiling при импорте run_report
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    names = resolve([n.strip() for n in args.jobs.split(",") if n.strip()])
+
+    # конфиг — один раз
+    ctx = {"session": make_session(args.workers), "cookies": None, "resume": args.resume, "queue": args.queue}
+    if "balance" in names:
+        import balance_data
+        ctx["balance_config"] = balance_data.load_config()
+
+    report = run_dag(names, ctx, args.workers)
+    print_report(report)
+    return 0 if all(r["status"] == "ok" for r in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Замеры по этапам загрузки: fetch, parse, transform, stage, merge, commit.
+
+    from run_report import loader, span
+
+    with loader("balance_data"):
+        with span("fetch"):
+            resp = ...
+        with span("parse", bytes_=len(resp.content)) as s:
+            data = resp.json()
+            s.rows = len(data["balance"])
+
+Каждый span пишет время, строки, байты и пиковый RSS процесса; итоги
+агрегируются по (loader, stage). При выходе из процесса отчёт пишется в JSON
+(RUN_REPORT_DIR, по умолчанию .run_reports/), а если задан RUN_REPORT_SQL
+("server/database") — ещё и в dbo.LoadRunLog.
+"""
+import atexit
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+STAGES = ("fetch", "parse", "transform", "stage", "merge", "commit")
+
+RUN_REPORT_DIR = os.environ.get(
+    "RUN_REPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".run_reports"),
+)
+RUN_REPORT_SQL = os.environ.get("RUN_REPORT_SQL", "")  # "localhost/SmartUpDB"
+LOG_TABLE = "dbo.LoadRunLog"
+
+RUN_ID = uuid.uuid4().hex[:12]
+STARTED_AT = datetime.now()
+_t0 = time.perf_counter()
+
+# (loader, stage) -> {"count", "seconds", "rows", "bytes", "peak_rss_mb", "errors"}
+STAGE_TOTALS = {}
+# loader -> {"seconds", "status", "error"}
+LOADERS = {}
+_lock = threading.Lock()
+_local = threading.local()
+# fn(event, span): event — "start" / "end"; так profiling.py снимает tracemalloc на границах этапов
+STAGE_HOOKS = []
+
+
+# ====== RSS ======
+def peak_rss_mb():
+    """Пиковый RSS процесса в MB (Linux/macOS: resource, Windows: psapi) или None."""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return round(counters.PeakWorkingSetSize / 1024 / 1024, 1)
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+# ====== SPANS ======
+def _default_loader() -> str:
+    return os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+
+
+def current_loader() -> str:
+    return getattr(_local, "loader", None) or _default_loader()
+
+
+class Span:
+    __slots__ = ("loader", "stage", "rows", "bytes")
+
+    def __init__(self, loader, stage, rows=None, bytes_=None):
+        self.loader = loader
+        self.stage = stage
+        self.rows = rows
+        self.bytes = bytes_
+
+
+@contextmanager
+def span(stage: str, rows: int = None, bytes_: int = None, loader: str = None):
+    """with span("merge", rows=len(rows)): cursor.execute(MERGE ...)"""
+    s = Span(loader or current_loader(), stage, rows, bytes_)
+    for hook in STAGE_HOOKS:
+        hook("start", s)
+    t0 = time.perf_counter()
+    error = False
+    try:
+        yield s
+    except BaseException:
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        rss = peak_rss_mb()
+        with _lock:
+            t = STAGE_TOTALS.setdefault((s.loader, s.stage), {"count": 0, "seconds": 0.0, "rows": 0, "bytes": 0,
+                                                               "peak_rss_mb": None, "errors": 0})
+            t["count"] += 1
+            t["seconds"] += seconds
+            t["rows"] += s.rows or 0
+            t["bytes"] += s.bytes or 0
+            t["errors"] += error
+            if rss is not None:
+                t["peak_rss_mb"] = max(t["peak_rss_mb"] or 0, rss)
+        for hook in STAGE_HOOKS:
+            hook("end", s)
+
+
+@contextmanager
+def loader(name: str):
+    """Все span внутри (в этом потоке) относятся к загрузчику name."""
+    prev = getattr(_local, "loader", None)
+    _local.loader = name
+    t0 = time.perf_counter()
+    status, error = "ok", None
+    try:
+        yield
+    except BaseException as e:
+        status, error = "failed", str(e)[:500]
+        raise
+    finally:
+        with _lock:
+            LOADERS[name] = {"seconds": round(time.perf_counter() - t0, 3), "status": status, "error": error}
+        _local.loader = prev
+
+
+# ====== REPORT ======
+def build_report() -> dict:
+    with _lock:
+        stages = [{"loader": l, "stage": st, **{k: (round(v, 3) if isinstance(v, float) else v)
+                                                 for k, v in t.items()}}
+                  for (l, st), t in sorted(STAGE_TOTALS.items(),
+                                           key=lambda kv: (kv[0][0], STAGES.index(kv[0][1])
+                                                           if kv[0][1] in STAGES else len(STAGES)))]
+        loaders = dict(LOADERS)
+    report = {
+        "run_id": RUN_ID,
+        "started_at": STARTED_AT.isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - _t0, 3),
+        "host": socket.gethostname(),
+        "argv": sys.argv,
+        "peak_rss_mb": peak_rss_mb(),
+        "loaders": loaders,
+        "stages": stages,
+    }
+    # то, что уже собирают другие модули (если они загружены)
+    db = sys.modules.get("db")
+    if db is not None:
+        report["sql_timings"] = {k: {"count": c, "seconds": round(s, 3)} for k, (c, s) in db.TIMINGS.items()}
+    transport = sys.modules.get("http_transport")
+    if transport is not None:
+        report["transfer"] = {k: {**v, "encodings": sorted(v["encodings"])} for k, v in transport.TRANSFER.items()}
+    limiter = sys.modules.get("rate_limit")
+    if limiter is not None:
+        report["rate_limit"] = limiter.SMARTUP.snapshot()
+    profiling = sys.modules.get("profiling")
+    if profiling is not None and profiling.OUTPUTS:
+        report["profiling"] = dict(profiling.OUTPUTS)
+    return report
+
+
+def report_path(suffix: str = ".json") -> str:
+    """Файл рядом с отчётом этого запуска: .run_reports/20250301_020000_balance_data_<run_id><suffix>"""
+    name = f"{STARTED_AT:%Y%m%d_%H%M%S}_{_default_loader()}_{RUN_ID}{suffix}"
+    return os.path.join(RUN_REPORT_DIR, name)
+
+
+def write_report(path: str = None) -> str:
+    path = path or report_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(build_report(), f, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp, path)
+    return path
+
+
+def log_to_sql(conn, report: dict = None):
+    """Одна строка на (loader, stage) в dbo.LoadRunLog."""
+    report = report or build_report()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+IF OBJECT_ID('{LOG_TABLE}', 'U') IS NULL
+CREATE TABLE {LOG_TABLE} (
+    id          BIGINT IDENTITY(1,1) NOT NULL CONSTRAINT PK_LoadRunLog PRIMARY KEY,
+    run_id      VARCHAR(32)   NOT NULL,
+    started_at  DATETIME2(0)  NOT NULL,
+    host        NVARCHAR(128) NULL,
+    loader      NVARCHAR(64)  NOT NULL,
+    stage       NVARCHAR(32)  NOT NULL,
+    calls       INT           NOT NULL,
+    seconds     FLOAT         NOT NULL,
+    rows_count  BIGINT        NOT NULL,
+    bytes_count BIGINT        NOT NULL,
+    peak_rss_mb FLOAT         NULL,
+    errors      INT           NOT NULL,
+    status      NVARCHAR(16)  NULL
+);
+""")
+    started = datetime.fromisoformat(report["started_at"])
+    rows = [(report["run_id"], started, report["host"], s["loader"], s["stage"], s["count"], s["seconds"],
+             s["rows"], s["bytes"], s["peak_rss_mb"], s["errors"],
+             report["loaders"].get(s["loader"], {}).get("status"))
+            for s in report["stages"]]
+    if rows:
+        cursor.executemany(f"""
+INSERT INTO {LOG_TABLE} (run_id, started_at, host, loader, stage, calls, seconds, rows_count, bytes_count,
+                         peak_rss_mb, errors, status)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+""", rows)
+    conn.commit()
+    cursor.close()
+
+
+def print_report():
+    report = build_report()
+    if not report["stages"]:
+        return
+    print("🧭 Этапы:")
+    print(f"   {'loader':14s} {'stage':10s} {'calls':>6s} {'seconds':>9s} {'rows':>10s} {'MB':>9s} {'RSS MB':>8s}")
+    for s in report["stages"]:
+        rss = f"{s['peak_rss_mb']:.0f}" if s["peak_rss_mb"] is not None else "-"
+        print(f"   {s['loader']:14s} {s['stage']:10s} {s['count']:6d} {s['seconds']:9.2f} {s['rows']:10d} "
+              f"{s['bytes'] / 1e6:9.2f} {rss:>8s}")
+
+
+@atexit.register
+def _flush():
+    if not STAGE_TOTALS and not LOADERS:
+        return
+    try:
+        path = write_report()
+        print(f"🧾 Отчёт о запуске: {path}")
+    except OSError as e:
+        print(f"⚠️ Отчёт о запуске не записан: {e}")
+    if RUN_REPORT_SQL:
+        try:
+            from db import get_connection
+
+            server, database = RUN_REPORT_SQL.split("/", 1)
+            log_to_sql(get_connection(server, database))
+            print(f"🧾 Отчёт о запуске записан в {LOG_TABLE}")
+        except Exception as e:
+            print(f"⚠️ {LOG_TABLE}: {e}")
+
+
+# SMARTUP_PROFILE / SMARTUP_TRACEMALLOC или --profile / --tracemalloc: профилирование с самого старта
+if (os.environ.get("SMARTUP_PROFILE") or os.environ.get("SMARTUP_TRACEMALLOC")
+        or any(a.startswith(("--profile", "--tracemalloc")) for a in sys.argv[1:])):
+    import profiling
+
+    profiling.start_requested()
@@ -1,112 +1,163 @@
-import pyodbc
 import json
+import os
 
-conn = pyodbc.connect(
-    "DRIVER={ODBC Driver 17 for SQL Server};"
-    "SERVER=localhost;"
-    "DATABASE=SmartUpDB;"
-    "Trusted_Connection=yes;"
-)
-
-cursor = conn.cursor()
-print("✅ Успешное подключение к SQL Server")
-
-# Читаем JSON
-with open("final_all.json", "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-if isinstance(data, dict) and "balance" in data:
-    data = data["balance"]
-
-rows = []
-for item in data:
-    groups = item.get("groups", [])
-    if not groups:
-        groups = [{"group_code": None, "type_code": None}]
-    for g in groups:
-        rows.append((
-            item.get("inventory_kind"),
-            item.get("date"),
-            int(item["warehouse_id"]) if item.get("warehouse_id") else None,
-            item.get("warehouse_code"),
-            item.get("product_code"),
-            item.get("product_barcode"),
-            item.get("product_id"),
-            item.get("card_code"),
-            item.get("expiry_date"),
-            item.get("serial_number"),
-            item.get("batch_number"),
-            float(item["quantity"]) if item.get("quantity") else None,
-            item.get("measure_code"),
-            float(item["input_price"]) if item.get("input_price") else None,
-            int(item["filial_id"]) if item.get("filial_id") else None,
-            item.get("filial_code"),
-            g.get("group_code"),
-            g.get("type_code")
-        ))
-
-# Создаём временную таблицу
-cursor.execute("""
-CREATE TABLE #TempBalanceData (
-    inventory_kind NVARCHAR(MAX),
-    [date] DATE,
-    warehouse_id INT,
-    warehouse_code NVARCHAR(MAX),
-    product_code NVARCHAR(MAX),
-    product_barcode NVARCHAR(MAX),
-    product_id NVARCHAR(MAX),
-    card_code NVARCHAR(MAX),
-    expiry_date DATE,
-    serial_number NVARCHAR(MAX),
-    batch_number NVARCHAR(MAX),
-    quantity FLOAT,
-    measure_code NVARCHAR(MAX),
-    input_price FLOAT,
-    filial_id INT,
-    filial_code NVARCHAR(MAX),
-    group_code NVARCHAR(MAX),
-    type_code NVARCHAR(MAX)
-)
-""")
-
-# Вставляем все данные во временную таблицу
-cursor.fast_executemany = True
-cursor.executemany("""
-INSERT INTO #TempBalanceData VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-""", rows)
-
-# MERGE во главную таблицу, вставляем только новые записи
-cursor.execute("""
-MERGE BalanceData AS target
-USING #TempBalanceData AS source
-ON target.warehouse_id = source.warehouse_id
-   AND target.product_code = source.product_code
-   AND target.[date] = source.[date]
-   AND target.batch_number = source.batch_number
-WHEN NOT MATCHED BY TARGET THEN
-INSERT (
-    inventory_kind, [date], warehouse_id, warehouse_code,
-    product_code, product_barcode, product_id, card_code,
-    expiry_date, serial_number, batch_number, quantity,
-    measure_code, input_price, filial_id, filial_code,
-    group_code, type_code
-)
-VALUES (
-    source.inventory_kind, source.[date], source.warehouse_id, source.warehouse_code,
-    source.product_code, source.product_barcode, source.product_id, source.card_code,
-    source.expiry_date, source.serial_number, source.batch_number, source.quantity,
-    source.measure_code, source.input_price, source.filial_id, source.filial_code,
-    source.group_code, source.type_code
-);
-""")  # ← точка с запятой в конце
-
-
-# Удаляем временную таблицу
-cursor.execute("DROP TABLE #TempBalanceData")
-
-conn.commit()
-cursor.close()
-conn.close()
-
-print("✅ Данные успешно загружены в SQL Server (только новые записи, быстро!)")
+from balancedata_schema import KEY_COLUMNS, drop_staging, ensure_balancedata_keys, stage_rows
+from db import get_connection, print_timings, timed
+from run_report import span
 
+BALANCE_JSON = "final_all.json"
+
+# Заглушка для товаров без групп — одна строка с пустой группой
+_NO_GROUPS = ({"group_code": None, "type_code": None},)
+
+# колонки #TempBalanceData в порядке кортежей build_rows; TEXT — NVARCHAR(n), не MAX
+STAGING_COLUMNS = {
+    "inventory_kind": "TEXT",
+    "[date]": "DATE",
+    "warehouse_id": "INT",
+    "warehouse_code": "TEXT",
+    "product_code": "TEXT",
+    "product_barcode": "TEXT",
+    "product_id": "TEXT",
+    "card_code": "TEXT",
+    "expiry_date": "DATE",
+    "serial_number": "TEXT",
+    "batch_number": "TEXT",
+    "quantity": "FLOAT",
+    "measure_code": "TEXT",
+    "input_price": "FLOAT",
+    "filial_id": "INT",
+    "filial_code": "TEXT",
+    "group_code": "TEXT",
+    "type_code": "TEXT",
+}
+
+
+def connect_sql():
+    conn = get_connection("localhost", "SmartUpDB")
+    print("✅ Успешное подключение к SQL Server")
+    return conn
+
+
+def _fact_fields(item):
+    """Поля факта (без групп) — считаются один раз на item."""
+    get = item.get
+    warehouse_id = get("warehouse_id")
+    quantity = get("quantity")
+    input_price = get("input_price")
+    filial_id = get("filial_id")
+    return (
+        get("inventory_kind"),
+        get("date"),
+        int(warehouse_id) if warehouse_id else None,
+        get("warehouse_code"),
+        get("product_code"),
+        get("product_barcode"),
+        get("product_id"),
+        get("card_code"),
+        get("expiry_date"),
+        get("serial_number"),
+        get("batch_number"),
+        float(quantity) if quantity else None,
+        get("measure_code"),
+        float(input_price) if input_price else None,
+        int(filial_id) if filial_id else None,
+        get("filial_code"),
+    )
+
+
+def build_rows(data):
+    """
+    Плоские строки для #TempBalanceData: одна строка на (item, группа).
+    Поля факта конвертируются один раз, затем размножаются по группам.
+    """
+    rows = []
+    append = rows.append
+    for item in data:
+        fact = _fact_fields(item)
+        for g in item.get("groups") or _NO_GROUPS:
+            append(fact + (g.get("group_code"), g.get("type_code")))
+    return rows
+
+
+def build_columns(data):
+    """
+    Колоночный вариант: факты отдельно, группы отдельно со ссылкой на индекс факта.
+    Возвращает (fact_rows, group_rows), где group_rows = [(fact_idx, group_code, type_code)].
+    """
+    fact_rows = []
+    group_rows = []
+    for idx, item in enumerate(data):
+        fact_rows.append(_fact_fields(item))
+        for g in item.get("groups") or _NO_GROUPS:
+            group_rows.append((idx, g.get("group_code"), g.get("type_code")))
+    return fact_rows, group_rows
+
+
+def load_to_sql(conn, rows):
+    cursor = conn.cursor()
+
+    # Ключевые колонки ограниченной длины + индексы под MERGE
+    still_max = ensure_balancedata_keys(cursor)
+    conn.commit()
+
+    # Временная таблица с NVARCHAR(n) + setinputsizes; длинные строки — отдельно (Overflow)
+    with span("stage", rows=len(rows)), timed("stage #TempBalanceData"):
+        source = stage_rows(cursor, "#TempBalanceData", STAGING_COLUMNS, rows,
+                            bounded_keys=set(KEY_COLUMNS) - still_max)
+
+    # MERGE во главную таблицу, вставляем только новые записи
+    with span("merge", rows=len(rows)), timed("merge BalanceData"):
+        cursor.execute(f"""
+        MERGE BalanceData AS target
+        USING {source} AS source
+        ON target.warehouse_id = source.warehouse_id
+           AND target.product_code = source.product_code
+           AND target.[date] = source.[date]
+           AND target.batch_number = source.batch_number
+        WHEN NOT MATCHED BY TARGET THEN
+        INSERT (
+            inventory_kind, [date], warehouse_id, warehouse_code,
+            product_code, product_barcode, product_id, card_code,
+            expiry_date, serial_number, batch_number, quantity,
+            measure_code, input_price, filial_id, filial_code,
+            group_code, type_code
+        )
+        VALUES (
+            source.inventory_kind, source.[date], source.warehouse_id, source.warehouse_code,
+            source.product_code, source.product_barcode, source.product_id, source.card_code,
+            source.expiry_date, source.serial_number, source.batch_number, source.quantity,
+            source.measure_code, source.input_price, source.filial_id, source.filial_code,
+            source.group_code, source.type_code
+        );
+        """)  # ← точка с запятой в конце
+
+    # Удаляем временную таблицу
+    drop_staging(cursor, "#TempBalanceData")
+
+    with span("commit"):
+        conn.commit()
+    cursor.close()
+
+
+def main():
+    conn = connect_sql()
+
+    # Читаем JSON
+    with span("parse", bytes_=os.path.getsize(BALANCE_JSON)), open(BALANCE_JSON, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    if isinstance(data, dict) and "balance" in data:
+        data = data["balance"]
+
+    with span("transform") as tr:
+        rows = build_rows(data)
+        tr.rows = len(rows)
+    load_to_sql(conn, rows)
+    print_timings()
+
+    print("✅ Данные успешно загружены в SQL Server (только новые записи, быстро!)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-import requests
 import json
+import os
 from datetime import datetime, timedelta
 
+from fetch_retry import FailureJournal, RetryStats, post_json, resume_requested
+from http_transport import make_session, print_transfer_stats
+
 url = "https://smartup.online/b/anor/mxsx/mkw/balance$export"
 username = "powerbi@epco"
 password = "said_2021"
@@ -20,10 +23,24 @@ def daterange(start_date, end_date, step_days=30):
 with open("filial_warehouse.json", "r", encoding="utf-8") as f:
     filial_warehouse_list = json.load(f)
 
+OUTPUT_JSON = "final_all12.json"
+
+# --resume: качаем только окна из журнала неудач и дописываем в уже сохранённый файл
+resume = resume_requested()
+journal = FailureJournal("smartup")
+stats = RetryStats()
+session = make_session()
+
 # Итоговый словарь
 final_data = {"balance": []}
 seen = set()  # сюда складываем уникальные записи
 
+if resume and os.path.exists(OUTPUT_JSON):
+    with open(OUTPUT_JSON, "r", encoding="utf-8") as f:
+        final_data = json.load(f)
+    for item in final_data["balance"]:
+        seen.add(json.dumps(item, sort_keys=True, ensure_ascii=False))
+
 # Укажи диапазон дат сам
 begin_date = datetime.strptime("15.02.2025", DATE_FORMAT)
 end_date   = datetime.strptime("15.04.2025", DATE_FORMAT)
@@ -34,7 +51,13 @@ for entry in filial_warehouse_list:
     warehouse_id = entry["warehouse_id"]
     warehouse_code = entry["warehouse_code"]
 
-    for start, finish in daterange(begin_date, end_date, step_days=30):
+    scope = f"filial={filial_id}|warehouse={warehouse_id}"
+    if resume:
+        windows = journal.windows(scope)
+    else:
+        windows = daterange(begin_date, end_date, step_days=30)
+
+    for start, finish in windows:
         params = {"filial_id": filial_id}
         payload = {
             "warehouse_codes": [{"warehouse_code": warehouse_code}],
@@ -44,17 +67,16 @@ for entry in filial_warehouse_list:
         }
 
         try:
-            response = requests.post(
+            data = post_json(
+                session,
                 url,
+                stats=stats,
                 params=params,
                 auth=(username, password),
                 headers={"Content-Type": "application/json"},
                 data=json.dumps(payload),
                 timeout=60
             )
-            response.raise_for_status()
-
-            data = response.json()
             balance_data = data.get("balance", [])
 
             added_count = 0
@@ -72,12 +94,18 @@ for entry in filial_warehouse_list:
                     added_count += 1
 
             print(f"✅ {start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | filial={filial_code} | warehouse={warehouse_code} | {len(balance_data)} items ({added_count} new)")
+            journal.mark_done(scope, start, finish)
 
         except Exception as e:
             print(f"⚠️ Ошибка | filial={filial_code} | warehouse={warehouse_code} | {start.strftime(DATE_FORMAT)} - {finish.strftime(DATE_FORMAT)} | {e}")
+            journal.record_failure(scope, start, finish, e)
+            stats.add(failed_units=1)
 
 # Сохраняем итог в один файл
-with open("final_all12.json", "w", encoding="utf-8") as f:
+with open(OUTPUT_JSON, "w", encoding="utf-8") as f:
     json.dump(final_data, f, ensure_ascii=False, indent=4)
 
-print(f"💾 All data saved to final_all12.json | Total unique records: {len(final_data['balance'])}")
+print(f"💾 All data saved to {OUTPUT_JSON} | Total unique records: {len(final_data['balance'])}")
+stats.print_summary()
+print_transfer_stats()
+journal.print_pending()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Сессия smartup.online без ручного входа на каждом запуске.
+
+get_session() возвращает requests.Session, готовый к запросам:
+  1) cookies из файла (SESSION_FILE), если не истекли и проходят пробный запрос
+  2) иначе Basic auth (как в api.py), если проходит пробный запрос
+  3) иначе вход через браузер (только в интерактивном запуске), cookies
+     сохраняются в файл вместе со сроком действия
+
+Истёкшей сессия считается только при 401/403 или странице входа вместо JSON.
+Сеть, таймаут, 429/5xx — временный сбой: пробный запрос повторяется, затем
+SessionProbeError; файл cookies при этом не трогается.
+
+Файл общий для всех процессов; запись атомарная (tmp + os.replace).
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+from http_transport import make_session
+from rate_limit import SMARTUP, THROTTLE_STATUS
+
+BASE_URL = "https://smartup.online"
+USERNAME = "powerbi@epco"
+PASSWORD = "said_2021"
+
+SESSION_FILE = os.environ.get(
+    "SMARTUP_SESSION_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".smartup_session.json"),
+)
+# срок для cookies без expiry (сессионные cookies браузера)
+SESSION_COOKIE_TTL = 8 * 3600
+
+# Дешёвый авторизованный запрос: заказы за один день в прошлом -> пустой ответ
+PROBE_URL = "https://smartup.online/b/trade/txs/tdeal/order$export"
+PROBE_PAYLOAD = {"begin_deal_date": "01.01.2000", "end_deal_date": "01.01.2000"}
+PROBE_TIMEOUT = 30
+PROBE_ATTEMPTS = 3
+PROBE_BACKOFF = 5.0  # сек, удваивается
+EXPIRED_STATUS = {401, 403}
+
+_login_lock = threading.Lock()
+
+
+# ====== FILE STORE ======
+def load_cookies(path: str = SESSION_FILE):
+    """Непросроченные cookies из файла (список dict) или []."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return []
+    now = time.time()
+    return [c for c in stored.get("cookies", []) if (c.get("expiry") or 0) > now]
+
+
+def save_cookies(cookies, path: str = SESSION_FILE):
+    """cookies: список dict как у selenium driver.get_cookies()."""
+    now = time.time()
+    stored = []
+    for c in cookies:
+        stored.append({
+            "name": c["name"],
+            "value": c["value"],
+            "domain": c.get("domain"),
+            "path": c.get("path") or "/",
+            "expiry": c.get("expiry") or now + SESSION_COOKIE_TTL,
+        })
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": now, "cookies": stored}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def clear_cookies(path: str = SESSION_FILE):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# ====== PROBE ======
+class SessionProbeError(RuntimeError):
+    """Пробный запрос не дал ответа (сеть, 429/5xx) — про сессию ничего не известно."""
+
+
+def probe(session: requests.Session) -> bool:
+    """
+    True — сессия авторизована, False — истекла (401/403 или страница входа).
+    Временные сбои повторяются PROBE_ATTEMPTS раз, затем SessionProbeError.
+    """
+    delay = PROBE_BACKOFF
+    for attempt in range(1, PROBE_ATTEMPTS + 1):
+        try:
+            r = SMARTUP.call(session.post, PROBE_URL, json=PROBE_PAYLOAD, timeout=PROBE_TIMEOUT)
+        except requests.RequestException as e:
+            problem = str(e)
+        else:
+            if r.status_code in EXPIRED_STATUS:
+                return False
+            if r.status_code == 200:
+                try:
+                    r.json()
+                except ValueError:
+                    return False  # страница входа
+                return True
+            if r.status_code not in THROTTLE_STATUS:
+                raise SessionProbeError(f"SmartUp: неожиданный ответ проверки сессии: HTTP {r.status_code}")
+            problem = f"HTTP {r.status_code}"
+        print(f"⚠️ Проверка сессии не удалась ({attempt}/{PROBE_ATTEMPTS}): {problem}")
+        if attempt < PROBE_ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
+    raise SessionProbeError(f"SmartUp недоступен при проверке сессии: {problem}. Cookies сохранены, "
+                            f"повторите запуск позже.")
+
+
+# ====== LOGIN ======
+def browser_login(url: str = BASE_URL):
+    """Открывает Chrome, ждёт ручного входа, возвращает cookies (список dict)."""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    chrome_options = Options()
+    chrome_options.add_argument("--start-maximized")
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.get(url)
+    input("🌐 Авторизуйтесь в браузере и нажмите Enter...")
+    cookies = driver.get_cookies()
+    driver.quit()
+    return cookies
+
+
+def _apply_cookies(session: requests.Session, cookies):
+    for c in cookies:
+        session.cookies.set(c["name"], c["value"], domain=c.get("domain") or "", path=c.get("path") or "/")
+
+
+def get_session(session: requests.Session = None, allow_browser: bool = None) -> requests.Session:
+    """
+    Авторизованная сессия. allow_browser=None — браузер только если есть терминал.
+    """
+    session = session or make_session()
+    if allow_browser is None:
+        allow_browser = sys.stdin is not None and sys.stdin.isatty()
+
+    with _login_lock:
+        # 1) сохранённые cookies
+        cookies = load_cookies()
+        if cookies:
+            _apply_cookies(session, cookies)
+            if probe(session):
+                print("🔑 Сессия SmartUp: сохранённые cookies")
+                return session
+            session.cookies.clear()
+            clear_cookies()
+
+        # 2) Basic auth
+        session.auth = (USERNAME, PASSWORD)
+        if probe(session):
+            print("🔑 Сессия SmartUp: Basic auth")
+            return session
+        session.auth = None
+
+        # 3) браузер
+        if not allow_browser:
+            raise RuntimeError("SmartUp: сессия истекла, Basic auth не принят, а вход через браузер недоступен "
+                               "(нет терминала). Запустите один раз вручную для входа.")
+        cookies = browser_login()
+        save_cookies(cookies)
+        _apply_cookies(session, load_cookies())
+        print("🔑 Сессия SmartUp: вход через браузер, cookies сохранены")
+        return session
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Очередь работ на SQL Server: несколько процессов/машин делят (scope, окно)
+через таблицу аренды dbo.WorkLease.
+
+    queue = WorkQueue("balance", connect_sql)
+    queue.ensure(cursor)
+    queue.enqueue(conn, [(scope_key, begin, end), ...])   # идемпотентно, PK не даёт дублей
+    queue.reopen(conn, [(scope_key, begin, end), ...])    # done -> pending (хвост), раз за запуск
+    for unit in queue.claims(conn):                        # UPDLOCK + READPAST: каждый unit — одному
+        ...загрузка...
+        queue.complete(cursor, unit)                       # в той же транзакции, что и данные
+        conn.commit()
+
+- аренда истекает через LEASE_SECONDS; пока unit в работе, фоновый поток
+  продлевает её каждые HEARTBEAT_SECONDS (своё подключение)
+- упавший процесс перестаёт продлевать — его unit забирает другой
+- ошибка: unit в статусе failed, повторяется до MAX_ATTEMPTS попыток;
+  просроченная аренда (процесс упал на этом unit) — тоже попытка, после
+  MAX_ATTEMPTS unit уходит в failed, а не кочует по процессам бесконечно
+- reopen() не трогает units, выполненные менее REOPEN_MIN_AGE назад: каждый
+  процесс планирует при старте, а хвост должен перезагрузиться раз за запуск
+- complete() проверяет, что аренда всё ещё наша, иначе LeaseLost (откатить)
+"""
+import os
+import socket
+import threading
+import uuid
+
+LEASE_TABLE = "dbo.WorkLease"
+LEASE_SECONDS = 600
+HEARTBEAT_SECONDS = 60
+MAX_ATTEMPTS = 3
+REOPEN_MIN_AGE = 3600  # сек; done моложе этого уже загружен в текущем запуске
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class LeaseLost(RuntimeError):
+    pass
+
+
+class Unit:
+    __slots__ = ("scope", "begin", "end", "attempts")
+
+    def __init__(self, scope, begin, end, attempts=0):
+        self.scope = scope
+        self.begin = begin
+        self.end = end
+        self.attempts = attempts
+
+    def key(self):
+        return self.scope, self.begin, self.end
+
+    def __repr__(self):
+        return f"{self.scope} | {self.begin:%d.%m.%Y} - {self.end:%d.%m.%Y}"
+
+
+class WorkQueue:
+    def __init__(self, name: str, connect, worker_id: str = WORKER_ID, lease_seconds: int = LEASE_SECONDS,
+                 heartbeat_seconds: int = HEARTBEAT_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.name = name
+        self.connect = connect  # db.get_connection-подобная: подключение на поток
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    # ====== DDL ======
+    def ensure(self, cursor):
+        cursor.execute(f"""
+IF OBJECT_ID('{LEASE_TABLE}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {LEASE_TABLE} (
+        queue        NVARCHAR(64)  NOT NULL,
+        scope_key    NVARCHAR(200) NOT NULL,
+        window_begin DATE          NOT NULL,
+        window_end   DATE          NOT NULL,
+        status       VARCHAR(10)   NOT NULL CONSTRAINT DF_WorkLease_Status DEFAULT 'pending',
+        worker_id    NVARCHAR(128) NULL,
+        lease_until  DATETIME2(0)  NULL,
+        attempts     INT           NOT NULL CONSTRAINT DF_WorkLease_Attempts DEFAULT 0,
+        last_error   NVARCHAR(500) NULL,
+        updated_utc  DATETIME2(0)  NOT NULL CONSTRAINT DF_WorkLease_Updated DEFAULT SYSUTCDATETIME(),
+        CONSTRAINT PK_WorkLease PRIMARY KEY (queue, scope_key, window_begin, window_end)
+    );
+    CREATE INDEX IX_WorkLease_Claim ON {LEASE_TABLE}(queue, status, lease_until) INCLUDE (attempts);
+END
+""")
+
+    # ====== PLAN ======
+    def enqueue(self, conn, units) -> int:
+        """units: (scope_key, begin, end). Уже известные (в любом статусе) не трогаются."""
+        rows = [(self.name, scope, begin, end) for scope, begin, end in units]
+        if not rows:
+            return 0
+        cursor = conn.cursor()
+        cursor.execute("IF OBJECT_ID('tempdb..#LeasePlan') IS NOT NULL DROP TABLE #LeasePlan;")
+        cursor.execute("CREATE TABLE #LeasePlan (queue NVARCHAR(64), scope_key NVARCHAR(200), "
+                       "window_begin DATE, window_end DATE);")
+        cursor.fast_executemany = True
+        cursor.executemany("INSERT INTO #LeasePlan VALUES (?, ?, ?, ?)", rows)
+        cursor.execute(f"""
+INSERT INTO {LEASE_TABLE} (queue, scope_key, window_begin, window_end)
+SELECT DISTINCT p.queue, p.scope_key, p.window_begin, p.window_end
+FROM #LeasePlan AS p
+WHERE NOT EXISTS (SELECT 1 FROM {LEASE_TABLE} AS l WITH (UPDLOCK, HOLDLOCK)
+                  WHERE l.queue = p.queue AND l.scope_key = p.scope_key
+                    AND l.window_begin = p.window_begin AND l.window_end = p.window_end);
+""")
+        added = cursor.rowcount
+        cursor.execute("DROP TABLE #LeasePlan;")
+        conn.commit()
+        cursor.close()
+        return max(added, 0)
+
+    def reopen(self, conn, units, min_age_seconds: int = REOPEN_MIN_AGE) -> int:
+        """
+        Выполненные (done) units снова в pending — перезагрузка хвоста. Остальные статусы не трогаются,
+        как и units, выполненные менее min_age_seconds назад (их уже перезагрузил соседний процесс).
+        """
+        rows = [(self.name, scope, begin, end) for scope, begin, end in units]
+        if not rows:
+            return 0
+        cursor = conn.cursor()
+        cursor.execute("IF OBJECT_ID('tempdb..#LeaseReopen') IS NOT NULL DROP TABLE #LeaseReopen;")
+        cursor.execute("CREATE TABLE #LeaseReopen (queue NVARCHAR(64), scope_key NVARCHAR(200), "
+                       "window_begin DATE, window_end DATE);")
+        cursor.fast_executemany = True
+        cursor.executemany("INSERT INTO #LeaseReopen VALUES (?, ?, ?, ?)", rows)
+        cursor.execute(f"""
+UPDATE l
+SET status = 'pending', worker_id = NULL, lease_until = NULL, attempts = 0, updated_utc = SYSUTCDATETIME()
+FROM {LEASE_TABLE} AS l
+JOIN #LeaseReopen AS p
+  ON p.queue = l.queue AND p.scope_key = l.scope_key
+ AND p.window_begin = l.window_begin AND p.window_end = l.window_end
+WHERE l.status = 'done' AND l.updated_utc < DATEADD(SECOND, -?, SYSUTCDATETIME());
+""", min_age_seconds)
+        reopened = cursor.rowcount
+        cursor.execute("DROP TABLE #LeaseReopen;")
+        conn.commit()
+        cursor.close()
+        return max(reopened, 0)
+
+    # ====== CLAIM ======
+    def claim(self, conn):
+        """Следующий свободный unit или None. Просроченные аренды тоже свободны (пока есть попытки)."""
+        cursor = conn.cursor()
+        cursor.execute(f"""
+UPDATE {LEASE_TABLE} WITH (READPAST, ROWLOCK)
+SET status = 'failed', lease_until = NULL, last_error = N'аренда истекла: процесс не завершил unit',
+    updated_utc = SYSUTCDATETIME()
+WHERE queue = ? AND status = 'leased' AND lease_until < SYSUTCDATETIME() AND attempts >= ?;
+""", self.name, self.max_attempts)
+        cursor.execute(f"""
+WITH c AS (
+    SELECT TOP (1) *
+    FROM {LEASE_TABLE} WITH (UPDLOCK, READPAST, ROWLOCK)
+    WHERE queue = ?
+      AND (status = 'pending'
+           OR (status = 'leased' AND lease_until < SYSUTCDATETIME() AND attempts < ?)
+           OR (status = 'failed' AND attempts < ?))
+    ORDER BY window_begin, scope_key
+)
+UPDATE c SET
+    status      = 'leased',
+    worker_id   = ?,
+    lease_until = DATEADD(SECOND, ?, SYSUTCDATETIME()),
+    attempts    = attempts + 1,
+    updated_utc = SYSUTCDATETIME()
+OUTPUT inserted.scope_key, inserted.window_begin, inserted.window_end, inserted.attempts;
+""", self.name, self.max_attempts, self.max_attempts, self.worker_id, self.lease_seconds)
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        if row is None:
+            return None
+        unit = Unit(row[0], row[1], row[2], row[3])
+        with self._lock:
+            self._held[unit.key()] = unit
+        self._start_heartbeat()
+        return unit
+
+    def claims(self, conn):
+        """Берёт unit за unit'ом, пока очередь не опустеет."""
+        try:
+            while True:
+                unit = self.claim(conn)
+                if unit is None:
+                    return
+                yield unit
+        finally:
+            self.stop()
+
+    # ====== FINISH ======
+    def _release(self, unit):
+        with self._lock:
+            self._held.pop(unit.key(), None)
+
+    def complete(self, cursor, unit):
+        """Отмечает unit выполненным; commit — за вызывающим (вместе с данными)."""
+        cursor.execute(f"""
+UPDATE {LEASE_TABLE}
+SET status = 'done', lease_until = NULL, last_error = NULL, updated_utc = SYSUTCDATETIME()
+WHERE queue = ? AND scope_key = ? AND window_begin = ? AND window_end = ?
+  AND worker_id = ? AND status = 'leased';
+""", self.name, unit.scope, unit.begin, unit.end, self.worker_id)
+        self._release(unit)
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"{unit}: аренду забрал другой процесс")
+
+    def fail(self, conn, unit, error):
+        self._release(unit)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+UPDATE {LEASE_TABLE}
+SET status = 'failed', lease_until = NULL, last_error = ?, updated_utc = SYSUTCDATETIME()
+WHERE queue = ? AND scope_key = ? AND window_begin = ? AND window_end = ? AND worker_id = ?;
+""", str(error)[:500], self.name, unit.scope, unit.begin, unit.end, self.worker_id)
+        conn.commit()
+        cursor.close()
+
+    # ====== HEARTBEAT ======
+    def _start_heartbeat(self):
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name=f"lease-{self.name}", daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        conn = None
+        while not self._stop.wait(self.heartbeat_seconds):
+            with self._lock:
+                held = list(self._held.values())
+            if not held:
+                continue
+            try:
+                conn = conn or self.connect()
+                cursor = conn.cursor()
+                for unit in held:
+                    cursor.execute(f"""
+UPDATE {LEASE_TABLE}
+SET lease_until = DATEADD(SECOND, ?, SYSUTCDATETIME()), updated_utc = SYSUTCDATETIME()
+WHERE queue = ? AND scope_key = ? AND window_begin = ? AND window_end = ?
+  AND worker_id = ? AND status = 'leased';
+""", self.lease_seconds, self.name, unit.scope, unit.begin, unit.end, self.worker_id)
+                    if cursor.rowcount == 0:
+                        print(f"⚠️ Аренда потеряна: {unit}")
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                # не роняем работу: аренда просто может истечь
+                print(f"⚠️ Heartbeat {LEASE_TABLE}: {e}")
+                conn = None
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    # ====== STATUS ======
+    def status(self, conn) -> dict:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+SELECT CASE WHEN status = 'leased' AND lease_until < SYSUTCDATETIME() THEN 'expired' ELSE status END, COUNT(*)
+FROM {LEASE_TABLE}
+WHERE queue = ?
+GROUP BY CASE WHEN status = 'leased' AND lease_until < SYSUTCDATETIME() THEN 'expired' ELSE status END;
+""", self.name)
+        result = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.close()
+        return result
+
+    def print_status(self, conn):
+        counts = self.status(conn)
+        parts = " | ".join(f"{k}: {counts.get(k, 0)}" for k in ("pending", "leased", "expired", "failed", "done"))
+        print(f"📋 Очередь {self.name} ({LEASE_TABLE}): {parts}")
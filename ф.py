@@ -1,72 +1,60 @@
-import gspread
-import pandas as pd
-import urllib
-from sqlalchemy import create_engine
-from oauth2client.service_account import ServiceAccountCredentials
+import argparse
 
+import profiling
+from db import get_engine
+from run_report import span
+from payments_sync import HEADER_ROW, LocalSheet, connect_sql, prepare_frame, read_used_range, sync_payments
+
+parser = argparse.ArgumentParser(description="Google Sheets F222 -> dbo.PaymentsRaw")
+parser.add_argument("--full", action="store_true", help="старый режим: get_all_values + полная перезаливка")
+parser.add_argument("--stub", help="CSV-файл вместо Google Sheets (локальная проверка)")
+profiling.add_arguments(parser)
+args = parser.parse_args()
 
-# ============ 1. Подключение к Google Sheets ============
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
-client = gspread.authorize(creds)
 
+# ============ 1. Подключение к Google Sheets ============
 SPREADSHEET_ID = "1H85Jz7VR9tIGhNyKB2inyZ0V1tc-LjVQcfJWG-OuHn8"
 SHEET_NAME = "F222"   # замени на актуальное имя листа
-sheet = client.open_by_key(SPREADSHEET_ID).worksheet(SHEET_NAME)
-
-data = sheet.get_all_values()
-df = pd.DataFrame(data)
-
-
-# ============ 2. Подготовка ============
-header_row = 6  # строка с заголовками в Google Sheets (нумерация с нуля → это 7-я строка)
-headers = df.iloc[header_row].tolist()
 
-# подставляем свои заголовки для первых колонок
-headers[:4] = ["#", "Name", "Surname", "Contract"]
+if args.stub:
+    sheet = LocalSheet.from_csv(args.stub)
+else:
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
 
-# заменяем пустые имена колонок
-headers = [h if h.strip() != "" else f"col_{i}" for i, h in enumerate(headers)]
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
+    client = gspread.authorize(creds)
+    sheet = client.open_by_key(SPREADSHEET_ID).worksheet(SHEET_NAME)
 
-# делаем имена уникальными (если Amount повторяется → Amount_1, Amount_2 и т.д.)
-def make_unique(seq):
-    seen = {}
-    result = []
-    for x in seq:
-        if x not in seen:
-            seen[x] = 0
-            result.append(x)
-        else:
-            seen[x] += 1
-            result.append(f"{x}_{seen[x]}")
-    return result
 
-headers = make_unique(headers)
-
-df.columns = headers
-df = df.iloc[header_row+1:].reset_index(drop=True)
-
-# убираем пустые строки
-df = df[df["#"] != ""]
-df = df[~df["#"].str.contains("TOTAL", na=False)]
+# ============ 2. Подготовка ============
+# строка с заголовками — HEADER_ROW (нумерация с нуля → это 7-я строка)
+with span("fetch"):
+    if args.full:
+        data = sheet.get_all_values()
+        width = max(map(len, data), default=0)
+        data = [row + [""] * (width - len(row)) for row in data]
+        header, rows = data[HEADER_ROW], data[HEADER_ROW + 1:]
+    else:
+        # только заполненная область листа, batch-чтение
+        header, rows = read_used_range(sheet, HEADER_ROW)
+
+with span("parse", rows=len(rows)):
+    df = prepare_frame(header, rows)
 
 print("✅ Размер таблицы после загрузки:", df.shape)
 print("✅ Колонки:", df.columns.tolist())
 print(df.head(10).to_string())
 
 
-# ============ 3. Подключение к SQL Server ============
-params = urllib.parse.quote_plus(
-    "DRIVER={ODBC Driver 17 for SQL Server};"
-    "SERVER=localhost;"
-    "DATABASE=Epco;"
-    "Trusted_Connection=yes;"
-    "TrustServerCertificate=yes;"
-)
-
-engine = create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
-
-
-# ============ 4. Загрузка в SQL ============
-df.to_sql("PaymentsRaw", engine, if_exists="replace", index=False)
-print("✅ Данные успешно сохранены в таблицу PaymentsRaw")
+# ============ 3. Загрузка в SQL ============
+if args.full:
+    engine = get_engine("localhost", "Epco")
+    with span("stage", rows=len(df)):
+        df.to_sql("PaymentsRaw", engine, if_exists="replace", index=False)
+    print("✅ Данные успешно сохранены в таблицу PaymentsRaw")
+else:
+    counts = sync_payments(connect_sql(), df)
+    print(f"✅ PaymentsRaw синхронизирована | новых: {counts['inserted']} | изменено: {counts['changed']} | "
+          f"удалено: {counts['removed']} | без изменений: {counts['unchanged']}")